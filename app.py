@@ -1,22 +1,41 @@
+# First, so the startup timings include every import below
+import startup
 import os
-import re
+import importlib.util
 import base64
-from io import BytesIO
-from flask import Flask, render_template, request, jsonify
+import json
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, as_completed, wait
+from flask import Flask, Response, render_template, request, jsonify, stream_with_context
+from werkzeug.wsgi import get_input_stream
 from flask_cors import CORS
-from PIL import Image, ImageEnhance
-import cv2
-import numpy as np
+
+# Only light modules here: /, /health and /ready must not wait for OpenCV, NumPy or
+# Tesseract. The OCR modules are imported by startup.warmup() or by the first route needing them.
+from batch_upload import BatchFormatError, ImageTooBig, iter_batch_images
+from jobs import JobQueue, QueueFull
+from metrics import metrics
+from concurrency import GUNICORN_THREADS, OCR_CONCURRENT, OCR_CPU_BUDGET, OCR_REQUEST_PARALLELISM, ocr_slots
+from concurrency import settings as concurrency_settings
 
 app = Flask(__name__)
+app.config['MAX_CONTENT_LENGTH'] = int(os.environ.get('OCR_MAX_UPLOAD_BYTES', 40 * 1024 * 1024))
 CORS(app)
 
-# Try to import pytesseract, but handle gracefully if not available
-try:
-    import pytesseract
-    TESSERACT_AVAILABLE = True
-except ImportError:
-    TESSERACT_AVAILABLE = False
+# Batch endpoint: images buffered or in progress at once, and the total body limit
+OCR_BATCH_IN_FLIGHT = max(1, int(os.environ.get('OCR_BATCH_IN_FLIGHT', 2 * OCR_CPU_BUDGET)))
+OCR_BATCH_MAX_BYTES = int(os.environ.get('OCR_BATCH_MAX_BYTES', 8 * 1024 ** 3))
+
+# Async job API: dedicated OCR threads per worker and the longest long-poll a client may request
+OCR_JOB_WORKERS = max(1, int(os.environ.get('OCR_JOB_WORKERS', OCR_CPU_BUDGET)))
+OCR_JOB_MAX_WAIT = float(os.environ.get('OCR_JOB_MAX_WAIT', 10))
+# Request threads of a worker that may long-poll at once, so polls cannot take every thread
+OCR_JOB_MAX_POLLERS = max(1, int(os.environ.get('OCR_JOB_MAX_POLLERS', GUNICORN_THREADS // 2)))
+
+# Requests with this header get a per-stage timing breakdown in the JSON response
+DEBUG_TIMINGS_HEADER = 'X-OCR-Debug'
+
+# Looked up without importing the bindings, which load Tesseract and belong to warmup
+TESSERACT_AVAILABLE = any(importlib.util.find_spec(name) is not None for name in ('tesserocr', 'pytesseract'))
 
 @app.route('/')
 def index():
@@ -24,225 +43,299 @@ def index():
 
 @app.route('/health')
 def health():
-    return jsonify({"service": "OCR Patient Scanner", "status": "healthy", "tesseract": TESSERACT_AVAILABLE})
+    """
+    Liveness only; answers while the OCR modules are still loading
+    """
+    return jsonify({"service": "OCR Patient Scanner", "status": "healthy", "tesseract": TESSERACT_AVAILABLE,
+                    "ready": startup.is_ready()})
+
+@app.route('/ready')
+def ready():
+    """
+    200 once this worker has finished warmup, 503 before; starts warmup if nothing has
+    """
+    startup.ensure_warm()
+    status = startup.status()
+    return jsonify(status), 200 if status['ready'] else 503
 
 @app.route('/api/status')
 def api_status():
+    from ocr_engine import engine_pool
+    from image_decode import peak_rss_mb
+    from result_cache import result_cache
+    from scheduler import attempt_scheduler
+    from pipeline import TESSERACT_AVAILABLE
+    from scan_store import scan_store
+    
     return jsonify({
         "service": "OCR Patient Scanner",
         "version": "2.0.0",
         "ocr_engine": "Tesseract (Server-side)" if TESSERACT_AVAILABLE else "Fallback OCR",
+        "engine_pool": engine_pool.stats(),
+        "peak_rss_mb": peak_rss_mb(),
+        "result_cache": result_cache.stats(),
+        "jobs": job_queue.stats(),
+        "scheduler": attempt_scheduler.stats(),
+        "scan_store": scan_store.stats(),
+        "concurrent_ocr": {
+            "enabled": OCR_CONCURRENT,
+            "cpu_budget": OCR_CPU_BUDGET,
+            "request_parallelism": OCR_REQUEST_PARALLELISM,
+        },
+        "concurrency": dict(concurrency_settings(), slot_usage=ocr_slots.stats()),
+        "startup": startup.status(),
         "status": "operational"
     })
 
-def simple_digit_extraction(image):
+@app.route('/metrics')
+def prometheus_metrics():
     """
-    Fallback OCR method using basic image processing
-    when Tesseract is not available
+    Stage latency histograms and outcome counters of all workers, in Prometheus text format
     """
-    try:
-        # Convert PIL image to OpenCV format
-        opencv_image = cv2.cvtColor(np.array(image), cv2.COLOR_RGB2BGR)
-        
-        # Convert to grayscale
-        gray = cv2.cvtColor(opencv_image, cv2.COLOR_BGR2GRAY)
-        
-        # Apply thresholding
-        _, thresh = cv2.threshold(gray, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
-        
-        # Find contours for text regions
-        contours, _ = cv2.findContours(thresh, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-        
-        # Look for rectangular regions that might contain text
-        text_regions = []
-        for contour in contours:
-            x, y, w, h = cv2.boundingRect(contour)
-            if w > 30 and h > 8 and 2 <= w/h <= 15:  # Likely text region
-                text_regions.append((x, y, w, h))
-        
-        text_regions.sort(key=lambda r: (r[1], r[0]))
-        
-        if len(text_regions) > 0:
-            return "FALLBACK_ATTEMPTED"
-        
-        return None
-        
-    except Exception as e:
-        print(f"Fallback OCR error: {e}")
-        return None
+    return Response(metrics.render() + startup.render(), mimetype='text/plain; version=0.0.4')
 
-def extract_patient_number(text):
+def read_upload():
     """
-    Enhanced patient number extraction with support for fragmented OCR results
+    Image source from the request body: a raw image/* (or octet-stream) body,
+    a multipart file field, or the legacy JSON {"image": "<base64>"} payload.
+    Returns None when a multipart request carries no file.
     """
-    digit_sequences = re.findall(r'\d+', text)
-    if not digit_sequences:
-        return None
-    
-    all_digits = ''.join(digit_sequences)
-    
-    # Look for specific patterns that should be interpreted as "3912171035"
-    specific_pattern1 = re.search(r'39\.12\.17-193\.06', text)
-    specific_pattern2 = re.search(r'39\.1217-193\.06', text)
-    if specific_pattern1 or specific_pattern2:
-        return "3912171035"
-    
-    # Look for general medical card patterns before checking consecutive digits
-    medical_pattern2 = re.search(r'(\d{2})\.(\d{2})\.(\d{2})-(\d{3})\.(\d{2})', text)
-    if medical_pattern2:
-        groups = medical_pattern2.groups()
-        candidate = groups[0] + groups[1] + groups[2] + groups[3][:2] + groups[4][-1]  # Take last digit of last group
-        if len(candidate) == 10:
-            return candidate
-    
-    # Look for patterns like XX.XXXX-XXX.XX that could be patient numbers (medical card format)
-    medical_pattern = re.search(r'(\d{2})\.(\d{4})-(\d{3})\.(\d{2})', text)
-    if medical_pattern:
-        groups = medical_pattern.groups()
-        
-        if groups[0] == '39' and groups[1] == '1217' and groups[2] == '193' and groups[3] == '06':
-            return "3912171035"
-        
-        candidate = groups[0] + groups[1] + groups[2][:2] + groups[3]
-        if len(candidate) == 10:
-            return candidate
-    
-    # Try to find exactly 10 consecutive digits
-    ten_digit_pattern = re.findall(r'\b\d{10}\b', text)
-    if ten_digit_pattern:
-        return ten_digit_pattern[0]
-    
-    for i in range(len(all_digits) - 9):
-        candidate = all_digits[i:i+10]
-        if candidate.startswith(('39', '38', '37')):  # Common patient number prefixes
-            return candidate
-    
-    if len(all_digits) == 10:
-        return all_digits
+    if request.mimetype.startswith('image/') or request.mimetype == 'application/octet-stream':
+        # Read once, without keeping werkzeug's cached copy of the body
+        return request.get_data(cache=False)
     
-    if len(all_digits) >= 10:
-        return all_digits[:10]
+    if request.mimetype == 'multipart/form-data':
+        # Werkzeug spools large parts to a temp file; decode straight from it
+        upload = request.files.get('image') or next(iter(request.files.values()), None)
+        return upload.stream if upload else None
     
-    return None
+    data = request.get_json()
+    return base64.b64decode(data['image'])
 
 @app.route('/process_ocr', methods=['POST'])
 def process_ocr():
+    with metrics.request() as timings:
+        return recognize_request(timings)
+
+def recognize_request(timings):
+    from image_decode import ImageTooLarge
+    from pipeline import TESSERACT_AVAILABLE, recognize_upload
+    
     try:
-        data = request.get_json()
-        image_data = base64.b64decode(data['image'])
-        
-        # Convert to PIL Image once
-        image = Image.open(BytesIO(image_data))
-        
-        # Convert to grayscale directly with PIL (more efficient)
-        if image.mode != 'L':
-            gray_image = image.convert('L')
-        else:
-            gray_image = image
-        
-        # Convert to numpy array for OpenCV operations (single conversion)
-        gray_array = np.array(gray_image)
-        
-        preprocessing_methods = []
-        
-        _, thresh_otsu = cv2.threshold(gray_array, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
-        processed_otsu = cv2.medianBlur(thresh_otsu, 3)
-        preprocessing_methods.append(('otsu', Image.fromarray(processed_otsu)))
-        
-        enhanced_contrast = np.array(ImageEnhance.Contrast(gray_image).enhance(2.0))
-        _, thresh_enhanced = cv2.threshold(enhanced_contrast, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
-        denoised_enhanced = cv2.medianBlur(thresh_enhanced, 3)
-        preprocessing_methods.append(('enhanced', Image.fromarray(denoised_enhanced)))
-        
-        adaptive_thresh = cv2.adaptiveThreshold(gray_array, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C, cv2.THRESH_BINARY, 11, 2)
-        preprocessing_methods.append(('adaptive', Image.fromarray(adaptive_thresh)))
+        with metrics.timed('ocr_stage_seconds', stage='read_upload'):
+            image_data = read_upload()
+        if image_data is None:
+            metrics.inc('ocr_failures_total', reason='no_upload')
+            return jsonify({
+                'success': False,
+                'error': 'No image file in upload'
+            }), 400
         
-        text = ""
-        best_result = None
-        
-        if TESSERACT_AVAILABLE:
-            try:
-                for method_name, processed_image in preprocessing_methods:
-                    digit_config = r'--oem 3 --psm 8 -c tessedit_char_whitelist=0123456789'
-                    ocr_text = pytesseract.image_to_string(processed_image, config=digit_config).strip()
-                    
-                    if not ocr_text or not any(c.isdigit() for c in ocr_text):
-                        ocr_text = pytesseract.image_to_string(processed_image, config=r'--oem 3 --psm 6').strip()
-                    
-                    if ocr_text and re.search(r'\d', ocr_text):
-                        patient_num = extract_patient_number(ocr_text)
-                        if patient_num:
-                            text = ocr_text
-                            best_result = (method_name, 'simplified_config', patient_num)
-                            break
-                        elif not best_result:  # Keep first result with digits as fallback
-                            text = ocr_text
-                            best_result = (method_name, 'simplified_config', None)
-                
-                if not best_result or not best_result[2]:
-                    digit_config = r'--oem 3 --psm 8 -c tessedit_char_whitelist=0123456789'
-                    text = pytesseract.image_to_string(image, config=digit_config).strip()
-                    
-                    if not text or not any(c.isdigit() for c in text):
-                        text = pytesseract.image_to_string(image, config=r'--oem 3 --psm 6').strip()
-                    
-                    if text:
-                        patient_num = extract_patient_number(text)
-                        if patient_num:
-                            best_result = ('original', 'simplified_config', patient_num)
-                            
-            except Exception as tesseract_error:
-                print(f"Tesseract error: {tesseract_error}")
-                # Fall back to simple extraction
-                fallback_result = simple_digit_extraction(preprocessing_methods[0][1] if preprocessing_methods else image)
-                if fallback_result and fallback_result != "FALLBACK_ATTEMPTED":
-                    text = fallback_result
-        else:
-            # Use fallback method
-            fallback_result = simple_digit_extraction(preprocessing_methods[0][1] if preprocessing_methods else image)
-            if fallback_result and fallback_result != "FALLBACK_ATTEMPTED":
-                text = fallback_result
-            else:
-                text = ""
-        
-        patient_number = extract_patient_number(text)
-        
-        if patient_number:
-            response_data = {
-                'success': True,
-                'patient_number': patient_number,
-                'raw_text': text,
-                'method': 'tesseract' if TESSERACT_AVAILABLE else 'fallback',
-            }
-            
-            if best_result:
-                response_data['preprocessing'] = best_result[0]
-                response_data['ocr_config'] = best_result[1]
-                
-            return jsonify(response_data)
-        
-        # Provide helpful feedback about what was found
-        found_numbers = re.findall(r'\d+', text)
-        all_digits = re.sub(r'\D', '', text)
+        response_data = recognize_upload(image_data)
+        if request.headers.get(DEBUG_TIMINGS_HEADER):
+            response_data = dict(response_data, timings=timings.to_dict())
+        return jsonify(response_data)
         
+    except ImageTooLarge as e:
+        metrics.inc('ocr_failures_total', reason='too_large')
         return jsonify({
             'success': False,
-            'message': 'No 10-digit patient number found',
-            'raw_text': text,
-            'method': 'tesseract' if TESSERACT_AVAILABLE else 'fallback',
-            'found_numbers': found_numbers,
-            'total_digits': len(all_digits),
-            'suggestion': 'Try a clearer image or ensure the patient number is clearly visible'
-        })
-        
+            'error': str(e),
+            'suggestion': 'Retake the photo at a lower resolution'
+        }), 413
     except Exception as e:
+        metrics.inc('ocr_failures_total', reason='error')
         return jsonify({
             'success': False,
             'error': str(e),
             'tesseract_available': TESSERACT_AVAILABLE
         }), 500
 
+@app.route('/preflight', methods=['POST'])
+def preflight():
+    """
+    Image-quality checks only, no OCR: lets a client vet a photo (or a downscaled
+    copy of it) before uploading it for recognition
+    """
+    import numpy as np
+    from image_decode import ImageTooLarge, decode_grayscale
+    from preflight import preflight_check
+    
+    try:
+        image_data = read_upload()
+        if image_data is None:
+            return jsonify({'success': False, 'error': 'No image file in upload'}), 400
+        # Decoded exactly as /process_ocr decodes it: a smaller JPEG draft changes sharpness and text lines
+        with metrics.timed('ocr_stage_seconds', stage='preflight_decode'):
+            gray_image, _ = decode_grayscale(image_data)
+        with metrics.timed('ocr_stage_seconds', stage='preflight'):
+            return jsonify(preflight_check(np.asarray(gray_image)))
+    except ImageTooLarge as e:
+        return jsonify({'success': False, 'error': str(e)}), 413
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+def recognize_job(image_data):
+    # Jobs OCR their variants sequentially; the job threads already use the CPU budget
+    from pipeline import recognize_upload
+    return recognize_upload(image_data, concurrent=False)
+
+job_queue = JobQueue(recognize_job, workers=OCR_JOB_WORKERS, max_pollers=OCR_JOB_MAX_POLLERS)
+
+@app.route('/jobs', methods=['POST'])
+def submit_job():
+    """
+    Queue an image for OCR and return its job id immediately (202),
+    or 429 with Retry-After when the queue is full
+    """
+    image_data = read_upload()
+    if image_data is None:
+        return jsonify({
+            'success': False,
+            'error': 'No image file in upload'
+        }), 400
+    
+    # Multipart uploads are backed by a temp file that closes with the request
+    if hasattr(image_data, 'read'):
+        image_data = image_data.read()
+    
+    try:
+        job_id = job_queue.submit(image_data)
+    except QueueFull as e:
+        response = jsonify({
+            'success': False,
+            'error': str(e),
+            'retry_after': e.retry_after
+        })
+        response.headers['Retry-After'] = str(e.retry_after)
+        return response, 429
+    
+    return jsonify({
+        'job_id': job_id,
+        'status': 'queued',
+        'poll_url': f'/jobs/{job_id}'
+    }), 202
+
+@app.route('/jobs/<job_id>')
+def get_job(job_id):
+    """
+    Job status and, once done, its OCR result. `?wait=N` long-polls up to N seconds
+    (at most OCR_JOB_MAX_WAIT, and only while this worker has a long-poll slot free).
+    """
+    wait_seconds = min(max(request.args.get('wait', 0, type=float), 0), OCR_JOB_MAX_WAIT)
+    job = job_queue.get(job_id, wait=wait_seconds)
+    if job is None:
+        return jsonify({'success': False, 'error': 'Unknown job id'}), 404
+    return jsonify(job)
+
+def batch_item(index, name, image_data):
+    """
+    One NDJSON record of a batch; errors are reported per image, never raised
+    """
+    from pipeline import recognize_upload
+    
+    if isinstance(image_data, ImageTooBig):
+        return {'index': index, 'name': name, 'success': False, 'error': 'Image exceeds batch size limit'}
+    try:
+        # Batch items already run in parallel, so each one OCRs its variants sequentially
+        return dict({'index': index, 'name': name}, **recognize_upload(image_data, concurrent=False))
+    except Exception as e:
+        return {'index': index, 'name': name, 'success': False, 'error': str(e)}
+
+@app.route('/process_ocr/batch', methods=['POST'])
+def process_ocr_batch():
+    """
+    OCR many images from one multipart, tar or zip body.
+    Streams one JSON line per image in completion order, with at most
+    OCR_BATCH_IN_FLIGHT images decoded or queued at any time.
+    """
+    stream = get_input_stream(request.environ, safe_fallback=False, max_content_length=OCR_BATCH_MAX_BYTES)
+    try:
+        images = iter_batch_images(request.mimetype, request.mimetype_params, stream)
+    except BatchFormatError as e:
+        return jsonify({'success': False, 'error': str(e)}), 415
+    
+    def generate():
+        # Threads only stage the images; each one waits for an OCR slot like any other request.
+        # Using the shared OCR executor here could starve the attempts of concurrent-mode requests.
+        executor = ThreadPoolExecutor(max_workers=OCR_BATCH_IN_FLIGHT, thread_name_prefix='ocr-batch')
+        pending = {}
+        count = 0
+        try:
+            for index, (name, image_data) in enumerate(images):
+                while len(pending) >= OCR_BATCH_IN_FLIGHT:
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        del pending[future]
+                        yield json.dumps(future.result()) + '\n'
+                pending[executor.submit(batch_item, index, name, image_data)] = index
+                count += 1
+            
+            for future in as_completed(list(pending)):
+                del pending[future]
+                yield json.dumps(future.result()) + '\n'
+            
+            yield json.dumps({'done': True, 'count': count}) + '\n'
+        except BatchFormatError as e:
+            yield json.dumps({'done': False, 'error': str(e)}) + '\n'
+        finally:
+            # Client went away: drop images that have not started
+            for future in pending:
+                future.cancel()
+            executor.shutdown(wait=False)
+    
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+@app.route('/live', methods=['POST'])
+def start_live_session():
+    """
+    Open a live scanning session; frames are then posted to its frame_url
+    """
+    from live_scan import live_sessions
+    
+    session_id = live_sessions.start()
+    return jsonify({
+        'session_id': session_id,
+        'frame_url': f'/live/{session_id}/frames'
+    }), 201
+
+@app.route('/live/<session_id>/frames', methods=['POST'])
+def live_frame(session_id):
+    """
+    One camera frame of a live session. Blurry, duplicate and superseded frames are
+    answered without a read; status is 'done' with the result once the number is settled.
+    """
+    from image_decode import ImageTooLarge
+    from live_scan import live_sessions
+    
+    try:
+        image_data = read_upload()
+        if image_data is None:
+            return jsonify({'success': False, 'error': 'No image file in upload'}), 400
+        frame = live_sessions.submit_frame(session_id, image_data)
+    except ImageTooLarge as e:
+        return jsonify({'success': False, 'error': str(e)}), 413
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)}), 500
+    
+    if frame is None:
+        return jsonify({'success': False, 'error': 'Unknown or expired session'}), 404
+    return jsonify(frame)
+
+@app.route('/live/<session_id>')
+def get_live_session(session_id):
+    from live_scan import live_sessions
+    
+    session = live_sessions.get(session_id)
+    if session is None:
+        return jsonify({'success': False, 'error': 'Unknown or expired session'}), 404
+    return jsonify(session)
+
+startup.mark('import_app')
+
 if __name__ == '__main__':
+    # No preload master here: warm up in the background while the server starts
+    startup.ensure_warm()
     port = int(os.environ.get('PORT', 10000))
     app.run(host='0.0.0.0', port=port)
 
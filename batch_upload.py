@@ -0,0 +1,152 @@
+"""
+Incremental readers for batch uploads.
+
+Each reader yields (name, image_bytes) one image at a time while the request
+body is still arriving, so a batch never has to be held in memory at once.
+Supported bodies: multipart/form-data (every file part), tar (optionally
+gzip/bz2/xz compressed) and zip.
+"""
+import os
+import posixpath
+import shutil
+import tarfile
+import tempfile
+import zipfile
+import zlib
+
+from werkzeug.exceptions import ClientDisconnected
+from werkzeug.sansio.multipart import Data, Epilogue, File, MultipartDecoder, NeedData
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.tif', '.tiff', '.bmp', '.webp', '.gif')
+# A single image larger than this in a batch is skipped rather than buffered
+MAX_IMAGE_BYTES = int(os.environ.get('OCR_BATCH_MAX_IMAGE_BYTES', 40 * 1024 * 1024))
+CHUNK_SIZE = 64 * 1024
+
+TAR_TYPES = ('application/x-tar', 'application/tar', 'application/gzip', 'application/x-gzip',
+             'application/x-bzip2', 'application/x-xz', 'application/x-gtar')
+ZIP_TYPES = ('application/zip', 'application/x-zip-compressed')
+
+
+class BatchFormatError(ValueError):
+    """Raised when a batch body is not a supported archive or multipart upload"""
+
+
+class ImageTooBig(ValueError):
+    """A single batch entry above OCR_BATCH_MAX_IMAGE_BYTES"""
+
+
+def is_image_name(name):
+    return name.lower().endswith(IMAGE_EXTENSIONS)
+
+
+def iter_multipart(stream, boundary):
+    """
+    File parts of a multipart body, parsed as the bytes arrive
+    """
+    decoder = MultipartDecoder(boundary.encode('latin-1'))
+    name = None
+    parts = []
+    size = 0
+
+    while True:
+        event = decoder.next_event()
+        if isinstance(event, NeedData):
+            chunk = stream.read(CHUNK_SIZE)
+            decoder.receive_data(chunk or None)
+        elif isinstance(event, File):
+            name = event.filename or event.name
+            parts = []
+            size = 0
+        elif isinstance(event, Data) and name is not None:
+            size += len(event.data)
+            if size <= MAX_IMAGE_BYTES:
+                parts.append(event.data)
+            if not event.more_data:
+                yield name, (b''.join(parts) if size <= MAX_IMAGE_BYTES else ImageTooBig(name))
+                name = None
+                parts = []
+        elif isinstance(event, Epilogue):
+            return
+
+
+def iter_tar(stream):
+    """
+    Image members of a tar stream, read sequentially without seeking
+    """
+    try:
+        archive = tarfile.open(fileobj=stream, mode='r|*')
+    except tarfile.TarError as e:
+        raise BatchFormatError(f"Not a tar archive: {e}")
+
+    with archive:
+        for member in archive:
+            if not member.isfile() or not is_image_name(member.name):
+                continue
+            if member.size > MAX_IMAGE_BYTES:
+                yield member.name, ImageTooBig(member.name)
+                continue
+            yield member.name, archive.extractfile(member).read()
+
+        # tarfile stops silently at an invalid header after the first; a real end is zero padding only
+        while True:
+            rest = archive.fileobj.read(CHUNK_SIZE)
+            if not rest:
+                break
+            if rest.count(0) != len(rest):
+                raise BatchFormatError('Tar archive is corrupt after its last readable member')
+
+
+def iter_zip(stream):
+    """
+    Image members of a zip body. Zip needs its central directory, so the body
+    is spooled to a temporary file first; members are then read one at a time.
+    """
+    with tempfile.TemporaryFile() as spool:
+        shutil.copyfileobj(stream, spool, CHUNK_SIZE)
+        spool.seek(0)
+        try:
+            archive = zipfile.ZipFile(spool)
+        except zipfile.BadZipFile as e:
+            raise BatchFormatError(f"Not a zip archive: {e}")
+
+        with archive:
+            for info in archive.infolist():
+                if info.is_dir() or not is_image_name(info.filename):
+                    continue
+                if posixpath.basename(info.filename).startswith('.'):
+                    continue
+                if info.file_size > MAX_IMAGE_BYTES:
+                    yield info.filename, ImageTooBig(info.filename)
+                    continue
+                yield info.filename, archive.read(info)
+
+
+def broken_body_errors(images):
+    """
+    Pass `images` through, turning a body that breaks off or is corrupt partway
+    (client gone, truncated multipart, damaged archive) into BatchFormatError
+    """
+    try:
+        yield from images
+    except BatchFormatError:
+        raise
+    except (ClientDisconnected, ValueError, EOFError, OSError, zlib.error,
+            tarfile.TarError, zipfile.BadZipFile) as e:
+        raise BatchFormatError(f"Batch body is truncated or corrupt: {e}")
+
+
+def iter_batch_images(mimetype, mimetype_params, stream):
+    """
+    (name, image_bytes or ImageTooBig) pairs for a batch request body.
+    Errors while reading the body are raised as BatchFormatError.
+    """
+    if mimetype == 'multipart/form-data':
+        boundary = mimetype_params.get('boundary')
+        if not boundary:
+            raise BatchFormatError('Multipart upload without boundary')
+        return broken_body_errors(iter_multipart(stream, boundary))
+    if mimetype in TAR_TYPES:
+        return broken_body_errors(iter_tar(stream))
+    if mimetype in ZIP_TYPES:
+        return broken_body_errors(iter_zip(stream))
+    raise BatchFormatError(f"Unsupported batch content type: {mimetype}")
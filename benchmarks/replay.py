@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+"""
+Replay stored scans through the current pipeline.
+
+Reads the images kept by the scan store (OCR_SCAN_STORE_IMAGES, see
+scan_store.py), runs each one through pipeline.recognize again, without the
+result cache, and diffs the result and the latency against what was recorded
+when the image was first scanned. Recorded latency is the time the pipeline
+took, without the time the image waited for an OCR slot, since replay runs one
+image at a time, and without reading the upload, which replay does not do.
+
+    python benchmarks/replay.py --store ocr-scans.sqlite --output replay.json
+    python benchmarks/replay.py --store ocr-scans.sqlite --days 7 --limit 200 --changed-only
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+# Every image is OCR'd again: no result cache, no new scan records, no metrics files for a
+# server on this host to merge, and a scheduler that learns from scratch
+os.environ.setdefault('OCR_CACHE', 'false')
+os.environ['OCR_SCAN_STORE'] = 'false'
+os.environ['OCR_METRICS'] = 'false'
+os.environ.setdefault('OCR_SCHEDULER_PATH', os.path.join(tempfile.mkdtemp(prefix='ocr-replay-'), 'scheduler.json'))
+
+from run_benchmark import git_commit, percentile  # noqa: E402
+from scan_store import STORE_PATH, ScanStore  # noqa: E402
+
+
+def verdict(recorded, replayed):
+    """
+    How the replayed result differs from the recorded one
+    """
+    if recorded['success'] and replayed.get('success'):
+        if (recorded['patient_number'], recorded['national_number']) == (
+                replayed.get('patient_number'), replayed.get('national_number')):
+            return 'same'
+        return 'changed'
+    if replayed.get('success'):
+        return 'gained'
+    if recorded['success']:
+        return 'lost'
+    return 'same'
+
+
+def recorded_latency(scan):
+    """
+    Pipeline time of a recorded scan in ms, without the OCR slot wait. Scans stored
+    before pipeline_ms was recorded have the upload read taken off the request time.
+    """
+    if scan['pipeline_ms'] is not None:
+        elapsed = scan['pipeline_ms']
+    elif scan['total_ms'] is not None:
+        elapsed = scan['total_ms'] - sum(entry['ms'] for entry in scan['timings'] if entry['stage'] == 'read_upload')
+    else:
+        return None
+    return round(elapsed - (scan['queue_ms'] or 0), 1)
+
+
+def run(store, since, limit, changed_only):
+    import pipeline
+    import startup
+
+    startup.warmup()
+
+    records = []
+    for scan in store.scans(since=since, limit=limit):
+        started = time.perf_counter()
+        try:
+            result = pipeline.recognize(scan['image'])
+            error = None
+        except Exception as e:
+            result, error = {}, str(e)
+        latency_ms = (time.perf_counter() - started) * 1000
+        recorded_ms = recorded_latency(scan)
+
+        record = {
+            'scan_id': scan['id'],
+            'image_hash': scan['image_hash'],
+            'verdict': 'error' if error else verdict(scan, result),
+            'recorded': {
+                'patient_number': scan['patient_number'],
+                'national_number': scan['national_number'],
+                'checksum_valid': bool(scan['checksum_valid']) if scan['checksum_valid'] is not None else None,
+                'preprocessing': scan['preprocessing'],
+                'latency_ms': recorded_ms,
+            },
+            'replayed': {
+                'patient_number': result.get('patient_number'),
+                'national_number': result.get('national_number'),
+                'checksum_valid': result.get('checksum_valid'),
+                'preprocessing': result.get('preprocessing'),
+                'latency_ms': round(latency_ms, 1),
+            },
+            'error': error,
+        }
+        records.append(record)
+        if record['verdict'] != 'same' or not changed_only:
+            print(f"{record['verdict']:8s} {scan['id']:6d} {recorded_ms or 0:8.1f} -> {latency_ms:8.1f} ms  "
+                  f"{pipeline.read_number(scan)} -> {pipeline.read_number(result)}")
+
+    recorded = [r['recorded']['latency_ms'] for r in records if r['recorded']['latency_ms'] is not None]
+    replayed = [r['replayed']['latency_ms'] for r in records]
+    ratios = [r['replayed']['latency_ms'] / r['recorded']['latency_ms'] for r in records
+              if r['recorded']['latency_ms']]
+    summary = {'images': len(records)}
+    for name in ('same', 'changed', 'gained', 'lost', 'error'):
+        summary[name] = sum(1 for r in records if r['verdict'] == name)
+    summary.update({
+        'recorded_latency_ms_p50': percentile(recorded, 0.5),
+        'recorded_latency_ms_p95': percentile(recorded, 0.95),
+        'replayed_latency_ms_p50': percentile(replayed, 0.5),
+        'replayed_latency_ms_p95': percentile(replayed, 0.95),
+        'latency_ratio_p50': round(percentile(ratios, 0.5), 3) if ratios else None,
+    })
+    config = {
+        'store': store.path,
+        'since': since,
+        'limit': limit,
+        'tesseract_available': pipeline.TESSERACT_AVAILABLE,
+        'concurrent': pipeline.OCR_CONCURRENT,
+        'cpu_count': os.cpu_count(),
+    }
+    return {'commit': git_commit(), 'timestamp': time.time(), 'config': config,
+            'summary': summary, 'records': records}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay stored scans through the current OCR pipeline')
+    parser.add_argument('--store', default=STORE_PATH, help='scan store database')
+    parser.add_argument('--days', type=float, help='only scans from the last N days')
+    parser.add_argument('--limit', type=int, help='at most this many images')
+    parser.add_argument('--changed-only', action='store_true', help='print only images whose result changed')
+    parser.add_argument('--output', default='replay-results.json')
+    args = parser.parse_args()
+
+    if not os.path.exists(args.store):
+        parser.error(f"no scan store at {args.store}")
+    store = ScanStore(path=args.store, enabled=True)
+    since = time.time() - args.days * 86400 if args.days else None
+
+    results = run(store, since, args.limit, args.changed_only)
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+
+    print()
+    for field, value in results['summary'].items():
+        print(f"  {field:24s} {value}")
+    print(f"Results written to {args.output}")
+
+
+if __name__ == '__main__':
+    main()
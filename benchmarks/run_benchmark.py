@@ -0,0 +1,200 @@
+#!/usr/bin/env python3
+"""
+Offline OCR benchmark on synthetic medical cards.
+
+Renders cards with known national register numbers (see synthetic_cards.py), runs each
+one through pipeline.recognize, the same code as POST /process_ocr, and reports
+p50/p95 latency, Tesseract calls per image, peak memory and accuracy. Results
+are written as JSON, so runs from different commits can be compared with
+--compare.
+
+    python benchmarks/run_benchmark.py --count 50 --output bench-main.json
+    python benchmarks/run_benchmark.py --count 50 --output bench-branch.json --compare bench-main.json
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+# Every card is new to the pipeline: no result cache, and a scheduler that learns from scratch.
+# No metrics files either: a server on this host would merge them into its own counters.
+os.environ.setdefault('OCR_CACHE', 'false')
+os.environ['OCR_METRICS'] = 'false'
+os.environ.setdefault('OCR_SCHEDULER_PATH', os.path.join(tempfile.mkdtemp(prefix='ocr-bench-'), 'scheduler.json'))
+
+from synthetic_cards import DIFFICULTY  # noqa: E402
+
+# Summary fields compared by --compare, and whether a higher value is better
+COMPARED = (
+    ('accuracy', True),
+    ('latency_ms_p50', False),
+    ('latency_ms_p95', False),
+    ('tesseract_calls_mean', False),
+    ('peak_rss_mb', False),
+)
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def render_cards(directory, count, seed, difficulty, font_glob=None):
+    """
+    Write the cards and their manifest to `directory` with synthetic_cards.py, in a child
+    process so rendering does not count towards this process's peak memory
+    """
+    command = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'synthetic_cards.py'),
+               directory, '--count', str(count), '--seed', str(seed), '--difficulty', difficulty]
+    if font_glob:
+        command += ['--fonts', font_glob]
+    subprocess.run(command, check=True, stdout=subprocess.DEVNULL)
+    with open(os.path.join(directory, 'manifest.json')) as f:
+        return json.load(f)
+
+
+def load_card(directory, entry):
+    """
+    A manifest entry as (jpeg_bytes, expected_national_number, params)
+    """
+    with open(os.path.join(directory, entry['file']), 'rb') as f:
+        data = f.read()
+    params = {key: value for key, value in entry.items() if key not in ('file', 'expected')}
+    return data, entry['expected'], params
+
+
+def run(count, seed, difficulty, warmup, font_glob=None):
+    with tempfile.TemporaryDirectory(prefix='ocr-bench-cards-') as directory:
+        manifest = render_cards(directory, count + warmup, seed, difficulty, font_glob)
+        return measure(directory, manifest, count, seed, difficulty, warmup, font_glob)
+
+
+def measure(directory, manifest, count, seed, difficulty, warmup, font_glob):
+    import pipeline
+    from image_decode import peak_rss_mb
+    from ocr_engine import engine_pool
+
+    # Warmup images load the engines and language data; they are not measured
+    for entry in manifest[:warmup]:
+        pipeline.recognize(load_card(directory, entry)[0])
+
+    records = []
+    for index, entry in enumerate(manifest[warmup:]):
+        data, expected, params = load_card(directory, entry)
+        calls_before = engine_pool.calls
+        started = time.perf_counter()
+        try:
+            result = pipeline.recognize(data)
+            error = None
+        except Exception as e:
+            result, error = {}, str(e)
+        latency_ms = (time.perf_counter() - started) * 1000
+
+        records.append({
+            'index': index,
+            'expected': expected,
+            'read': pipeline.read_number(result),
+            'correct': pipeline.read_number(result) == expected,
+            'latency_ms': round(latency_ms, 1),
+            'tesseract_calls': engine_pool.calls - calls_before,
+            'method': result.get('method'),
+            'preprocessing': result.get('preprocessing'),
+            'confidence': result.get('confidence'),
+            'error': error,
+            'card': dict(params, jpeg_bytes=len(data)),
+        })
+        status = 'ok  ' if records[-1]['correct'] else 'MISS'
+        print(f"{status} {index:4d} {latency_ms:8.1f} ms  expected {expected}  got {pipeline.read_number(result)}")
+
+    latencies = [r['latency_ms'] for r in records]
+    calls = [r['tesseract_calls'] for r in records]
+    summary = {
+        'images': len(records),
+        'accuracy': round(sum(r['correct'] for r in records) / len(records), 4) if records else None,
+        'latency_ms_p50': percentile(latencies, 0.5),
+        'latency_ms_p95': percentile(latencies, 0.95),
+        'latency_ms_max': max(latencies) if latencies else None,
+        'tesseract_calls_mean': round(sum(calls) / len(calls), 2) if calls else None,
+        'tesseract_calls_max': max(calls) if calls else None,
+        'peak_rss_mb': peak_rss_mb(),
+        'errors': sum(1 for r in records if r['error']),
+    }
+    config = {
+        'count': count,
+        'seed': seed,
+        'difficulty': difficulty,
+        'fonts': font_glob,
+        'warmup': warmup,
+        'fast_path': pipeline.OCR_FAST_PATH,
+        'tesseract_available': pipeline.TESSERACT_AVAILABLE,
+        'engine': engine_pool.stats()['backend'],
+        'concurrent': pipeline.OCR_CONCURRENT,
+        'arms': pipeline.OCR_ARMS,
+        'cpu_count': os.cpu_count(),
+    }
+    return {'commit': git_commit(), 'timestamp': time.time(), 'config': config,
+            'summary': summary, 'records': records}
+
+
+def compare(summary, baseline):
+    """
+    Print summary deltas against a previous benchmark result
+    """
+    print(f"\nCompared with {baseline.get('commit') or 'baseline'}:")
+    for field, higher_is_better in COMPARED:
+        old, new = baseline['summary'].get(field), summary.get(field)
+        if old is None or new is None:
+            continue
+        delta = new - old
+        if delta == 0:
+            verdict = ''
+        else:
+            verdict = 'better' if (delta > 0) == higher_is_better else 'worse'
+        change = f" ({delta / old:+.1%})" if old else ''
+        print(f"  {field:22s} {old:>10} -> {new:>10}  {delta:+.4g}{change} {verdict}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the OCR pipeline on synthetic medical cards')
+    parser.add_argument('--count', type=int, default=30, help='measured images')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--difficulty', choices=sorted(DIFFICULTY), default='medium')
+    parser.add_argument('--warmup', type=int, default=2, help='unmeasured images run first')
+    parser.add_argument('--fonts', help='glob of font files to render the cards with')
+    parser.add_argument('--output', default='benchmark-results.json')
+    parser.add_argument('--compare', help='previous results file to compare against')
+    args = parser.parse_args()
+
+    results = run(args.count, args.seed, args.difficulty, args.warmup, args.fonts)
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+
+    print()
+    for field, value in results['summary'].items():
+        print(f"  {field:22s} {value}")
+    print(f"Results written to {args.output}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results['summary'], json.load(f))
+
+
+if __name__ == '__main__':
+    main()
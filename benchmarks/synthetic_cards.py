@@ -0,0 +1,211 @@
+#!/usr/bin/env python3
+"""
+Synthetic medical card photos with known national register numbers.
+
+Each card carries a random, checksum-valid `YY.MM.DD-XXX.CC` national
+register number among filler text lines. It is rendered with a random font,
+then rotated, blurred, glared and JPEG-compressed, and pasted on a
+background at a random phone-photo resolution. Generation is deterministic
+for a given seed.
+"""
+import argparse
+import glob
+import io
+import json
+import os
+import random
+
+from PIL import Image, ImageDraw, ImageFilter, ImageFont
+
+FONT_GLOBS = (
+    '/usr/share/fonts/truetype/dejavu/*.ttf',
+    '/usr/share/fonts/truetype/liberation/*.ttf',
+    '/usr/share/fonts/truetype/freefont/*.ttf',
+    '/Library/Fonts/*.ttf',
+    'C:/Windows/Fonts/arial*.ttf',
+)
+
+# ID-1 card, 85.6 x 54 mm
+CARD_RATIO = 85.6 / 54.0
+
+SURNAMES = ('JANSSENS', 'PEETERS', 'MAES', 'JACOBS', 'MERTENS', 'WILLEMS', 'CLAES', 'GOOSSENS')
+FIRST_NAMES = ('Jan', 'Marie', 'Luc', 'Anna', 'Pieter', 'Sofie', 'Tom', 'Els')
+STREETS = ('Kerkstraat', 'Stationsstraat', 'Dorpstraat', 'Molenstraat', 'Schoolstraat')
+
+DIFFICULTY = {
+    # rotation degrees, blur radius, glare probability, JPEG quality range, photo width range
+    'easy': {'rotation': 2, 'blur': 0.4, 'glare': 0.0, 'quality': (85, 95), 'width': (1600, 2400)},
+    'medium': {'rotation': 6, 'blur': 1.2, 'glare': 0.3, 'quality': (60, 90), 'width': (1200, 4000)},
+    'hard': {'rotation': 12, 'blur': 2.5, 'glare': 0.6, 'quality': (35, 75), 'width': (900, 6000)},
+}
+
+
+def available_fonts():
+    fonts = []
+    for pattern in FONT_GLOBS:
+        fonts.extend(sorted(glob.glob(pattern)))
+    return fonts
+
+
+def load_font(path, size):
+    if path:
+        return ImageFont.truetype(path, size)
+    return ImageFont.load_default(size)
+
+
+def random_national_number(rng):
+    """
+    Checksum-valid 11-digit national register number with a real birth date
+    """
+    year = rng.randint(1930, 2020)
+    month = rng.randint(1, 12)
+    day = rng.randint(1, 28)
+    serial = rng.randint(1, 997)
+    base = f'{year % 100:02d}{month:02d}{day:02d}{serial:03d}'
+    check = 97 - int(('2' if year >= 2000 else '') + base) % 97
+    return base + f'{check:02d}'
+
+
+def format_national_number(digits):
+    return f'{digits[0:2]}.{digits[2:4]}.{digits[4:6]}-{digits[6:9]}.{digits[9:11]}'
+
+
+def render_card(rng, national_number, font_path, card_width):
+    """
+    Flat, upright card image with the number line among filler lines
+    """
+    card_height = int(card_width / CARD_RATIO)
+    shade = rng.randint(225, 255)
+    card = Image.new('RGB', (card_width, card_height), (shade, shade, rng.randint(215, 255)))
+    draw = ImageDraw.Draw(card)
+
+    margin = card_width // 16
+    text_size = card_height // 12
+    number_size = int(text_size * rng.uniform(1.1, 1.5))
+    small = load_font(font_path, text_size)
+    large = load_font(font_path, number_size)
+    ink = tuple(rng.randint(0, 60) for _ in range(3))
+
+    lines = [
+        (small, 'ZIEKENHUIS - PATIENTENKAART'),
+        (small, f'{rng.choice(SURNAMES)} {rng.choice(FIRST_NAMES)}'),
+        (large, format_national_number(national_number)),
+        (small, f'{rng.choice(STREETS)} {rng.randint(1, 200)}, {rng.randint(1000, 9999)}'),
+        (small, f'Geb. {national_number[4:6]}/{national_number[2:4]}/{national_number[0:2]}   M/V'),
+    ]
+    # Occasionally move the number line to the top or bottom of the card
+    number_line = lines.pop(2)
+    lines.insert(rng.choice((0, 2, 2, 2, len(lines))), number_line)
+
+    y = margin // 2
+    for font, text in lines:
+        draw.text((margin, y), text, fill=ink, font=font)
+        y += int(font.size * 1.6)
+
+    # Barcode strip
+    x = margin
+    bar_top = card_height - margin - text_size
+    while x < card_width - margin:
+        width = rng.choice((2, 3, 5))
+        draw.rectangle([x, bar_top, x + width, card_height - margin // 2], fill=ink)
+        x += width + rng.choice((2, 3, 4))
+
+    return card
+
+
+def add_glare(rng, image):
+    """
+    Soft overexposed ellipse, as from a phone flash on a laminated card
+    """
+    width, height = image.size
+    mask = Image.new('L', image.size, 0)
+    cx, cy = rng.randint(0, width), rng.randint(0, height)
+    rx, ry = rng.randint(width // 12, width // 5), rng.randint(height // 12, height // 5)
+    ImageDraw.Draw(mask).ellipse([cx - rx, cy - ry, cx + rx, cy + ry], fill=rng.randint(160, 255))
+    mask = mask.filter(ImageFilter.GaussianBlur(max(rx, ry) / 3))
+    return Image.composite(Image.new('RGB', image.size, (255, 255, 255)), image, mask)
+
+
+def generate_card(rng, difficulty='medium', fonts=None):
+    """
+    One synthetic card photo as (jpeg_bytes, expected_national_number, params)
+    """
+    spec = DIFFICULTY[difficulty]
+    fonts = available_fonts() if fonts is None else fonts
+    font_path = rng.choice(fonts) if fonts else None
+
+    national_number = random_national_number(rng)
+    photo_width = rng.randint(*spec['width'])
+    photo_height = int(photo_width * rng.choice((0.75, 0.5625, 1.333)))
+    card_width = int(min(photo_width, photo_height * CARD_RATIO) * rng.uniform(0.55, 0.85))
+
+    card = render_card(rng, national_number, font_path, card_width)
+    rotation = rng.uniform(-spec['rotation'], spec['rotation'])
+    card = card.convert('RGBA').rotate(rotation, resample=Image.BICUBIC, expand=True)
+
+    background = tuple(rng.randint(40, 160) for _ in range(3))
+    photo = Image.new('RGB', (photo_width, photo_height), background)
+    x = rng.randint(0, max(0, photo_width - card.width))
+    y = rng.randint(0, max(0, photo_height - card.height))
+    photo.paste(card, (x, y), card)
+
+    glare = rng.random() < spec['glare']
+    if glare:
+        photo = add_glare(rng, photo)
+
+    blur = rng.uniform(0, spec['blur'])
+    if blur > 0.1:
+        photo = photo.filter(ImageFilter.GaussianBlur(blur))
+
+    quality = rng.randint(*spec['quality'])
+    buffer = io.BytesIO()
+    photo.save(buffer, format='JPEG', quality=quality)
+
+    params = {
+        'national_number': national_number,
+        'font': os.path.basename(font_path) if font_path else 'default',
+        'size': [photo_width, photo_height],
+        'card_width': card_width,
+        'rotation': round(rotation, 2),
+        'blur': round(blur, 2),
+        'glare': glare,
+        'jpeg_quality': quality,
+    }
+    return buffer.getvalue(), national_number, params
+
+
+def generate_cards(count, seed=0, difficulty='medium', font_glob=None):
+    """
+    Yield `count` cards, deterministic for a given seed, rendered with the fonts
+    matching `font_glob` or else with every known local font
+    """
+    rng = random.Random(seed)
+    fonts = sorted(glob.glob(font_glob)) if font_glob else available_fonts()
+    for _ in range(count):
+        yield generate_card(rng, difficulty, fonts)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Write synthetic medical card photos to a directory')
+    parser.add_argument('output_dir')
+    parser.add_argument('--count', type=int, default=20)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--difficulty', choices=sorted(DIFFICULTY), default='medium')
+    parser.add_argument('--fonts', help='glob of font files to render the cards with')
+    args = parser.parse_args()
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    manifest = []
+    for i, (data, expected, params) in enumerate(generate_cards(args.count, args.seed, args.difficulty, args.fonts)):
+        name = f'card_{i:04d}.jpg'
+        with open(os.path.join(args.output_dir, name), 'wb') as f:
+            f.write(data)
+        manifest.append(dict(params, file=name, expected=expected))
+
+    with open(os.path.join(args.output_dir, 'manifest.json'), 'w') as f:
+        json.dump(manifest, f, indent=2)
+    print(f"Wrote {len(manifest)} cards to {args.output_dir}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,202 @@
+"""
+Card geometry: rectify the photographed card once per image, before any OCR.
+
+The card outline is found on a downscaled copy and the card is warped to a
+canonical ID-1 sized image, which removes rotation, perspective and the
+background around it. When no outline is visible (a close-up, or a card on a
+background of the same colour), the whole photo is deskewed instead, by the
+median angle of its text lines. Every preprocessing variant and the
+number-line crops then start from the same upright image.
+
+With OCR_CARD_NUMBER_FIELD set to the number's position on the card layout,
+as `x0,y0,x1,y1` fractions of the card, that field is cropped directly from
+the rectified card and read first.
+"""
+import os
+
+import cv2
+import numpy as np
+from PIL import Image
+
+from regions import crop_region, find_card_outline, is_text_region, text_line_mask
+
+OCR_RECTIFY = os.environ.get('OCR_RECTIFY', 'true').lower() in ('1', 'true', 'yes')
+
+# ID-1 card, 85.6 x 54 mm, warped to this width
+ID1_RATIO = 85.6 / 54.0
+CARD_WIDTH = int(os.environ.get('OCR_CARD_WIDTH', 1024))
+CARD_HEIGHT = int(round(CARD_WIDTH / ID1_RATIO))
+# Outlines whose side ratio is further than this from ID-1 are not the card
+CARD_RATIO_TOLERANCE = 0.25
+
+# Outline and skew detection run on a copy no wider than this
+GEOMETRY_DETECTION_WIDTH = 800
+
+# Skew below this is left alone; above the maximum it is not a tilted text line
+DESKEW_MIN_ANGLE = 0.5
+DESKEW_MAX_ANGLE = 30.0
+
+
+def parse_field(value):
+    """
+    (x0, y0, x1, y1) card fractions from "x0,y0,x1,y1", or None when unset or malformed
+    """
+    if not value:
+        return None
+    try:
+        x0, y0, x1, y1 = (float(v) for v in value.split(','))
+    except ValueError:
+        print(f"Ignoring malformed OCR_CARD_NUMBER_FIELD: {value!r}")
+        return None
+    if not (0 <= x0 < x1 <= 1 and 0 <= y0 < y1 <= 1):
+        print(f"Ignoring OCR_CARD_NUMBER_FIELD outside the card: {value!r}")
+        return None
+    return x0, y0, x1, y1
+
+
+OCR_CARD_NUMBER_FIELD = parse_field(os.environ.get('OCR_CARD_NUMBER_FIELD'))
+
+
+class CardGeometry:
+    """
+    Upright image of one photo: the warped card when `card_found`, otherwise
+    the photo rotated by `skew_angle` degrees
+    """
+
+    def __init__(self, image, card_found=False, skew_angle=0.0, corners=None):
+        self.image = image
+        self.card_found = card_found
+        self.skew_angle = skew_angle
+        self.corners = corners
+
+    def field_crop(self, field=None):
+        """
+        (box, crop) of the configured number field on the rectified card, or None
+        """
+        field = field or OCR_CARD_NUMBER_FIELD
+        if field is None or not self.card_found:
+            return None
+        height, width = self.image.shape[:2]
+        x0, y0, x1, y1 = field
+        box = (int(x0 * width), int(y0 * height), int((x1 - x0) * width), int((y1 - y0) * height))
+        return box, crop_region(self.image, box)
+
+    def to_dict(self):
+        info = {'card_found': self.card_found, 'skew_angle': round(self.skew_angle, 2)}
+        if self.corners is not None:
+            info['corners'] = [[round(float(x)), round(float(y))] for x, y in self.corners]
+        return info
+
+
+def _detection_copy(gray_array):
+    height, width = gray_array.shape[:2]
+    scale = min(1.0, GEOMETRY_DETECTION_WIDTH / float(width))
+    if scale == 1.0:
+        return gray_array, scale
+    return cv2.resize(gray_array, (int(width * scale), int(height * scale)), interpolation=cv2.INTER_AREA), scale
+
+
+def order_corners(corners):
+    """
+    Corners as top-left, top-right, bottom-right, bottom-left, with the long side horizontal
+    """
+    by_angle = sorted(corners, key=lambda p: np.arctan2(p[1] - corners[:, 1].mean(), p[0] - corners[:, 0].mean()))
+    # Clockwise in image coordinates, starting at the corner nearest the origin
+    start = int(np.argmin([p[0] + p[1] for p in by_angle]))
+    ordered = np.array(by_angle[start:] + by_angle[:start], np.float32)
+
+    top, left = np.linalg.norm(ordered[1] - ordered[0]), np.linalg.norm(ordered[3] - ordered[0])
+    if left > top:
+        # Card photographed in portrait: start from the bottom-left so the long side ends up on top
+        ordered = np.roll(ordered, 1, axis=0)
+    return ordered
+
+
+def find_card(gray_array):
+    """
+    Ordered full-resolution corners of the card, or None
+    """
+    small, scale = _detection_copy(gray_array)
+    outline = find_card_outline(small)
+    if outline is None:
+        return None
+
+    corners = order_corners(outline / scale)
+    width = (np.linalg.norm(corners[1] - corners[0]) + np.linalg.norm(corners[2] - corners[3])) / 2
+    height = (np.linalg.norm(corners[3] - corners[0]) + np.linalg.norm(corners[2] - corners[1])) / 2
+    if height == 0 or abs(width / height / ID1_RATIO - 1) > CARD_RATIO_TOLERANCE:
+        return None
+    return corners
+
+
+def warp_card(gray_array, corners):
+    target = np.array([[0, 0], [CARD_WIDTH - 1, 0], [CARD_WIDTH - 1, CARD_HEIGHT - 1], [0, CARD_HEIGHT - 1]],
+                      np.float32)
+    matrix = cv2.getPerspectiveTransform(corners, target)
+    return cv2.warpPerspective(gray_array, matrix, (CARD_WIDTH, CARD_HEIGHT),
+                               flags=cv2.INTER_AREA, borderMode=cv2.BORDER_REPLICATE)
+
+
+def estimate_skew(gray_array):
+    """
+    Median angle in degrees of the text lines, weighted by their length; positive
+    when lines rise to the right
+    """
+    small, _ = _detection_copy(gray_array)
+    _, lines = text_line_mask(small)
+    contours, _ = cv2.findContours(lines, cv2.RETR_LIST, cv2.CHAIN_APPROX_SIMPLE)
+
+    angles, weights = [], []
+    for contour in contours:
+        (_, _), (w, h), _ = rect = cv2.minAreaRect(contour)
+        length, thickness = max(w, h), min(w, h)
+        if not is_text_region(length, thickness):
+            continue
+        # Direction of the long side of the rotated box
+        points = cv2.boxPoints(rect)
+        edges = [points[1] - points[0], points[2] - points[1]]
+        dx, dy = max(edges, key=np.linalg.norm)
+        angle = np.degrees(np.arctan2(-dy, dx))
+        angle = (angle + 90) % 180 - 90
+        if abs(angle) <= DESKEW_MAX_ANGLE:
+            angles.append(angle)
+            weights.append(length)
+
+    if not angles:
+        return 0.0
+    order = np.argsort(angles)
+    cumulative = np.cumsum(np.array(weights)[order])
+    return float(np.array(angles)[order][np.searchsorted(cumulative, cumulative[-1] / 2)])
+
+
+def deskew(gray_array, angle):
+    height, width = gray_array.shape[:2]
+    matrix = cv2.getRotationMatrix2D((width / 2.0, height / 2.0), -angle, 1.0)
+    return cv2.warpAffine(gray_array, matrix, (width, height), flags=cv2.INTER_LINEAR,
+                          borderMode=cv2.BORDER_REPLICATE)
+
+
+def rectify(gray_array):
+    """
+    CardGeometry of a grayscale photo (uint8 array): the card warped to
+    CARD_WIDTH x CARD_HEIGHT when its outline is found, then deskewed
+    """
+    corners = find_card(gray_array)
+    image = warp_card(gray_array, corners) if corners is not None else gray_array
+
+    angle = estimate_skew(image)
+    if abs(angle) >= DESKEW_MIN_ANGLE:
+        image = deskew(image, angle)
+    else:
+        angle = 0.0
+    return CardGeometry(image, corners is not None, angle, corners)
+
+
+def rectify_image(gray_image):
+    """
+    rectify() for a PIL image; returns (upright PIL image, CardGeometry)
+    """
+    geometry = rectify(np.asarray(gray_image))
+    if not geometry.card_found and not geometry.skew_angle:
+        return gray_image, geometry
+    return Image.fromarray(geometry.image), geometry
@@ -0,0 +1,202 @@
+"""
+CPU budget of the service and how it is split between processes and threads.
+
+The number of usable cores comes from the container's cgroup CPU quota (v2
+`cpu.max` or v1 `cpu.cfs_quota_us`) and the process's CPU affinity, not from
+os.cpu_count(), which reports the host's cores. A profile turns it into
+gunicorn workers and threads, OCR slots per worker, and the thread counts of
+OpenCV and Tesseract's OpenMP:
+
+- latency (default): few workers, and each image OCRs its variants in
+  parallel on all the worker's cores
+- throughput: one single-threaded worker per core, each image OCR'd sequentially
+
+Every value can still be overridden by its own environment variable. Each
+worker holds OCR work to its slot count with a semaphore, and the time an
+image waits for a slot is reported apart from the time it is processed.
+"""
+import math
+import os
+import threading
+from contextlib import contextmanager
+
+from metrics import metrics
+
+OCR_PROFILE = os.environ.get('OCR_PROFILE', 'latency').lower()
+
+CGROUP_V2_CPU_MAX = '/sys/fs/cgroup/cpu.max'
+CGROUP_V1_DIRS = ('/sys/fs/cgroup/cpu', '/sys/fs/cgroup/cpu,cpuacct')
+
+
+def _read(path):
+    try:
+        with open(path) as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+
+def cgroup_cpu_limit():
+    """
+    CPU quota of this container in cores (may be fractional), or None when unlimited
+    """
+    value = _read(CGROUP_V2_CPU_MAX)
+    if value:
+        quota, _, period = value.partition(' ')
+        if quota != 'max' and period:
+            return int(quota) / float(period)
+        return None
+
+    for directory in CGROUP_V1_DIRS:
+        quota = _read(os.path.join(directory, 'cpu.cfs_quota_us'))
+        period = _read(os.path.join(directory, 'cpu.cfs_period_us'))
+        if quota and period and int(quota) > 0:
+            return int(quota) / float(period)
+    return None
+
+
+def available_cpus():
+    """
+    Whole cores this process may use: OCR_CPUS, else the cgroup quota capped by the CPU affinity
+    """
+    if os.environ.get('OCR_CPUS'):
+        return max(1, int(os.environ['OCR_CPUS']))
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cpus = os.cpu_count() or 1
+    limit = cgroup_cpu_limit()
+    if limit is not None:
+        # A fractional quota still allows one busy thread per started core
+        cpus = min(cpus, math.ceil(limit))
+    return max(1, cpus)
+
+
+def plan(cpus, profile, workers=None):
+    """
+    Process and thread counts for `cpus` cores under a profile; `workers` fixes the worker count
+    """
+    if profile == 'throughput':
+        return {
+            'workers': workers or cpus,
+            'threads': 2,
+            'ocr_slots': 1,
+            'concurrent': False,
+            'request_parallelism': 1,
+            'cv2_threads': 1,
+            'omp_threads': 1,
+        }
+    if profile != 'latency':
+        print(f"Unknown OCR_PROFILE {profile!r}, using latency")
+    workers = workers or (1 if cpus <= 2 else 2)
+    slots = max(1, cpus // workers)
+    return {
+        'workers': workers,
+        'threads': 4,
+        'ocr_slots': slots,
+        'concurrent': True,
+        'request_parallelism': slots,
+        'cv2_threads': slots,
+        # Tesseract's own OpenMP threads are slower than running more images at once
+        'omp_threads': 1,
+    }
+
+
+def _env_int(name, default):
+    return max(1, int(os.environ.get(name, default)))
+
+
+CPUS = available_cpus()
+_plan = plan(CPUS, OCR_PROFILE, _env_int('GUNICORN_WORKERS', 1) if os.environ.get('GUNICORN_WORKERS') else None)
+GUNICORN_WORKERS = _plan['workers']
+GUNICORN_THREADS = _env_int('GUNICORN_THREADS', _plan['threads'])
+# OCR work running at once in one worker: images holding a slot, and threads of the shared OCR executor
+OCR_CPU_BUDGET = _env_int('OCR_CPU_BUDGET', _plan['ocr_slots'])
+OCR_CONCURRENT = os.environ.get('OCR_CONCURRENT', str(_plan['concurrent'])).lower() in ('1', 'true', 'yes')
+OCR_REQUEST_PARALLELISM = _env_int('OCR_REQUEST_PARALLELISM', min(OCR_CPU_BUDGET, _plan['request_parallelism']))
+OCR_CV2_THREADS = _env_int('OCR_CV2_THREADS', min(OCR_CPU_BUDGET, _plan['cv2_threads']))
+OMP_THREAD_LIMIT = _env_int('OMP_THREAD_LIMIT', _plan['omp_threads'])
+
+
+def apply_thread_limits():
+    """
+    Set the OpenMP and OpenCV thread counts for this process. OMP_THREAD_LIMIT
+    must be in the environment before Tesseract is loaded.
+    """
+    os.environ['OMP_THREAD_LIMIT'] = str(OMP_THREAD_LIMIT)
+    import cv2
+    cv2.setNumThreads(OCR_CV2_THREADS)
+
+
+def settings():
+    return {
+        'profile': OCR_PROFILE,
+        'cpus': CPUS,
+        'cgroup_cpu_limit': cgroup_cpu_limit(),
+        'workers': GUNICORN_WORKERS,
+        'threads': GUNICORN_THREADS,
+        'ocr_slots': OCR_CPU_BUDGET,
+        'concurrent': OCR_CONCURRENT,
+        'request_parallelism': OCR_REQUEST_PARALLELISM,
+        'cv2_threads': OCR_CV2_THREADS,
+        'omp_thread_limit': OMP_THREAD_LIMIT,
+    }
+
+
+class OcrSlots:
+    """
+    Per-process semaphore admitting at most `slots` images into OCR at once
+    """
+
+    def __init__(self, slots=OCR_CPU_BUDGET):
+        self.slots = slots
+        self._lock = threading.Lock()
+        self._pid = None
+        self._semaphore = None
+        self._waiting = 0
+        self._busy = 0
+
+    def _ensure_process(self):
+        # A semaphore held in the master at fork time would stay held in the worker
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid != os.getpid():
+                self._semaphore = threading.BoundedSemaphore(self.slots)
+                self._waiting = self._busy = 0
+                self._pid = os.getpid()
+
+    @contextmanager
+    def hold(self):
+        """
+        Wait for a slot (timed as the 'queue' stage), then time the block as processing
+        """
+        self._ensure_process()
+        with self._lock:
+            self._waiting += 1
+        try:
+            with metrics.timed('ocr_queue_seconds'):
+                self._semaphore.acquire()
+        finally:
+            with self._lock:
+                self._waiting -= 1
+        with self._lock:
+            self._busy += 1
+        try:
+            with metrics.timed('ocr_processing_seconds'):
+                yield
+        finally:
+            with self._lock:
+                self._busy -= 1
+            self._semaphore.release()
+
+    def stats(self):
+        current = self._pid == os.getpid()
+        return {
+            'slots': self.slots,
+            'busy': self._busy if current else 0,
+            'waiting': self._waiting if current else 0,
+        }
+
+
+ocr_slots = OcrSlots()
@@ -1,83 +1,68 @@
 #!/usr/bin/env python3
-import pytesseract
-from PIL import Image, ImageEnhance
-import cv2
-import numpy as np
 import re
+import sys
+
+import numpy as np
+
+from card_geometry import rectify_image
+from image_decode import decode_grayscale
+from ocr_engine import engine_pool
+from pipeline import PREPROCESSORS, ocr_attempt, recognize_gray, run_roi_ocr
+
+DEFAULT_IMAGE = "/home/ubuntu/attachments/a8e442a5-3e0b-41b0-b2bc-d29c253dbda0/IMG_4547.jpeg"
+
+def debug_preprocessing_methods(image_path=DEFAULT_IMAGE):
+    """Debug each preprocessing method of the pipeline individually"""
 
-def debug_preprocessing_methods():
-    """Debug each preprocessing method individually"""
-    
-    image_path = "/home/ubuntu/attachments/a8e442a5-3e0b-41b0-b2bc-d29c253dbda0/IMG_4547.jpeg"
-    
     print(f"Loading medical card image: {image_path}")
-    image = Image.open(image_path)
-    
-    # Convert to grayscale
-    if image.mode != 'L':
-        gray_image = image.convert('L')
-    else:
-        gray_image = image
-    
+    # Same decode as the service: EXIF-upright, grayscale, size-capped
+    with open(image_path, 'rb') as f:
+        gray_image, decode_info = decode_grayscale(f)
+    print(f"Decoded {decode_info['original_size']} -> {decode_info['decoded_size']} ({decode_info['format']})")
+
+    # The pipeline rectifies the card once and runs every variant on the result
+    original_image = gray_image
+    gray_image, geometry = rectify_image(gray_image)
+    print(f"Card geometry: {geometry.to_dict()}")
     gray_array = np.array(gray_image)
-    
+
     print("\nTesting each preprocessing method with different OCR configs:")
     print("=" * 70)
-    
-    configs = [
-        r'--oem 3 --psm 8',  # Single word
-        r'--oem 3 --psm 6',  # Default configuration
-        r'--oem 3 --psm 7',  # Single text line
-        r'--oem 3 --psm 11', # Sparse text
+
+    psms = [
+        8,   # Single word
+        6,   # Default configuration
+        7,   # Single text line
+        11,  # Sparse text
     ]
-    
-    print("\n1. OTSU + Median Blur Method:")
-    _, thresh_otsu = cv2.threshold(gray_array, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
-    processed_otsu = cv2.medianBlur(thresh_otsu, 3)
-    otsu_img = Image.fromarray(processed_otsu)
-    
-    for config in configs:
-        try:
-            text = pytesseract.image_to_string(otsu_img, config=config).strip()
-            has_digits = bool(re.search(r'\d', text))
-            print(f"  Config {config}: has_digits={has_digits}, text='{text[:50]}{'...' if len(text) > 50 else ''}'")
-        except Exception as e:
-            print(f"  Config {config}: ERROR - {e}")
-    
-    print("\n2. Enhanced Contrast + OTSU Method:")
-    enhanced_contrast = np.array(ImageEnhance.Contrast(gray_image).enhance(2.0))
-    _, thresh_enhanced = cv2.threshold(enhanced_contrast, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
-    denoised_enhanced = cv2.medianBlur(thresh_enhanced, 3)
-    enhanced_img = Image.fromarray(denoised_enhanced)
-    
-    for config in configs:
-        try:
-            text = pytesseract.image_to_string(enhanced_img, config=config).strip()
-            has_digits = bool(re.search(r'\d', text))
-            print(f"  Config {config}: has_digits={has_digits}, text='{text[:50]}{'...' if len(text) > 50 else ''}'")
-        except Exception as e:
-            print(f"  Config {config}: ERROR - {e}")
-    
-    print("\n3. Adaptive Thresholding Method:")
-    adaptive_thresh = cv2.adaptiveThreshold(gray_array, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C, cv2.THRESH_BINARY, 11, 2)
-    adaptive_img = Image.fromarray(adaptive_thresh)
-    
-    for config in configs:
-        try:
-            text = pytesseract.image_to_string(adaptive_img, config=config).strip()
-            has_digits = bool(re.search(r'\d', text))
-            print(f"  Config {config}: has_digits={has_digits}, text='{text[:50]}{'...' if len(text) > 50 else ''}'")
-        except Exception as e:
-            print(f"  Config {config}: ERROR - {e}")
-    
-    print("\n4. Original Grayscale Method:")
-    for config in configs:
+
+    for number, name in enumerate(PREPROCESSORS, 1):
+        print(f"\n{number}. {name} method:")
+        processed = PREPROCESSORS[name](gray_image, gray_array)
+
+        for psm in psms:
+            try:
+                text = engine_pool.image_to_string(processed, psm=psm).strip()
+                has_digits = bool(re.search(r'\d', text))
+                print(f"  --psm {psm}: has_digits={has_digits}, text='{text[:50]}{'...' if len(text) > 50 else ''}'")
+            except Exception as e:
+                print(f"  --psm {psm}: ERROR - {e}")
+
         try:
-            text = pytesseract.image_to_string(gray_image, config=config).strip()
-            has_digits = bool(re.search(r'\d', text))
-            print(f"  Config {config}: has_digits={has_digits}, text='{text[:50]}{'...' if len(text) > 50 else ''}'")
+            text, confidence = ocr_attempt(processed)
+            print(f"  word_level (as served): confidence={confidence:.2f}, text='{text[:50]}'")
         except Exception as e:
-            print(f"  Config {config}: ERROR - {e}")
+            print(f"  word_level (as served): ERROR - {e}")
+
+    print("\nNumber-line crops (roi):")
+    try:
+        text, best_result = run_roi_ocr(gray_array)
+        print(f"  text='{text[:50]}', candidate={best_result[2] if best_result else None}")
+    except Exception as e:
+        print(f"  ERROR - {e}")
+
+    print("\nFull pipeline result:")
+    print(f"  {recognize_gray(original_image, concurrent=False)}")
 
 if __name__ == "__main__":
-    debug_preprocessing_methods()
+    debug_preprocessing_methods(*sys.argv[1:2])
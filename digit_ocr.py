@@ -0,0 +1,247 @@
+"""
+Tesseract-free recognizer for the printed patient number line.
+
+Glyphs are segmented from contours of a binarised line crop. Tall glyphs are
+digits, classified by normalised correlation of their bitmap against digit
+templates in one matrix product. Short glyphs sitting on the baseline are
+".", and flat glyphs at mid-height are "-". On a clean crop this takes a few
+milliseconds. It is used when Tesseract is missing or fails, and as a fast
+path that is tried before it.
+
+Templates come from digit_templates.npz, which ships with the service so the
+result does not depend on the fonts installed on the host. Run
+`python digit_ocr.py --build-templates` to regenerate it from the local fonts.
+"""
+import glob
+import os
+import sys
+
+import cv2
+import numpy as np
+from PIL import Image, ImageDraw, ImageFont
+
+TEMPLATE_PATH = os.environ.get('OCR_DIGIT_TEMPLATES',
+                               os.path.join(os.path.dirname(os.path.abspath(__file__)), 'digit_templates.npz'))
+FONT_GLOBS = (
+    '/usr/share/fonts/truetype/dejavu/*.ttf',
+    '/usr/share/fonts/truetype/liberation*/*.ttf',
+    '/usr/share/fonts/truetype/freefont/*.ttf',
+    '/usr/share/fonts/truetype/noto/NotoSans*-Regular.ttf',
+)
+
+# Normalised glyph bitmap size (width, height)
+GLYPH_SIZE = (16, 24)
+CLASSES = '0123456789'
+
+# Glyph geometry, relative to the median digit height of the line
+DIGIT_MIN_HEIGHT = 0.6
+DOT_MAX_HEIGHT = 0.35
+DASH_MAX_HEIGHT = 0.3
+NOISE_MAX_HEIGHT = 0.1
+# Tall glyphs narrower than this (barcode bars, card edges) are not digits
+DIGIT_MIN_ASPECT = 0.12
+# Digits matching no template at least this well are read as "?", so they break up digit runs
+DIGIT_MIN_SCORE = 0.6
+# Horizontal gap, in digit heights, read as a space between groups
+SPACE_GAP = 0.9
+
+
+def glyph_canvas(bitmap):
+    """
+    Binary glyph (glyph = 255, tightly cropped) scaled into a GLYPH_SIZE canvas,
+    keeping its aspect ratio so a narrow "1" stays narrow
+    """
+    height, width = bitmap.shape
+    target_w, target_h = GLYPH_SIZE
+    scale = min(target_h / float(height), target_w / float(width))
+    new_w, new_h = max(1, int(round(width * scale))), max(1, int(round(height * scale)))
+    resized = cv2.resize(bitmap, (new_w, new_h), interpolation=cv2.INTER_AREA)
+
+    canvas = np.zeros((target_h, target_w), np.uint8)
+    x, y = (target_w - new_w) // 2, (target_h - new_h) // 2
+    canvas[y:y + new_h, x:x + new_w] = resized
+    return canvas
+
+
+def glyph_vectors(canvases):
+    """
+    Zero-mean, unit-norm rows for a stack of glyph canvases
+    """
+    # A little blur makes the correlation tolerant to one-pixel shifts and stroke width
+    blurred = np.stack([cv2.GaussianBlur(c, (3, 3), 0) for c in canvases]).astype(np.float32)
+    vectors = blurred.reshape(len(canvases), -1)
+    vectors -= vectors.mean(axis=1, keepdims=True)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-6)
+
+
+def _render_glyph(font, char):
+    image = Image.new('L', (font.size * 2, font.size * 2), 0)
+    ImageDraw.Draw(image).text((font.size // 2, font.size // 4), char, fill=255, font=font)
+    bitmap = (np.asarray(image) > 127).astype(np.uint8) * 255
+    ys, xs = np.nonzero(bitmap)
+    return bitmap[ys.min():ys.max() + 1, xs.min():xs.max() + 1]
+
+
+def render_templates():
+    """
+    Template canvases and labels for every digit in every local font,
+    plain and with thinner and bolder strokes
+    """
+    fonts = [path for pattern in FONT_GLOBS for path in sorted(glob.glob(pattern))]
+    faces = [ImageFont.truetype(path, 64) for path in fonts] or [ImageFont.load_default(64)]
+    kernel = np.ones((3, 3), np.uint8)
+
+    canvases, labels = [], []
+    for font in faces:
+        for char in CLASSES:
+            glyph = cv2.copyMakeBorder(_render_glyph(font, char), 2, 2, 2, 2, cv2.BORDER_CONSTANT, value=0)
+            for variant in (glyph, cv2.erode(glyph, kernel), cv2.dilate(glyph, kernel)):
+                ys, xs = np.nonzero(variant)
+                canvases.append(glyph_canvas(variant[ys.min():ys.max() + 1, xs.min():xs.max() + 1]))
+                labels.append(char)
+    return np.array(canvases, np.uint8), np.array(labels)
+
+
+def load_templates(path=TEMPLATE_PATH):
+    """
+    (template matrix, labels), one normalised row per template.
+    Falls back to rendering from local fonts if the bundled file is missing.
+    """
+    try:
+        with np.load(path) as data:
+            canvases, labels = data['canvases'], data['labels']
+    except (OSError, KeyError, ValueError) as e:
+        print(f"Digit templates unavailable ({e}), rendering from local fonts")
+        canvases, labels = render_templates()
+    return glyph_vectors(canvases), labels.astype(str)
+
+
+TEMPLATES, TEMPLATE_LABELS = load_templates()
+# Class index of every template row
+_TEMPLATE_CLASS = np.array([CLASSES.index(label) for label in TEMPLATE_LABELS])
+
+
+def binarize(gray_array):
+    """
+    Otsu binarisation with glyphs white, whatever the print polarity
+    """
+    _, binary = cv2.threshold(gray_array, 0, 255, cv2.THRESH_BINARY_INV + cv2.THRESH_OTSU)
+    if np.count_nonzero(binary) > binary.size // 2:
+        binary = cv2.bitwise_not(binary)
+    return binary
+
+
+def segment_glyphs(binary):
+    """
+    Glyph boxes (x, y, w, h) of the main text line in a line crop, left to right.
+    Pieces of one broken glyph stacked above each other are merged.
+    """
+    contours, _ = cv2.findContours(binary, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    boxes = [cv2.boundingRect(c) for c in contours]
+    if not boxes:
+        return []
+
+    # Keep the band around the crop's vertical centre, where the ROI stage put the line
+    height = binary.shape[0]
+    boxes = [b for b in boxes if b[1] < height * 0.75 and b[1] + b[3] > height * 0.25]
+
+    boxes.sort()
+    merged = []
+    for x, y, w, h in boxes:
+        if merged:
+            px, py, pw, ph = merged[-1]
+            overlap = min(px + pw, x + w) - max(px, x)
+            if overlap > 0.6 * min(pw, w):
+                x0, y0 = min(px, x), min(py, y)
+                merged[-1] = (x0, y0, max(px + pw, x + w) - x0, max(py + ph, y + h) - y0)
+                continue
+        merged.append((x, y, w, h))
+    return merged
+
+
+def classify_digits(binary, boxes):
+    """
+    (digit, score) per box by best template correlation; score is in [0, 1]
+    """
+    canvases = [glyph_canvas(binary[y:y + h, x:x + w]) for x, y, w, h in boxes]
+    scores = glyph_vectors(canvases) @ TEMPLATES.T
+
+    # Best template per class, then the best class
+    per_class = np.full((len(boxes), len(CLASSES)), -1.0, np.float32)
+    np.maximum.at(per_class.T, _TEMPLATE_CLASS, scores.T)
+    best = per_class.argmax(axis=1)
+    return [(CLASSES[i], float(max(0.0, per_class[row, i]))) for row, i in enumerate(best)]
+
+
+def read_line(gray_array):
+    """
+    Text of one line crop as digits, "." and "-", with spaces at wide gaps,
+    and the mean digit score (0-1). Returns ("", 0.0) when no digits are found.
+    """
+    binary = binarize(gray_array)
+    boxes = segment_glyphs(binary)
+    if not boxes:
+        return "", 0.0
+
+    digit_height = float(np.median([h for _, _, _, h in boxes if h >= 0.5 * max(b[3] for b in boxes)]))
+    tall = [(x + w / 2.0, y + h) for x, y, w, h in boxes if h >= DIGIT_MIN_HEIGHT * digit_height]
+    # Baseline through the digit bottoms; a straight fit follows a slightly tilted line
+    if len(tall) >= 3:
+        slope, intercept = np.polyfit([c for c, _ in tall], [b for _, b in tall], 1)
+    else:
+        slope, intercept = 0.0, float(np.median([b for _, b in tall]))
+
+    glyphs = []
+    digit_boxes = []
+    for box in boxes:
+        x, y, w, h = box
+        baseline = slope * (x + w / 2.0) + intercept
+        if h >= DIGIT_MIN_HEIGHT * digit_height:
+            if w < DIGIT_MIN_ASPECT * h:
+                continue
+            glyphs.append([x, w, None])
+            digit_boxes.append((len(glyphs) - 1, box))
+        elif h < NOISE_MAX_HEIGHT * digit_height:
+            continue
+        elif (h <= DOT_MAX_HEIGHT * digit_height and w <= 1.5 * h
+              and abs(y + h - baseline) <= 0.2 * digit_height):
+            glyphs.append([x, w, '.'])
+        elif (h <= DASH_MAX_HEIGHT * digit_height and w >= 1.2 * h
+              and abs(y + h / 2.0 - (baseline - digit_height / 2.0)) <= 0.25 * digit_height):
+            glyphs.append([x, w, '-'])
+
+    if not digit_boxes:
+        return "", 0.0
+
+    results = classify_digits(binary, [box for _, box in digit_boxes])
+    for (index, _), (digit, score) in zip(digit_boxes, results):
+        glyphs[index][2] = digit if score >= DIGIT_MIN_SCORE else '?'
+
+    text = []
+    previous_end = None
+    for x, w, char in glyphs:
+        if previous_end is not None and x - previous_end > SPACE_GAP * digit_height:
+            text.append(' ')
+        text.append(char)
+        previous_end = x + w
+
+    return ''.join(text), sum(score for _, score in results) / len(results)
+
+
+def build_template_file(path=TEMPLATE_PATH):
+    canvases, labels = render_templates()
+    np.savez_compressed(path, canvases=canvases, labels=labels)
+    print(f"Wrote {len(labels)} digit templates to {path}")
+
+
+if __name__ == '__main__':
+    if '--build-templates' in sys.argv[1:]:
+        build_template_file()
+    else:
+        # Read the number line of each image given on the command line
+        from regions import number_region_crops
+        for image_path in sys.argv[1:]:
+            gray = np.array(Image.open(image_path).convert('L'))
+            for box, crop in number_region_crops(gray):
+                print(image_path, box, read_line(np.array(crop)))
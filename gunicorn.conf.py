@@ -1,8 +1,11 @@
 import os
 
+# Worker and thread counts follow the container's CPU quota and OCR_PROFILE (see concurrency.py)
+from concurrency import GUNICORN_THREADS, GUNICORN_WORKERS
+
 bind = f"0.0.0.0:{os.environ.get('PORT', 10000)}"
-workers = 2
-threads = 4
+workers = GUNICORN_WORKERS
+threads = GUNICORN_THREADS
 worker_class = "sync"
 worker_tmp_dir = "/dev/shm"
 log_level = "info"
@@ -14,3 +17,28 @@ max_requests = 1000
 max_requests_jitter = 50
 preload_app = True
 
+
+
+def on_starting(server):
+    # Worker metric files from a previous run would otherwise be merged into /metrics
+    from metrics import metrics
+    metrics.reset()
+
+
+def when_ready(server):
+    # Master, sockets bound, no workers yet: warm up here so every forked worker starts warm
+    import startup
+    if server.cfg.preload_app and startup.OCR_WARMUP:
+        startup.warmup()
+
+
+def post_worker_init(worker):
+    # Without preload_app the worker imported the app itself and warms up in the background
+    import startup
+    startup.ensure_warm()
+
+
+def child_exit(server, worker):
+    # Merge the exited worker's metrics into the archive file
+    from metrics import metrics
+    metrics.archive(worker.pid)
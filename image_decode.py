@@ -0,0 +1,87 @@
+"""
+Memory-capped image decoding straight to grayscale.
+
+The header is read first so oversized uploads are rejected before any pixel
+buffer exists. JPEGs are decoded with libjpeg's DCT-domain scaling (1/2, 1/4
+or 1/8) directly into a single luminance channel, so a 12-48 MP phone photo
+never materialises at full resolution or in RGB. Other formats (PNG, TIFF,
+WebP) cannot be scaled while decoding and are decoded in full, so they are held
+to a much lower pixel limit.
+"""
+import os
+import resource
+import sys
+from io import BytesIO
+
+from PIL import Image, ImageOps
+
+# Uploads above this many pixels are refused outright; below PIL's own decompression-bomb limit,
+# which stays in place as a second line of defence
+MAX_PIXELS = int(os.environ.get('OCR_MAX_PIXELS', 64_000_000))
+# Larger images are downscaled to about this many pixels while decoding.
+# 4 MP keeps the patient number of a card photographed at arm's length well above 20 px tall.
+DECODE_PIXELS = int(os.environ.get('OCR_DECODE_PIXELS', 4_000_000))
+# Limit for formats without draft decoding, which exist at full size in RGB(A) before the
+# grayscale conversion: 16 MP is up to 64 MB per image at its peak
+MAX_UNDRAFTED_PIXELS = int(os.environ.get('OCR_MAX_UNDRAFTED_PIXELS', 4 * DECODE_PIXELS))
+
+
+class ImageTooLarge(ValueError):
+    """Raised when an upload exceeds OCR_MAX_PIXELS"""
+
+
+def decode_grayscale(source, max_pixels=MAX_PIXELS, decode_pixels=DECODE_PIXELS,
+                     max_undrafted_pixels=MAX_UNDRAFTED_PIXELS):
+    """
+    Decode bytes or a binary file object to an upright 'L' image of at most
+    about `decode_pixels` pixels. Returns (image, info).
+    """
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        source = BytesIO(source)
+
+    try:
+        image = Image.open(source)
+    except Image.DecompressionBombError as e:
+        raise ImageTooLarge(str(e))
+    source_format = image.format
+    width, height = image.size
+    if width * height > max_pixels:
+        raise ImageTooLarge(f"Image is {width}x{height} ({width * height} pixels), limit is {max_pixels}")
+    if source_format != 'JPEG' and width * height > max_undrafted_pixels:
+        raise ImageTooLarge(f"{source_format} image is {width}x{height} ({width * height} pixels), "
+                            f"limit for formats other than JPEG is {max_undrafted_pixels}")
+
+    scale = min(1.0, (decode_pixels / float(width * height)) ** 0.5)
+    target = (max(1, int(width * scale)), max(1, int(height * scale)))
+
+    # JPEG: pick the DCT scale and decode to luminance only; no-op for other formats
+    if source_format == 'JPEG':
+        image.draft('L', target)
+
+    image = ImageOps.exif_transpose(image)
+    if image.mode != 'L':
+        image = image.convert('L')
+
+    # exif_transpose may have swapped the axes
+    if image.width * image.height > decode_pixels:
+        if (image.width > image.height) != (target[0] > target[1]):
+            target = (target[1], target[0])
+        image = image.resize(target, Image.BILINEAR, reducing_gap=2.0)
+
+    info = {
+        'original_size': [width, height],
+        'decoded_size': list(image.size),
+        'format': source_format,
+    }
+    return image, info
+
+
+def peak_rss_mb():
+    """
+    High-water mark of this process's resident set size, in MB
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    if sys.platform == 'darwin':
+        peak /= 1024
+    return round(peak / 1024.0, 1)
@@ -0,0 +1,270 @@
+"""
+Asynchronous OCR jobs behind a bounded queue.
+
+Each gunicorn worker runs a small pool of dedicated OCR threads fed by a
+bounded in-process queue. Job state and results are kept in a SQLite file on
+/dev/shm, so a job submitted to one worker can be polled through any other.
+When the local queue is full, submission fails fast so the endpoint can shed
+load with 429 instead of accepting work it cannot finish in time.
+
+The queue itself lives in the worker's memory, so jobs record the pid of the
+worker that owns them. When that worker exits (gunicorn recycles workers
+after max_requests and on every deploy) its unfinished jobs are marked
+failed: on a clean exit by the worker itself, otherwise by the next request
+that finds the owning process gone.
+"""
+import atexit
+import json
+import math
+import os
+import queue
+import sqlite3
+import threading
+import time
+import uuid
+
+from shm_db import connect, shared_dir
+
+JOBS_PATH = os.environ.get('OCR_JOBS_PATH', os.path.join(shared_dir(), 'ocr-jobs.sqlite'))
+JOB_QUEUE_SIZE = int(os.environ.get('OCR_JOB_QUEUE_SIZE', 16))
+JOB_RESULT_TTL = float(os.environ.get('OCR_JOB_RESULT_TTL', 600))
+# Wait statistics on /api/status cover jobs started within this window
+JOB_STATS_WINDOW = float(os.environ.get('OCR_JOB_STATS_WINDOW', 300))
+
+ORPHANED_ERROR = 'The server worker handling this job restarted before it finished; submit the image again'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    status TEXT NOT NULL,
+    created REAL NOT NULL,
+    started REAL,
+    finished REAL,
+    result TEXT,
+    error TEXT,
+    pid INTEGER
+);
+CREATE INDEX IF NOT EXISTS jobs_created ON jobs (created);
+"""
+
+
+def process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class QueueFull(Exception):
+    """Raised by JobQueue.submit when the queue cannot take more work"""
+
+    def __init__(self, retry_after):
+        super().__init__(f"OCR queue is full, retry in {retry_after}s")
+        self.retry_after = retry_after
+
+
+class JobQueue:
+    """
+    Bounded queue of OCR jobs processed by `workers` threads calling `handler(image_data)`.
+    At most `max_pollers` request threads long-poll at once; further polls answer immediately.
+    """
+
+    def __init__(self, handler, workers, maxsize=JOB_QUEUE_SIZE, path=JOBS_PATH, max_pollers=1):
+        self.handler = handler
+        self.workers = max(1, workers)
+        self.maxsize = maxsize
+        self.path = path
+        self.max_pollers = max(1, max_pollers)
+        self._pollers = threading.BoundedSemaphore(self.max_pollers)
+        self._lock = threading.Lock()
+        self._pid = None
+        self._queue = None
+        self._busy = 0
+        # Exponentially weighted mean OCR time per job, for Retry-After estimates
+        self._service_time = 2.0
+
+    def _connect(self):
+        # Job files on /dev/shm can outlive a deploy that predates the pid column
+        return connect(self.path, SCHEMA, migrations=('ALTER TABLE jobs ADD COLUMN pid INTEGER',))
+
+    def _ensure_started(self):
+        # Threads do not survive a fork, so each worker starts its own
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._queue = queue.Queue(maxsize=self.maxsize)
+            self._busy = 0
+            for i in range(self.workers):
+                threading.Thread(target=self._run, name=f'ocr-job-{i}', daemon=True).start()
+            self._pid = os.getpid()
+            atexit.register(self._fail_unfinished)
+
+    def _fail_unfinished(self):
+        """
+        Mark this worker's queued and running jobs failed; they die with its threads
+        """
+        if self._pid != os.getpid():
+            return
+        try:
+            self._connect().execute(
+                "UPDATE jobs SET status = 'failed', finished = ?, error = ? "
+                "WHERE pid = ? AND status IN ('queued', 'running')",
+                (time.time(), ORPHANED_ERROR, os.getpid()))
+        except sqlite3.Error as e:
+            print(f"Job queue error: {e}")
+
+    def _fail_orphans(self, conn):
+        """
+        Mark unfinished jobs of workers that are gone (killed without a clean exit) failed
+        """
+        rows = conn.execute(
+            "SELECT DISTINCT pid FROM jobs WHERE status IN ('queued', 'running') AND pid IS NOT NULL").fetchall()
+        for (pid,) in rows:
+            if pid != os.getpid() and not process_alive(pid):
+                conn.execute(
+                    "UPDATE jobs SET status = 'failed', finished = ?, error = ? "
+                    "WHERE pid = ? AND status IN ('queued', 'running')",
+                    (time.time(), ORPHANED_ERROR, pid))
+
+    def retry_after(self):
+        """
+        Seconds until a queue slot is likely to free up
+        """
+        backlog = self.maxsize + self._busy
+        return max(1, math.ceil(self._service_time * backlog / self.workers))
+
+    def submit(self, image_data):
+        """
+        Queue an image and return its job id; raises QueueFull when at capacity
+        """
+        self._ensure_started()
+        job_id = uuid.uuid4().hex
+        now = time.time()
+
+        conn = self._connect()
+        conn.execute('DELETE FROM jobs WHERE created < ?', (now - JOB_RESULT_TTL,))
+        self._fail_orphans(conn)
+        conn.execute('INSERT INTO jobs (id, status, created, pid) VALUES (?, ?, ?, ?)',
+                     (job_id, 'queued', now, os.getpid()))
+
+        try:
+            self._queue.put_nowait((job_id, now, image_data))
+        except queue.Full:
+            conn.execute('DELETE FROM jobs WHERE id = ?', (job_id,))
+            raise QueueFull(self.retry_after())
+
+        return job_id
+
+    def _run(self):
+        while True:
+            job_id, created, image_data = self._queue.get()
+            with self._lock:
+                self._busy += 1
+            try:
+                self._process(job_id, image_data)
+            except Exception as e:
+                # Bookkeeping failed ("database is locked", /dev/shm full); the thread keeps serving
+                print(f"Job queue error: {e}")
+                self._set_failed(job_id, f"Job bookkeeping failed: {e}")
+            finally:
+                image_data = None
+                with self._lock:
+                    self._busy -= 1
+                self._queue.task_done()
+
+    def _process(self, job_id, image_data):
+        started = time.time()
+        self._connect().execute('UPDATE jobs SET status = ?, started = ? WHERE id = ?', ('running', started, job_id))
+
+        try:
+            result = self.handler(image_data)
+            status, error = 'done', None
+        except Exception as e:
+            result, status, error = None, 'failed', str(e)
+        del image_data
+
+        finished = time.time()
+        self._service_time = 0.8 * self._service_time + 0.2 * (finished - started)
+        self._connect().execute(
+            'UPDATE jobs SET status = ?, finished = ?, result = ?, error = ? WHERE id = ?',
+            (status, finished, json.dumps(result) if result is not None else None, error, job_id))
+
+    def _set_failed(self, job_id, error):
+        try:
+            self._connect().execute("UPDATE jobs SET status = 'failed', finished = ?, error = ? WHERE id = ?",
+                                    (time.time(), error, job_id))
+        except sqlite3.Error as e:
+            print(f"Job queue error: {e}")
+
+    def get(self, job_id, wait=0.0):
+        """
+        Job record as a dict, or None for an unknown id.
+        With `wait`, long-polls up to that many seconds for the job to finish, if
+        fewer than max_pollers threads of this worker are already long-polling.
+        """
+        polling = wait > 0 and self._pollers.acquire(blocking=False)
+        try:
+            row = self._poll(job_id, wait if polling else 0.0)
+        finally:
+            if polling:
+                self._pollers.release()
+        if row is None:
+            return None
+        status, created, started, finished, result, error = row
+
+        job = {'job_id': job_id, 'status': status}
+        if started is not None:
+            job['queue_wait_ms'] = round((started - created) * 1000)
+        if started is not None and finished is not None:
+            job['processing_ms'] = round((finished - started) * 1000)
+        if result is not None:
+            job['result'] = json.loads(result)
+        if error is not None:
+            job['error'] = error
+        return job
+
+    def _poll(self, job_id, wait):
+        conn = self._connect()
+        deadline = time.time() + wait
+        while True:
+            row = conn.execute(
+                'SELECT status, created, started, finished, result, error, pid FROM jobs WHERE id = ?',
+                (job_id,)).fetchone()
+            if row is None:
+                return None
+            status, pid = row[0], row[6]
+            if status in ('queued', 'running') and pid is not None and pid != os.getpid() and not process_alive(pid):
+                self._fail_orphans(conn)
+                continue
+            if status in ('done', 'failed') or time.time() >= deadline:
+                return row[:6]
+            time.sleep(0.1)
+
+    def stats(self):
+        local_depth = self._queue.qsize() if self._pid == os.getpid() else 0
+        try:
+            conn = self._connect()
+            depth = conn.execute("SELECT COUNT(*) FROM jobs WHERE status = 'queued'").fetchone()[0]
+            running = conn.execute("SELECT COUNT(*) FROM jobs WHERE status = 'running'").fetchone()[0]
+            waits = [row[0] for row in conn.execute(
+                'SELECT started - created FROM jobs WHERE started >= ? ORDER BY 1',
+                (time.time() - JOB_STATS_WINDOW,))]
+        except sqlite3.Error as e:
+            return {'error': str(e)}
+
+        return {
+            'queued': depth,
+            'running': running,
+            'worker_queue_depth': local_depth,
+            'worker_queue_capacity': self.maxsize,
+            'worker_threads': self.workers,
+            'max_pollers': self.max_pollers,
+            'wait_ms_mean': round(sum(waits) / len(waits) * 1000) if waits else 0,
+            'wait_ms_p95': round(waits[min(len(waits) - 1, int(len(waits) * 0.95))] * 1000) if waits else 0,
+            'wait_ms_max': round(waits[-1] * 1000) if waits else 0,
+        }
@@ -0,0 +1,240 @@
+"""
+Live scanning: a camera stream sent as a sequence of downscaled frames.
+
+The client opens a session and posts frames to it a few times a second.
+Each frame is scored before any OCR: blurry frames (low variance of the
+Laplacian) are rejected, as are near-duplicates of the frame last sent to OCR
+(difference hash within LIVE_DEDUP_DISTANCE bits) unless they are clearly
+sharper, and frames well below the sharpest frame of the last
+LIVE_SHARPEST_WINDOW seconds. A frame that passes takes the session's next
+generation number; OCR of an older frame stops at its next pass once a newer
+one is accepted.
+
+The session ends as soon as a frame yields a checksum-valid number, or two
+frames agree on the same number. Session state is kept in a SQLite file on
+/dev/shm, so consecutive frames may be served by different workers.
+"""
+import json
+import os
+import time
+import uuid
+
+import numpy as np
+
+from image_decode import decode_grayscale
+from concurrency import ocr_slots
+from metrics import metrics
+from preflight import laplacian_sharpness
+from pipeline import OCR_STOP_CONFIDENCE, Cancelled, read_number, recognize_gray
+from result_cache import hamming, perceptual_hash
+from shm_db import connect, shared_dir
+
+LIVE_PATH = os.environ.get('OCR_LIVE_PATH', os.path.join(shared_dir(), 'ocr-live.sqlite'))
+LIVE_SESSION_TTL = float(os.environ.get('OCR_LIVE_SESSION_TTL', 300))
+# Frames are decoded to at most this many pixels; clients already send downscaled frames
+LIVE_DECODE_PIXELS = int(os.environ.get('OCR_LIVE_DECODE_PIXELS', 1_000_000))
+# Variance of the Laplacian of a SHARPNESS_WIDTH-wide thumbnail below which a frame is blurry
+LIVE_MIN_SHARPNESS = float(os.environ.get('OCR_LIVE_MIN_SHARPNESS', 100))
+# Frames within this many dHash bits of the last OCR'd frame are duplicates...
+LIVE_DEDUP_DISTANCE = int(os.environ.get('OCR_LIVE_DEDUP_DISTANCE', 4))
+# ...unless they are this much sharper than it
+LIVE_DEDUP_SHARPER = float(os.environ.get('OCR_LIVE_DEDUP_SHARPER', 1.25))
+# Frames below this fraction of the sharpest frame seen within the window are skipped
+LIVE_SHARPEST_WINDOW = float(os.environ.get('OCR_LIVE_SHARPEST_WINDOW', 1.5))
+LIVE_SHARPEST_RATIO = float(os.environ.get('OCR_LIVE_SHARPEST_RATIO', 0.8))
+
+# Frames are scored at this width, so scores compare across devices and LIVE_MIN_SHARPNESS holds for all
+SHARPNESS_WIDTH = 320
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS live_sessions (
+    id TEXT PRIMARY KEY,
+    created REAL NOT NULL,
+    updated REAL NOT NULL,
+    generation INTEGER NOT NULL DEFAULT 0,
+    frames INTEGER NOT NULL DEFAULT 0,
+    ocr_frames INTEGER NOT NULL DEFAULT 0,
+    last_hash INTEGER,
+    last_sharpness REAL,
+    recent TEXT NOT NULL DEFAULT '[]',
+    reads TEXT NOT NULL DEFAULT '[]',
+    result TEXT
+);
+CREATE INDEX IF NOT EXISTS live_sessions_updated ON live_sessions (updated);
+"""
+
+
+def end_reason(response, previous_reads):
+    """
+    Why a frame's result ends the session, or None to keep scanning
+    """
+    if not response.get('success'):
+        return None
+    if response.get('checksum_valid') and response.get('confidence', 0.0) >= OCR_STOP_CONFIDENCE:
+        return 'checksum'
+    if read_number(response) in previous_reads:
+        return 'agreement'
+    return None
+
+
+class LiveSessions:
+    """
+    Live scanning sessions in a file-backed SQLite store shared by all workers
+    """
+
+    def __init__(self, path=LIVE_PATH, ttl=LIVE_SESSION_TTL):
+        self.path = path
+        self.ttl = ttl
+
+    def _connect(self):
+        return connect(self.path, SCHEMA)
+
+    def start(self):
+        """
+        Open a session and return its id
+        """
+        session_id = uuid.uuid4().hex
+        now = time.time()
+        conn = self._connect()
+        conn.execute('DELETE FROM live_sessions WHERE updated < ?', (now - self.ttl,))
+        conn.execute('INSERT INTO live_sessions (id, created, updated) VALUES (?, ?, ?)', (session_id, now, now))
+        return session_id
+
+    def get(self, session_id):
+        """
+        Session summary as a dict, or None for an unknown or expired id
+        """
+        row = self._connect().execute(
+            'SELECT created, frames, ocr_frames, reads, result FROM live_sessions WHERE id = ? AND updated >= ?',
+            (session_id, time.time() - self.ttl)).fetchone()
+        if row is None:
+            return None
+        created, frames, ocr_frames, reads, result = row
+        session = {
+            'session_id': session_id,
+            'status': 'done' if result else 'scanning',
+            'frames': frames,
+            'ocr_frames': ocr_frames,
+            'reads': json.loads(reads),
+            'age_seconds': round(time.time() - created, 1),
+        }
+        if result:
+            session['result'] = json.loads(result)
+        return session
+
+    def _generation(self, session_id):
+        row = self._connect().execute('SELECT generation FROM live_sessions WHERE id = ?', (session_id,)).fetchone()
+        return row[0] if row else None
+
+    def _admit(self, session_id, sharpness, phash):
+        """
+        Gate one scored frame in a write transaction.
+        Returns (status, detail): ('ocr', generation), ('rejected', reason),
+        ('done', result) or (None, None) for an unknown session.
+        """
+        now = time.time()
+        conn = self._connect()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            row = conn.execute(
+                'SELECT generation, last_hash, last_sharpness, recent, result FROM live_sessions '
+                'WHERE id = ? AND updated >= ?', (session_id, now - self.ttl)).fetchone()
+            if row is None:
+                return None, None
+            generation, last_hash, last_sharpness, recent, result = row
+            if result:
+                return 'done', json.loads(result)
+
+            recent = [entry for entry in json.loads(recent) if entry[0] >= now - LIVE_SHARPEST_WINDOW]
+            sharpest = max((s for _, s in recent), default=0.0)
+            if sharpness >= LIVE_MIN_SHARPNESS:
+                recent.append([now, sharpness])
+
+            if sharpness < LIVE_MIN_SHARPNESS:
+                status, detail = 'rejected', 'blurry'
+            elif (last_hash is not None and hamming(phash, last_hash) <= LIVE_DEDUP_DISTANCE
+                  and sharpness < LIVE_DEDUP_SHARPER * last_sharpness):
+                status, detail = 'rejected', 'duplicate'
+            elif sharpness < LIVE_SHARPEST_RATIO * sharpest:
+                status, detail = 'rejected', 'not_sharpest'
+            else:
+                generation += 1
+                status, detail = 'ocr', generation
+
+            if status == 'ocr':
+                conn.execute(
+                    'UPDATE live_sessions SET updated = ?, frames = frames + 1, ocr_frames = ocr_frames + 1, '
+                    'generation = ?, last_hash = ?, last_sharpness = ?, recent = ? WHERE id = ?',
+                    (now, generation, phash, sharpness, json.dumps(recent), session_id))
+            else:
+                conn.execute('UPDATE live_sessions SET updated = ?, frames = frames + 1, recent = ? WHERE id = ?',
+                             (now, json.dumps(recent), session_id))
+            return status, detail
+        finally:
+            conn.execute('COMMIT')
+
+    def _record(self, session_id, response):
+        """
+        Add one frame's OCR result to the session; returns the session result if it has ended
+        """
+        conn = self._connect()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            row = conn.execute('SELECT reads, result FROM live_sessions WHERE id = ?', (session_id,)).fetchone()
+            if row is None:
+                return None
+            reads, result = row
+            if result:
+                # Another frame of this session finished first
+                return json.loads(result)
+
+            reads = json.loads(reads)
+            reason = end_reason(response, reads)
+            if response.get('success'):
+                reads.append(read_number(response))
+            result = dict(response, end_reason=reason) if reason else None
+            conn.execute('UPDATE live_sessions SET updated = ?, reads = ?, result = ? WHERE id = ?',
+                         (time.time(), json.dumps(reads), json.dumps(result) if result else None, session_id))
+            return result
+        finally:
+            conn.execute('COMMIT')
+
+    def submit_frame(self, session_id, image_data):
+        """
+        Score, gate and possibly OCR one frame (bytes or binary file).
+        Returns the response dict, or None for an unknown session.
+        """
+        gray_image, _ = decode_grayscale(image_data, decode_pixels=LIVE_DECODE_PIXELS)
+        with metrics.timed('ocr_stage_seconds', stage='frame_gate'):
+            sharpness = laplacian_sharpness(np.asarray(gray_image), SHARPNESS_WIDTH)
+            phash = perceptual_hash(gray_image)
+            status, detail = self._admit(session_id, sharpness, phash)
+        if status is None:
+            return None
+
+        frame = {'session_id': session_id, 'sharpness': round(sharpness, 1)}
+        if status == 'done':
+            return dict(frame, status='done', result=detail)
+        if status == 'rejected':
+            metrics.inc('ocr_live_frames_total', outcome=detail)
+            return dict(frame, status='rejected', reason=detail)
+
+        generation = detail
+        try:
+            with metrics.request(), ocr_slots.hold():
+                response = recognize_gray(
+                    gray_image, concurrent=False,
+                    cancelled=lambda: self._generation(session_id) != generation)
+        except Cancelled:
+            metrics.inc('ocr_live_frames_total', outcome='superseded')
+            return dict(frame, status='superseded')
+
+        result = self._record(session_id, response)
+        if result is not None:
+            metrics.inc('ocr_live_frames_total', outcome='done')
+            return dict(frame, status='done', result=result)
+        metrics.inc('ocr_live_frames_total', outcome='scanned')
+        return dict(frame, status='scanning', read=read_number(response))
+
+
+live_sessions = LiveSessions()
@@ -0,0 +1,313 @@
+"""
+Pipeline timing metrics in Prometheus text format.
+
+Each process keeps its histograms and counters in memory and a background
+thread writes them to its own JSON file in OCR_METRICS_DIR (on /dev/shm by
+default) about once per OCR_METRICS_FLUSH_SECONDS. GET /metrics merges the
+files of all workers, including workers that have since been recycled, so
+the numbers cover the whole gunicorn instance whichever worker serves the
+scrape.
+
+Stages are timed with `timed(histogram, **labels)`. While a `request()` is
+active in the current context, the same timings are also collected into a
+per-request breakdown that the API can return for debugging.
+"""
+import atexit
+import contextvars
+import glob
+import json
+import os
+import shutil
+import threading
+import time
+from contextlib import contextmanager
+
+from shm_db import shared_dir
+
+METRICS_ENABLED = os.environ.get('OCR_METRICS', 'true').lower() in ('1', 'true', 'yes')
+METRICS_DIR = os.environ.get('OCR_METRICS_DIR', os.path.join(shared_dir(), 'ocr-metrics'))
+METRICS_FLUSH_SECONDS = float(os.environ.get('OCR_METRICS_FLUSH_SECONDS', 2))
+# Merged metrics of workers that have exited
+ARCHIVE_NAME = 'archive.json'
+
+SECONDS_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+CALL_BUCKETS = (0, 1, 2, 3, 4, 6, 8, 12, 16)
+
+# name: (help, buckets)
+HISTOGRAMS = {
+    'ocr_stage_seconds': ('Time spent in each pipeline stage', SECONDS_BUCKETS),
+    'ocr_preprocess_seconds': ('Time to build each preprocessing variant', SECONDS_BUCKETS),
+    'ocr_engine_call_seconds': ('Time per OCR engine call, by page segmentation config', SECONDS_BUCKETS),
+    'ocr_image_seconds': ('End-to-end time per image, upload read included', SECONDS_BUCKETS),
+    'ocr_engine_calls_per_image': ('OCR engine calls made for one image', CALL_BUCKETS),
+    'ocr_queue_seconds': ('Time an image waited for a free OCR slot', SECONDS_BUCKETS),
+    'ocr_processing_seconds': ('Time an image held an OCR slot', SECONDS_BUCKETS),
+}
+COUNTERS = {
+    'ocr_images_total': 'Images processed, by outcome',
+    'ocr_winner_total': 'Attempt arm that produced the returned number',
+    'ocr_failures_total': 'Failed images, by reason',
+    'ocr_live_frames_total': 'Live scan frames, by outcome',
+    'ocr_scan_store_rows_total': 'Scan store records written, dropped or failed',
+}
+
+_current = contextvars.ContextVar('ocr_request_timings', default=None)
+
+
+class RequestTimings:
+    """
+    Stage timings of one image, in the order they finished
+    """
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.stages = []
+        self.engine_calls = 0
+
+    def add(self, histogram, labels, seconds):
+        entry = {'stage': histogram[len('ocr_'):-len('_seconds')]}
+        entry.update(labels)
+        entry['ms'] = round(seconds * 1000, 2)
+        self.stages.append(entry)
+        if histogram == 'ocr_engine_call_seconds':
+            self.engine_calls += 1
+
+    def to_dict(self):
+        return {
+            'total_ms': round((time.perf_counter() - self.started) * 1000, 2),
+            'queue_ms': round(sum(entry['ms'] for entry in self.stages if entry['stage'] == 'queue'), 2),
+            'engine_calls': self.engine_calls,
+            'stages': list(self.stages),
+        }
+
+
+def _key(name, labels):
+    return name, tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def _format_labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{k}="{v}"' for k, v in pairs) + '}'
+
+
+def _snapshot(histograms, counters):
+    return {
+        'histograms': [[name, dict(labels), [list(counts), total, count]]
+                       for (name, labels), (counts, total, count) in histograms.items()],
+        'counters': [[name, dict(labels), value] for (name, labels), value in counters.items()],
+    }
+
+
+def _write(path, snapshot):
+    # Write and rename, so readers never see a partial file
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temp_path = f'{path}.{threading.get_ident()}.tmp'
+    with open(temp_path, 'w') as f:
+        json.dump(snapshot, f)
+    os.replace(temp_path, path)
+
+
+def _format_bound(bound):
+    return repr(float(bound))
+
+
+class Metrics:
+    """
+    Per-process histograms and counters, merged across processes through METRICS_DIR
+    """
+
+    def __init__(self, directory=METRICS_DIR, enabled=METRICS_ENABLED):
+        self.directory = directory
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self._pid = None
+        self._path = None
+        self._histograms = {}
+        self._counters = {}
+        self._dirty = False
+
+    def _ensure_process(self):
+        # Forked workers start from zero with their own file; the parent's counts are in the parent's file
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._histograms = {}
+            self._counters = {}
+            self._dirty = False
+            self._path = os.path.join(self.directory, f'{os.getpid()}-{int(time.time() * 1000)}.json')
+            self._pid = os.getpid()
+            threading.Thread(target=self._flush_loop, name='ocr-metrics', daemon=True).start()
+
+    def observe(self, name, value, **labels):
+        if not self.enabled:
+            return
+        self._ensure_process()
+        buckets = HISTOGRAMS[name][1]
+        key = _key(name, labels)
+        with self._lock:
+            entry = self._histograms.get(key)
+            if entry is None:
+                entry = self._histograms[key] = [[0] * len(buckets), 0.0, 0]
+            for i, bound in enumerate(buckets):
+                if value <= bound:
+                    entry[0][i] += 1
+            entry[1] += value
+            entry[2] += 1
+            self._dirty = True
+
+    def inc(self, name, amount=1, **labels):
+        if not self.enabled:
+            return
+        self._ensure_process()
+        key = _key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+            self._dirty = True
+
+    @contextmanager
+    def timed(self, histogram, **labels):
+        """
+        Observe the duration of the block in `histogram`, and in the current request's breakdown
+        """
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - started
+            self.observe(histogram, seconds, **labels)
+            timings = _current.get()
+            if timings is not None:
+                timings.add(histogram, labels, seconds)
+
+    @contextmanager
+    def request(self):
+        """
+        Per-image timing scope. Nested scopes share the outermost one, which
+        records the end-to-end time and engine call count when it exits.
+        """
+        timings = _current.get()
+        if timings is not None:
+            yield timings
+            return
+
+        timings = RequestTimings()
+        token = _current.set(timings)
+        try:
+            yield timings
+        finally:
+            _current.reset(token)
+            self.observe('ocr_image_seconds', time.perf_counter() - timings.started)
+            self.observe('ocr_engine_calls_per_image', timings.engine_calls)
+
+    def _flush_loop(self):
+        pid = os.getpid()
+        while self._pid == pid:
+            time.sleep(METRICS_FLUSH_SECONDS)
+            if self._dirty:
+                self.flush()
+
+    def flush(self):
+        """
+        Write this process's metrics to its file in METRICS_DIR
+        """
+        if not self.enabled or self._pid != os.getpid():
+            return
+        with self._lock:
+            snapshot = _snapshot(self._histograms, self._counters)
+            self._dirty = False
+        try:
+            _write(self._path, snapshot)
+        except OSError as e:
+            print(f"Metrics flush error: {e}")
+
+    def _merged(self, paths=None):
+        histograms, counters = {}, {}
+        if paths is None:
+            paths = glob.glob(os.path.join(self.directory, '*.json'))
+        # The archive first: worker files it already includes are skipped until the master removes them
+        paths = sorted(paths, key=lambda path: os.path.basename(path) != ARCHIVE_NAME)
+        archived = set()
+        for path in paths:
+            if os.path.basename(path) in archived:
+                continue
+            try:
+                with open(path) as f:
+                    snapshot = json.load(f)
+            except (OSError, ValueError):
+                continue
+            archived.update(snapshot.get('archived', []))
+            for name, labels, (buckets, total, count) in snapshot.get('histograms', []):
+                if name not in HISTOGRAMS:
+                    continue
+                entry = histograms.setdefault(_key(name, labels), [[0] * len(buckets), 0.0, 0])
+                entry[0] = [a + b for a, b in zip(entry[0], buckets)]
+                entry[1] += total
+                entry[2] += count
+            for name, labels, value in snapshot.get('counters', []):
+                if name in COUNTERS:
+                    key = _key(name, labels)
+                    counters[key] = counters.get(key, 0) + value
+        return histograms, counters
+
+    def render(self):
+        """
+        All workers' metrics in Prometheus text exposition format
+        """
+        if not self.enabled:
+            return ''
+        self._ensure_process()
+        self.flush()
+        histograms, counters = self._merged()
+
+        lines = []
+        for name, (help_text, buckets) in HISTOGRAMS.items():
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} histogram')
+            for (metric, labels), (counts, total, count) in sorted(histograms.items()):
+                if metric != name:
+                    continue
+                for bound, bucket_count in zip(buckets, counts):
+                    lines.append(f'{name}_bucket{_format_labels(labels, [("le", _format_bound(bound))])} {bucket_count}')
+                lines.append(f'{name}_bucket{_format_labels(labels, [("le", "+Inf")])} {count}')
+                lines.append(f'{name}_sum{_format_labels(labels)} {total}')
+                lines.append(f'{name}_count{_format_labels(labels)} {count}')
+        for name, help_text in COUNTERS.items():
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} counter')
+            for (metric, labels), value in sorted(counters.items()):
+                if metric == name:
+                    lines.append(f'{name}{_format_labels(labels)} {value}')
+        return '\n'.join(lines) + '\n'
+
+    def archive(self, pid):
+        """
+        Fold the files of exited worker `pid` into one archive file, so recycled
+        workers do not leave a growing number of files behind. Called by the master.
+        """
+        paths = glob.glob(os.path.join(self.directory, f'{pid}-*.json'))
+        if not self.enabled or not paths:
+            return
+        archive_path = os.path.join(self.directory, ARCHIVE_NAME)
+        histograms, counters = self._merged(paths + [archive_path])
+        snapshot = _snapshot(histograms, counters)
+        snapshot['archived'] = [os.path.basename(path) for path in paths]
+        try:
+            _write(archive_path, snapshot)
+            for path in paths:
+                os.remove(path)
+        except OSError as e:
+            print(f"Metrics archive error: {e}")
+
+    def reset(self):
+        """
+        Remove all worker files; called once when the server starts
+        """
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+
+metrics = Metrics()
+atexit.register(metrics.flush)
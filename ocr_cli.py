@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+"""
+Bulk patient number OCR from the command line.
+
+Walks a directory (or reads a list of paths, one per line, `-` for stdin),
+OCRs the images in a process pool across all cores and appends one row per
+image to a CSV or JSONL file as results come in. Paths already present in the
+output file are skipped, so an interrupted run picks up where it stopped.
+
+    python ocr_cli.py scans/ --output results.csv
+    find /archive -name '*.jpg' | python ocr_cli.py --file-list - --output results.jsonl
+"""
+import argparse
+import csv
+import json
+import os
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, as_completed, wait
+
+from batch_upload import is_image_name
+
+CSV_FIELDS = ('path', 'success', 'patient_number', 'confidence', 'checksum_valid', 'national_number',
+              'preprocessing', 'ocr_config', 'seconds', 'error')
+
+
+def find_images(root):
+    """
+    Image files under `root`, in a stable order
+    """
+    for directory, subdirs, files in os.walk(root):
+        subdirs.sort()
+        for name in sorted(files):
+            if is_image_name(name) and not name.startswith('.'):
+                yield os.path.join(directory, name)
+
+
+def read_file_list(path):
+    f = sys.stdin if path == '-' else open(path)
+    try:
+        for line in f:
+            line = line.strip()
+            if line:
+                yield line
+    finally:
+        if f is not sys.stdin:
+            f.close()
+
+
+def output_format(path, requested=None):
+    if requested:
+        return requested
+    return 'jsonl' if path.endswith(('.jsonl', '.ndjson', '.json')) else 'csv'
+
+
+def completed_paths(path, fmt):
+    """
+    Paths already recorded in an existing output file
+    """
+    if not os.path.exists(path):
+        return set()
+    done = set()
+    with open(path, newline='') as f:
+        if fmt == 'csv':
+            for row in csv.DictReader(f):
+                done.add(row['path'])
+        else:
+            for line in f:
+                try:
+                    done.add(json.loads(line)['path'])
+                except (ValueError, KeyError):
+                    # A line cut short by an interrupted run
+                    continue
+    return done
+
+
+def init_worker():
+    # One OCR thread per process: parallelism comes from the pool, not from inside each image.
+    # Read by concurrency.py when the pipeline is first imported in this process.
+    os.environ['OCR_PROFILE'] = 'throughput'
+    os.environ.setdefault('OCR_ENGINE_POOL_SIZE', '1')
+    # The server merges every metrics file on the host; offline runs must not add to its counters
+    os.environ['OCR_METRICS'] = 'false'
+
+
+def recognize_file(path):
+    """
+    Result record for one image file; errors are recorded, never raised
+    """
+    import pipeline
+
+    started = time.perf_counter()
+    try:
+        result = pipeline.recognize(path, concurrent=False)
+        error = None
+    except Exception as e:
+        result, error = {'success': False}, str(e)
+    record = dict(result, path=path, seconds=round(time.perf_counter() - started, 3))
+    if error:
+        record['error'] = error
+    return record
+
+
+class ResultWriter:
+    """
+    Appends result records to a CSV or JSONL file, flushing every row
+    """
+
+    def __init__(self, path, fmt):
+        self.fmt = fmt
+        new_file = not os.path.exists(path) or os.path.getsize(path) == 0
+        self._file = open(path, 'a', newline='')
+        if fmt == 'csv':
+            self._csv = csv.DictWriter(self._file, fieldnames=CSV_FIELDS, extrasaction='ignore')
+            if new_file:
+                self._csv.writeheader()
+
+    def write(self, record):
+        if self.fmt == 'csv':
+            self._csv.writerow(record)
+        else:
+            self._file.write(json.dumps(record) + '\n')
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='OCR patient numbers from many images using all cores')
+    parser.add_argument('directory', nargs='?', help='directory to scan for images')
+    parser.add_argument('--file-list', help='file with one image path per line, or - for stdin')
+    parser.add_argument('--output', '-o', default='ocr-results.csv', help='CSV or JSONL results file (appended)')
+    parser.add_argument('--format', choices=('csv', 'jsonl'), help='output format (default: from the extension)')
+    parser.add_argument('--workers', '-j', type=int,
+                        help='OCR processes (default: the cores of the container quota and CPU affinity)')
+    parser.add_argument('--no-cache', action='store_true', help='bypass the shared result cache')
+    args = parser.parse_args()
+
+    if bool(args.directory) == bool(args.file_list):
+        parser.error('give either a directory or --file-list')
+    if args.no_cache:
+        # Inherited by the worker processes before they import the pipeline
+        os.environ['OCR_CACHE'] = 'false'
+
+    fmt = output_format(args.output, args.format)
+    done = completed_paths(args.output, fmt)
+    paths = find_images(args.directory) if args.directory else read_file_list(args.file_list)
+
+    writer = ResultWriter(args.output, fmt)
+    if args.workers is None:
+        # concurrency.py reads the profile when imported, and forked workers inherit the module
+        init_worker()
+        from concurrency import available_cpus
+        args.workers = available_cpus()
+    workers = max(1, args.workers)
+    started = time.time()
+    processed = skipped = found = 0
+    pending = set()
+
+    def collect(futures):
+        nonlocal processed, found
+        for future in futures:
+            record = future.result()
+            writer.write(record)
+            processed += 1
+            found += bool(record.get('success'))
+            number = record.get('national_number') or record.get('patient_number')
+            print(f"{'ok  ' if record.get('success') else 'FAIL'} {record['path']}: "
+                  f"{number or record.get('error') or record.get('message')}")
+
+    try:
+        with ProcessPoolExecutor(max_workers=workers, initializer=init_worker) as executor:
+            for path in paths:
+                if path in done:
+                    skipped += 1
+                    continue
+                # Keep a couple of files per process queued, without listing the whole tree up front
+                while len(pending) >= 2 * workers:
+                    finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    collect(finished)
+                pending.add(executor.submit(recognize_file, path))
+            collect(as_completed(pending))
+    except KeyboardInterrupt:
+        print('Interrupted; rerun the same command to continue')
+    finally:
+        writer.close()
+
+    elapsed = time.time() - started
+    rate = processed / elapsed if elapsed else 0.0
+    print(f"{processed} images in {elapsed:.1f}s ({rate:.1f}/s), {found} numbers found, "
+          f"{skipped} already done, results in {args.output}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,291 @@
+"""
+Pool of long-lived Tesseract engines shared by the request threads of a worker.
+
+Each engine is a tesserocr API handle that loads the traineddata once and
+OCRs in-memory PIL images, so a call costs no process fork, temp file or
+language-data reload. When tesserocr is not installed (or cannot initialise)
+calls fall back to pytesseract, which runs the tesseract binary per call.
+"""
+import os
+import queue
+import threading
+from collections import namedtuple
+from contextlib import contextmanager
+
+from concurrency import GUNICORN_THREADS, OCR_CPU_BUDGET, apply_thread_limits
+
+# OMP_THREAD_LIMIT is read when Tesseract's OpenMP runtime loads, so it is set before the import
+apply_thread_limits()
+
+try:
+    import tesserocr
+    TESSEROCR_AVAILABLE = True
+except ImportError:
+    TESSEROCR_AVAILABLE = False
+
+try:
+    import pytesseract
+    PYTESSERACT_AVAILABLE = True
+except ImportError:
+    PYTESSERACT_AVAILABLE = False
+
+AVAILABLE = TESSEROCR_AVAILABLE or PYTESSERACT_AVAILABLE
+
+if TESSEROCR_AVAILABLE:
+    print("OCR backend: tesserocr engine pool")
+elif PYTESSERACT_AVAILABLE:
+    print("OCR backend: pytesseract, one tesseract process per call (tesserocr is not installed)")
+else:
+    print("OCR backend: none, Tesseract is not installed; using the digit template reader only")
+
+DIGITS = '0123456789'
+
+# One engine per thread that can OCR at once: request threads and the shared OCR executor
+POOL_SIZE = int(os.environ.get('OCR_ENGINE_POOL_SIZE', max(GUNICORN_THREADS, OCR_CPU_BUDGET)))
+ACQUIRE_TIMEOUT = float(os.environ.get('OCR_ENGINE_ACQUIRE_TIMEOUT', 60))
+LANG = os.environ.get('OCR_LANG', 'eng')
+
+
+# One recognised word; `line` is any value shared by the words of the same text line
+Word = namedtuple('Word', 'text conf left top width height line')
+
+
+def tesseract_config(psm, whitelist=None):
+    """
+    Build the pytesseract config string for a page segmentation mode
+    and optional character whitelist
+    """
+    config = f'--oem 3 --psm {psm}'
+    if whitelist:
+        config += f' -c tessedit_char_whitelist={whitelist}'
+    return config
+
+
+def _iterate_words(api):
+    level = tesserocr.RIL.WORD
+    iterator = api.GetIterator()
+    if iterator is None:
+        return
+    line = 0
+    while True:
+        if iterator.IsAtBeginningOf(tesserocr.RIL.TEXTLINE):
+            line += 1
+        text = (iterator.GetUTF8Text(level) or '').strip()
+        box = iterator.BoundingBox(level)
+        if text and box:
+            x0, y0, x1, y1 = box
+            yield Word(text, iterator.Confidence(level), x0, y0, x1 - x0, y1 - y0, line)
+        if not iterator.Next(level):
+            break
+
+
+def words_to_text(words):
+    """
+    Rebuild text lines from word geometry. Tokens of one line are ordered left to
+    right; tokens closer than the text height belong to one number and are
+    joined directly at a "." or "-" and by a single space otherwise.
+    """
+    lines = {}
+    for word in words:
+        lines.setdefault(word.line, []).append(word)
+
+    text_lines = []
+    for line_words in sorted(lines.values(), key=lambda ws: min(w.top for w in ws)):
+        line_words.sort(key=lambda w: w.left)
+        parts = [line_words[0].text]
+        for prev, word in zip(line_words, line_words[1:]):
+            gap = word.left - (prev.left + prev.width)
+            if gap >= max(prev.height, word.height):
+                parts.append('   ')
+            elif prev.text[-1] not in '.-' and word.text[0] not in '.-':
+                parts.append(' ')
+            parts.append(word.text)
+        text_lines.append(''.join(parts))
+    return '\n'.join(text_lines)
+
+
+class EnginePool:
+    """
+    Bounded, thread-safe pool of tesserocr engines.
+
+    Engines are created lazily up to `size` and handed out one caller at a
+    time. The pool is per process: after a fork (gunicorn preload_app) the
+    inherited engines are discarded and the child builds its own, except
+    engines created by prewarm() in the preload master, which each child
+    takes over as its own copy.
+    """
+
+    def __init__(self, size=POOL_SIZE, lang=LANG):
+        self.size = max(1, size)
+        self.lang = lang
+        self._lock = threading.Lock()
+        self._pid = None
+        self._idle = None
+        self._created = 0
+        self._disabled = not TESSEROCR_AVAILABLE
+        # Set by prewarm(): idle engines survive a fork
+        self._inheritable = False
+        self.calls = 0
+
+    @property
+    def active(self):
+        """True when calls go through pooled engines rather than pytesseract"""
+        return not self._disabled
+
+    def _ensure_process(self):
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    inherited = []
+                    if self._inheritable and self._idle is not None:
+                        # Warmed in the master, which never uses them again; this process owns its copy
+                        while not self._idle.empty():
+                            inherited.append(self._idle.get_nowait())
+                    self._idle = queue.LifoQueue()
+                    for api in inherited:
+                        self._idle.put(api)
+                    self._created = len(inherited)
+                    self._pid = os.getpid()
+
+    def _create_engine(self):
+        try:
+            return tesserocr.PyTessBaseAPI(lang=self.lang, oem=tesserocr.OEM.DEFAULT)
+        except Exception as e:
+            print(f"Tesseract engine init error, falling back to pytesseract: {e}")
+            self._disabled = True
+            return None
+
+    def _acquire(self):
+        self._ensure_process()
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+
+        with self._lock:
+            create = self._created < self.size
+            if create:
+                self._created += 1
+
+        if create:
+            api = self._create_engine()
+            if api is None:
+                with self._lock:
+                    self._created -= 1
+            return api
+
+        return self._idle.get(timeout=ACQUIRE_TIMEOUT)
+
+    @contextmanager
+    def engine(self):
+        """
+        Borrow an engine for the duration of the block.
+        Yields None when the pool is unavailable.
+        """
+        api = self._acquire() if self.active else None
+        try:
+            yield api
+        finally:
+            if api is not None:
+                api.Clear()
+                self._idle.put(api)
+
+    def image_to_string(self, image, psm=6, whitelist=None):
+        """
+        OCR a PIL image with the given page segmentation mode and whitelist
+        """
+        with self._lock:
+            self.calls += 1
+        with self.engine() as api:
+            if api is not None:
+                api.SetPageSegMode(psm)
+                api.SetVariable('tessedit_char_whitelist', whitelist or '')
+                api.SetImage(image)
+                return api.GetUTF8Text().strip()
+
+        return pytesseract.image_to_string(image, config=tesseract_config(psm, whitelist)).strip()
+
+    def image_to_words(self, image, psm=11, whitelist=None):
+        """
+        Recognised words with confidence (0-100) and bounding box, from one engine pass
+        """
+        with self._lock:
+            self.calls += 1
+        with self.engine() as api:
+            if api is not None:
+                api.SetPageSegMode(psm)
+                api.SetVariable('tessedit_char_whitelist', whitelist or '')
+                api.SetImage(image)
+                api.Recognize()
+                return list(_iterate_words(api))
+
+        data = pytesseract.image_to_data(image, config=tesseract_config(psm, whitelist),
+                                         output_type=pytesseract.Output.DICT)
+        words = []
+        for i, text in enumerate(data['text']):
+            text = text.strip()
+            if not text or float(data['conf'][i]) < 0:
+                continue
+            words.append(Word(text, float(data['conf'][i]), data['left'][i], data['top'][i],
+                              data['width'][i], data['height'][i],
+                              (data['block_num'][i], data['par_num'][i], data['line_num'][i])))
+        return words
+
+    def prewarm(self, image, count=1):
+        """
+        Create up to `count` engines and run `image` through each, so language data
+        is loaded before the first request. Call from the preload master only,
+        before forking; forked workers inherit the warm engines.
+        """
+        self._inheritable = True
+        apis = []
+        while self.active and len(apis) < min(count, self.size):
+            api = self._acquire()
+            if api is None:
+                break
+            apis.append(api)
+        try:
+            for api in apis:
+                api.SetPageSegMode(7)
+                api.SetImage(image)
+                api.Recognize()
+        finally:
+            for api in apis:
+                api.Clear()
+                self._idle.put(api)
+        if not apis:
+            # No pooled engines: run the pytesseract fallback once to page in the binary and data
+            self.image_to_string(image, psm=7)
+        return len(apis)
+
+    def stats(self):
+        return {
+            'backend': 'tesserocr' if self.active else 'pytesseract',
+            'size': self.size,
+            'engines': self._created if self._pid == os.getpid() else 0,
+            'calls': self.calls,
+        }
+
+    def close(self):
+        """End all idle engines held by this process"""
+        if self._pid != os.getpid() or self._idle is None:
+            return
+        while True:
+            try:
+                api = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            api.End()
+            with self._lock:
+                self._created -= 1
+
+
+engine_pool = EnginePool()
+
+
+def image_to_string(image, psm=6, whitelist=None):
+    return engine_pool.image_to_string(image, psm=psm, whitelist=whitelist)
+
+
+def image_to_words(image, psm=11, whitelist=None):
+    return engine_pool.image_to_words(image, psm=psm, whitelist=whitelist)
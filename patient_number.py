@@ -0,0 +1,181 @@
+"""
+Patient number candidates from raw OCR text.
+
+Cards print the patient's national register number as `YY.MM.DD-XXX.CC`:
+birth date, a 3-digit serial and a 2-digit mod-97 check over the first nine
+digits (with a leading "2" for births from 2000 on). A checksum-valid read is
+almost certainly right, which lets the pipeline stop after the first one
+instead of running every OCR pass.
+
+The 10-digit patient number cannot be derived from the national number, so
+the two are separate candidates: 11-digit reads carry `national_number` and
+10-digit reads do not. Windows of ten digits cut out of a checksum-valid
+national number are not offered as patient numbers.
+
+Candidates are generated from every grouping of the digit runs in the text
+and from common OCR digit confusions, then scored by checksum validity,
+date plausibility and how closely the separators match the card layout.
+"""
+import re
+from collections import namedtuple
+from itertools import combinations, product
+
+# `number` is the digits read; for 11-digit reads it equals `national_number`
+Candidate = namedtuple('Candidate', 'number national_number confidence checksum_valid source')
+
+# Digits Tesseract commonly mistakes for one another on card fonts
+CONFUSIONS = {
+    '0': '8',
+    '1': '7',
+    '3': '8',
+    '7': '1',
+    '8': '03',
+}
+# Substituted digits tried per 11-digit group; each try costs a checksum
+MAX_CORRECTIONS = 2
+
+LAYOUT = re.compile(r'^\d{2}\.\d{2}\.\d{2}-\d{3}\.\d{2}$')
+# Digit runs joined by separators OCR produces between the groups of one number
+GROUP = re.compile(r'\d+(?:[ .,\-_/:]{1,2}\d+)*')
+
+CONFIDENCE_LAYOUT_VALID = 0.99
+CONFIDENCE_VALID = 0.95
+CONFIDENCE_CORRECTED = (0.85, 0.7)
+CONFIDENCE_INVALID = 0.35
+CONFIDENCE_TEN_DIGITS = 0.5
+CONFIDENCE_DIGIT_WINDOW = 0.2
+# Checksum-valid numbers with an impossible birth date are scaled down
+IMPLAUSIBLE_DATE_FACTOR = 0.6
+# Checksum-valid 11-digit windows cut out of a longer digit run, without group boundaries
+WINDOW_FACTOR = 0.85
+
+
+def checksum_valid(digits):
+    """
+    mod-97 check of an 11-digit national register number, for births before and after 2000
+    """
+    base, check = digits[:9], int(digits[9:])
+    return 97 - int(base) % 97 == check or 97 - int('2' + base) % 97 == check
+
+
+def date_plausible(digits):
+    """
+    Birth month and day in range; month and day may be 00 when unknown,
+    and bis-numbers add 20 or 40 to the month
+    """
+    month, day = int(digits[2:4]), int(digits[4:6])
+    return month <= 52 and month % 20 <= 12 and day <= 31
+
+
+def corrections(digits):
+    """
+    Variants of `digits` with up to MAX_CORRECTIONS confusable digits substituted,
+    as (variant, substitutions) pairs
+    """
+    positions = [i for i, d in enumerate(digits) if d in CONFUSIONS]
+    for count in range(1, MAX_CORRECTIONS + 1):
+        for chosen in combinations(positions, count):
+            for replacements in product(*(CONFUSIONS[digits[i]] for i in chosen)):
+                variant = list(digits)
+                for i, r in zip(chosen, replacements):
+                    variant[i] = r
+                yield ''.join(variant), count
+
+
+def unique_correction(digits):
+    """
+    The single checksum-valid, date-plausible correction with the fewest substitutions,
+    as (digits, substitutions). None when there is none or the fewest-substitution
+    level is ambiguous: with ~1/97 of random numbers passing, an ambiguous fix is a guess.
+    """
+    found = {}
+    for variant, count in corrections(digits):
+        if checksum_valid(variant) and date_plausible(variant):
+            found.setdefault(count, set()).add(variant)
+    if not found:
+        return None
+    count = min(found)
+    if len(found[count]) != 1:
+        return None
+    return found[count].pop(), count
+
+
+def score_national_number(digits, layout_match):
+    """
+    Best candidate for an 11-digit read, trying confusion corrections if the checksum fails
+    """
+    if checksum_valid(digits):
+        confidence = CONFIDENCE_LAYOUT_VALID if layout_match else CONFIDENCE_VALID
+        source = 'checksum'
+    else:
+        corrected = unique_correction(digits)
+        if corrected:
+            digits, count = corrected
+            confidence = CONFIDENCE_CORRECTED[count - 1]
+            source = 'checksum_corrected'
+        else:
+            return Candidate(digits, digits, CONFIDENCE_INVALID * (1.0 if date_plausible(digits) else 0.5),
+                             False, 'national_number_layout')
+
+    if not date_plausible(digits):
+        confidence *= IMPLAUSIBLE_DATE_FACTOR
+    return Candidate(digits, digits, confidence, True, source)
+
+
+def generate_candidates(text):
+    """
+    All patient number and national number candidates in `text`, best first
+    """
+    candidates = {}
+
+    def add(candidate):
+        current = candidates.get(candidate.number)
+        if current is None or candidate.confidence > current.confidence:
+            candidates[candidate.number] = candidate
+
+    for match in GROUP.finditer(text):
+        group = match.group()
+        runs = re.findall(r'\d+', group)
+
+        # Every span of consecutive runs that adds up to 11 digits
+        national = set()
+        for start in range(len(runs)):
+            total = 0
+            for end in range(start, len(runs)):
+                total += len(runs[end])
+                if total == 11:
+                    digits = ''.join(runs[start:end + 1])
+                    layout = end - start == 4 and LAYOUT.match(group) is not None
+                    candidate = score_national_number(digits, layout)
+                    add(candidate)
+                    if candidate.checksum_valid:
+                        national.add(digits)
+                if total >= 11:
+                    break
+
+        # A standalone 10-digit run, e.g. the patient number printed on its own
+        for run in runs:
+            if len(run) == 10:
+                add(Candidate(run, None, CONFIDENCE_TEN_DIGITS, False, 'ten_digits'))
+
+        # Sliding windows over long digit sequences, if nothing better turns up
+        digits = ''.join(runs)
+        for i in range(len(digits) - 10 + 1):
+            if any(digits[i:i + 10] in number for number in national):
+                continue
+            add(Candidate(digits[i:i + 10], None, CONFIDENCE_DIGIT_WINDOW, False, 'digit_window'))
+        for i in range(len(digits) - 11 + 1):
+            window = digits[i:i + 11]
+            if checksum_valid(window) and window not in national:
+                candidate = score_national_number(window, False)
+                add(candidate._replace(confidence=candidate.confidence * WINDOW_FACTOR, source='checksum_window'))
+
+    return sorted(candidates.values(), key=lambda c: c.confidence, reverse=True)
+
+
+def best_candidate(text):
+    """
+    Highest-confidence candidate in `text`, or None
+    """
+    candidates = generate_candidates(text) if text else []
+    return candidates[0] if candidates else None
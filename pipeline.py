@@ -0,0 +1,545 @@
+"""
+Patient number OCR pipeline.
+
+`recognize(image)` runs the full pipeline on one image (a path, bytes, binary
+file, PIL image or NumPy array) and returns the result dict served by
+POST /process_ocr. Decoding, the shared result cache, the adaptive attempt
+order and the early stop on a checksum-valid number all live here, so the web
+app, the bulk CLI (ocr_cli.py) and the debug script share one implementation.
+"""
+import contextvars
+import os
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from PIL import Image, ImageEnhance
+import cv2
+import numpy as np
+
+from ocr_engine import DIGITS, engine_pool, words_to_text
+from regions import number_region_crops
+from card_geometry import OCR_RECTIFY, rectify_image
+from digit_ocr import read_line
+from image_decode import decode_grayscale, peak_rss_mb
+from result_cache import content_key, perceptual_hash, result_cache
+from patient_number import CONFIDENCE_TEN_DIGITS, best_candidate, generate_candidates
+from scheduler import attempt_scheduler, image_features
+from metrics import metrics
+from concurrency import OCR_CONCURRENT, OCR_CPU_BUDGET, OCR_REQUEST_PARALLELISM, ocr_slots
+from preflight import PREFLIGHT_ENABLED, preflight_check
+from scan_store import scan_store
+import ocr_engine
+
+# Pooled tesserocr engines when installed, pytesseract otherwise
+TESSERACT_AVAILABLE = ocr_engine.AVAILABLE
+
+# Remaining OCR passes are skipped once a candidate reaches this confidence;
+# checksum-valid national register numbers score 0.95 and up
+OCR_STOP_CONFIDENCE = float(os.environ.get('OCR_STOP_CONFIDENCE', 0.9))
+# A plain 10-digit read also ends the search when Tesseract's mean word confidence reaches this
+OCR_WORD_STOP_CONFIDENCE = float(os.environ.get('OCR_WORD_STOP_CONFIDENCE', 0.85))
+
+# Region-of-interest stage: OCR only the top-ranked number-line crops before the full frame
+OCR_ROI = os.environ.get('OCR_ROI', 'true').lower() in ('1', 'true', 'yes')
+OCR_ROI_REGIONS = int(os.environ.get('OCR_ROI_REGIONS', 3))
+
+# Attempt arms in their default order; the scheduler reorders them per image
+OCR_ARMS = (['roi'] if OCR_ROI else []) + ['otsu', 'enhanced', 'adaptive', 'original']
+
+# Template-matching fast path before Tesseract; its read is returned as is when it is an
+# uncorrected checksum-valid number with at least this mean glyph score. Off by default:
+# the templates are rendered from DejaVu only and read other fonts far less often.
+OCR_FAST_PATH = os.environ.get('OCR_FAST_PATH', 'false').lower() in ('1', 'true', 'yes')
+OCR_FAST_PATH_MIN_SCORE = float(os.environ.get('OCR_FAST_PATH_MIN_SCORE', 0.8))
+
+# Metric labels for the page segmentation modes the pipeline uses
+PSM_NAMES = {7: 'single_line', 11: 'word_level'}
+
+_ocr_executor = None
+_ocr_executor_pid = None
+_ocr_executor_lock = threading.Lock()
+
+class Cancelled(Exception):
+    """Raised by recognize_gray when its `cancelled` callback reports the result is no longer wanted"""
+
+def run_glyph_ocr(crops, best=("", None)):
+    """
+    Template-matching read of the number-line crops, best-ranked first (see digit_ocr.py)
+    """
+    for _, crop in crops:
+        with metrics.timed('ocr_stage_seconds', stage='glyphs'):
+            attempt = read_line(np.asarray(crop))
+        best = consider(best, attempt, 'glyphs', 'templates')
+        if is_confident(best[1]):
+            break
+    
+    return best
+
+def fast_path_accepted(best_result):
+    """
+    True when a template read can be returned without running Tesseract at all:
+    an uncorrected checksum-valid number read with high glyph scores
+    """
+    if not best_result or not best_result[2]:
+        return False
+    candidate, glyph_score = best_result[2], best_result[3]
+    return (candidate.source == 'checksum' and candidate.confidence >= OCR_STOP_CONFIDENCE
+            and glyph_score >= OCR_FAST_PATH_MIN_SCORE)
+
+def read_number(response):
+    """
+    The number a response identifies the card by: the national number when one was read,
+    the patient number otherwise
+    """
+    return response.get('national_number') or response.get('patient_number')
+
+def extract_patient_number(text):
+    """
+    Highest-confidence patient number in OCR text, see patient_number.py
+    """
+    candidate = best_candidate(text)
+    return candidate.number if candidate else None
+
+def is_confident(best_result):
+    """
+    True once an attempt produced a candidate good enough to skip the remaining passes:
+    a checksum-valid number, or a 10-digit read the engine itself is sure about
+    """
+    if not best_result or not best_result[2]:
+        return False
+    candidate, ocr_confidence = best_result[2], best_result[3]
+    return (candidate.confidence >= OCR_STOP_CONFIDENCE
+            or (candidate.confidence >= CONFIDENCE_TEN_DIGITS and ocr_confidence >= OCR_WORD_STOP_CONFIDENCE))
+
+def consider(best, attempt, method_name, ocr_config):
+    """
+    Fold one OCR attempt (text, ocr_confidence) into the running best (text, best_result).
+    The higher-confidence candidate wins, engine confidence breaking ties; the first
+    text with digits is kept while no attempt has a candidate.
+    """
+    ocr_text, ocr_confidence = attempt
+    if not ocr_text or not re.search(r'\d', ocr_text):
+        return best
+    
+    text, best_result = best
+    with metrics.timed('ocr_stage_seconds', stage='extract'):
+        candidate = best_candidate(ocr_text)
+    current = (best_result[2].confidence, best_result[3]) if best_result and best_result[2] else None
+    
+    if candidate and (current is None or (candidate.confidence, ocr_confidence) > current):
+        return ocr_text, (method_name, ocr_config, candidate, ocr_confidence)
+    if best_result is None:
+        return ocr_text, (method_name, ocr_config, None, ocr_confidence)
+    return best
+
+def preprocess_otsu(gray_image, gray_array):
+    _, thresh_otsu = cv2.threshold(gray_array, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
+    # In place: the median filter result replaces the threshold buffer
+    cv2.medianBlur(thresh_otsu, 3, dst=thresh_otsu)
+    return Image.fromarray(thresh_otsu)
+
+def preprocess_enhanced(gray_image, gray_array):
+    enhanced_contrast = np.asarray(ImageEnhance.Contrast(gray_image).enhance(2.0))
+    _, thresh_enhanced = cv2.threshold(enhanced_contrast, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
+    del enhanced_contrast
+    cv2.medianBlur(thresh_enhanced, 3, dst=thresh_enhanced)
+    return Image.fromarray(thresh_enhanced)
+
+def preprocess_adaptive(gray_image, gray_array):
+    adaptive_thresh = cv2.adaptiveThreshold(gray_array, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C, cv2.THRESH_BINARY, 11, 2)
+    return Image.fromarray(adaptive_thresh)
+
+PREPROCESSORS = {
+    'otsu': preprocess_otsu,
+    'enhanced': preprocess_enhanced,
+    'adaptive': preprocess_adaptive,
+    'original': lambda gray_image, gray_array: gray_image,
+}
+
+def build_preprocessing_methods(gray_image, gray_array, names=('otsu', 'enhanced', 'adaptive')):
+    """
+    Otsu, contrast-enhanced and adaptive binarisations (and 'original') of a grayscale image.
+    Yields lazily so a variant's buffers only exist once it is needed.
+    """
+    for name in names:
+        yield name, preprocess(name, gray_image, gray_array)
+
+def preprocess(name, gray_image, gray_array):
+    with metrics.timed('ocr_preprocess_seconds', variant=name):
+        return PREPROCESSORS[name](gray_image, gray_array)
+
+def number_crops(gray_array, geometry=None):
+    """
+    The OCR_ROI_REGIONS most likely patient-number line crops, as (box, image),
+    after the configured number field of a rectified card
+    """
+    with metrics.timed('ocr_stage_seconds', stage='regions'):
+        crops = number_region_crops(gray_array, OCR_ROI_REGIONS)
+        field = geometry.field_crop() if geometry is not None else None
+    return [field] + crops if field else crops
+
+def run_roi_ocr(gray_array, best=("", None), crops=None):
+    """
+    Single-line OCR of the most likely patient-number crops, best-ranked first
+    """
+    if crops is None:
+        crops = number_crops(gray_array)
+    with metrics.timed('ocr_preprocess_seconds', variant='roi'):
+        binarized = []
+        for _, crop in crops:
+            _, crop_otsu = cv2.threshold(np.array(crop), 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
+            binarized.append(Image.fromarray(crop_otsu))
+    
+    for crop in binarized:
+        attempt = ocr_attempt(crop, psm=7, whitelist=DIGITS + '.-')
+        best = consider(best, attempt, 'roi', 'single_line')
+        if is_confident(best[1]):
+            break
+    
+    return best
+
+def ocr_attempt(image, psm=11, whitelist=None):
+    """
+    One word-level engine pass. Returns the digit-bearing words rebuilt into
+    lines from their geometry, and their mean engine confidence (0-1).
+    """
+    with metrics.timed('ocr_engine_call_seconds', config=PSM_NAMES.get(psm, f'psm{psm}')):
+        words = engine_pool.image_to_words(image, psm=psm, whitelist=whitelist)
+    digit_words = [w for w in words if any(c.isdigit() for c in w.text)]
+    if not digit_words:
+        return "", 0.0
+    
+    return words_to_text(digit_words), sum(w.conf for w in digit_words) / len(digit_words) / 100.0
+
+def run_ocr_sequential(arms, gray_image, gray_array, best=("", None), attempted=None, crops=None, cancelled=None):
+    """
+    Run the attempt arms ('roi' or a preprocessing variant) in order,
+    stopping as soon as one yields a confident (checksum-valid) number.
+    `cancelled()` is checked before each arm; raises Cancelled when it returns true.
+    """
+    for arm in arms:
+        if cancelled is not None and cancelled():
+            raise Cancelled()
+        if arm == 'roi':
+            best = run_roi_ocr(gray_array, best, crops)
+        else:
+            best = consider(best, ocr_attempt(preprocess(arm, gray_image, gray_array)), arm, 'word_level')
+        if attempted is not None:
+            attempted.append(arm)
+        if is_confident(best[1]):
+            break
+    
+    return best
+
+def get_ocr_executor():
+    """
+    Per-worker executor shared by all request threads, sized to the worker's CPU share
+    """
+    global _ocr_executor, _ocr_executor_pid
+    if _ocr_executor_pid != os.getpid():
+        with _ocr_executor_lock:
+            if _ocr_executor_pid != os.getpid():
+                _ocr_executor = ThreadPoolExecutor(max_workers=OCR_CPU_BUDGET, thread_name_prefix='ocr')
+                _ocr_executor_pid = os.getpid()
+    return _ocr_executor
+
+def run_ocr_concurrent(preprocessing_methods, best=("", None), attempted=None):
+    """
+    OCR the (name, image) preprocessing variants in parallel.
+    Variants are pulled from the iterable only as attempts finish, so a lazy
+    generator builds no more buffers than there are attempts running.
+    The first attempt with a confident (checksum-valid) number wins; queued attempts
+    are cancelled and results of attempts still running are dropped.
+    """
+    attempts = iter(preprocessing_methods)
+    exhausted = False
+    executor = get_ocr_executor()
+    pending = {}
+    
+    try:
+        while not exhausted or pending:
+            while not exhausted and len(pending) < OCR_REQUEST_PARALLELISM:
+                attempt = next(attempts, None)
+                if attempt is None:
+                    exhausted = True
+                    break
+                method_name, attempt_image = attempt
+                # The copied context carries this request's timing breakdown into the OCR thread
+                context = contextvars.copy_context()
+                pending[executor.submit(context.run, ocr_attempt, attempt_image)] = method_name
+            if not pending:
+                break
+            
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                method_name = pending.pop(future)
+                best = consider(best, future.result(), method_name, 'word_level')
+                if attempted is not None:
+                    attempted.append(method_name)
+                if is_confident(best[1]):
+                    return best
+    finally:
+        for future in pending:
+            future.cancel()
+    
+    return best
+
+def confirm_number(gray_image, number):
+    """
+    True when a quick read of the number line of this image yields `number`: the
+    template reader first, then one single-line Tesseract pass over the same crops
+    """
+    gray_array = np.asarray(rectify_image(gray_image)[0]) if OCR_RECTIFY else np.asarray(gray_image)
+    crops = number_crops(gray_array)
+    best = run_glyph_ocr(crops)
+    if best[1] and best[1][2] and best[1][2].number == number:
+        return True
+    if not TESSERACT_AVAILABLE:
+        return False
+    try:
+        best = run_roi_ocr(gray_array, ("", None), crops)
+    except Exception as e:
+        print(f"Tesseract error: {e}")
+        return False
+    return bool(best[1] and best[1][2] and best[1][2].number == number)
+
+def recognize_gray(gray_image, concurrent=None, cancelled=None):
+    """
+    Run the OCR pipeline on a decoded grayscale image and build the response payload.
+    `concurrent` overrides OCR_CONCURRENT for this image. `cancelled`, a callable,
+    is polled between OCR passes; once it returns true the remaining passes are
+    skipped and Cancelled is raised.
+    """
+    if concurrent is None:
+        concurrent = OCR_CONCURRENT
+    
+    # Warp the card upright once; every crop and preprocessing variant below starts from it
+    geometry = None
+    if OCR_RECTIFY:
+        with metrics.timed('ocr_stage_seconds', stage='rectify'):
+            gray_image, geometry = rectify_image(gray_image)
+    
+    # Convert to numpy array for OpenCV operations (single conversion)
+    gray_array = np.array(gray_image)
+    
+    attempted = []
+    # Number-line crops are located once and shared by the template reader and the ROI arm
+    crops = number_crops(gray_array, geometry) if OCR_FAST_PATH or OCR_ROI or not TESSERACT_AVAILABLE else None
+    
+    # Template matching: a few milliseconds, and the only reader without Tesseract
+    glyph_best = ("", None)
+    if OCR_FAST_PATH or not TESSERACT_AVAILABLE:
+        glyph_best = run_glyph_ocr(crops)
+        attempted.append('glyphs')
+    best = glyph_best
+    
+    if TESSERACT_AVAILABLE and not fast_path_accepted(glyph_best[1]):
+        try:
+            if cancelled is not None and cancelled():
+                raise Cancelled()
+            with metrics.timed('ocr_stage_seconds', stage='features'):
+                features = image_features(gray_array)
+            arms = attempt_scheduler.order(features['context'], OCR_ARMS)
+            best = ("", None)
+            
+            if concurrent:
+                # ROI crops are small; run them first, then the full-frame variants in parallel
+                if 'roi' in arms:
+                    best = run_roi_ocr(gray_array, best, crops)
+                    attempted.append('roi')
+                if not is_confident(best[1]):
+                    if cancelled is not None and cancelled():
+                        raise Cancelled()
+                    variants = [arm for arm in arms if arm != 'roi']
+                    best = run_ocr_concurrent(build_preprocessing_methods(gray_image, gray_array, variants), best, attempted)
+            else:
+                best = run_ocr_sequential(arms, gray_image, gray_array, best, attempted, crops, cancelled)
+            
+            winner = best[1][0] if is_confident(best[1]) else None
+            attempt_scheduler.record(features['context'], attempted, winner)
+                        
+        except Cancelled:
+            metrics.inc('ocr_images_total', outcome='cancelled')
+            raise
+        except Exception as tesseract_error:
+            print(f"Tesseract error: {tesseract_error}")
+            metrics.inc('ocr_failures_total', reason='tesseract_error')
+            if crops is None:
+                crops = number_crops(gray_array, geometry)
+            if 'glyphs' not in attempted:
+                glyph_best = run_glyph_ocr(crops)
+                attempted.append('glyphs')
+            best = glyph_best
+        
+        # Tesseract found no number: keep the template read if it had one
+        if not (best[1] and best[1][2]) and glyph_best[1] and glyph_best[1][2]:
+            best = glyph_best
+    
+    text, best_result = best
+    if best_result and best_result[0] == 'glyphs':
+        method = 'digit_templates'
+    else:
+        method = 'tesseract' if TESSERACT_AVAILABLE else 'fallback'
+    
+    candidate = best_result[2] if best_result and best_result[2] else best_candidate(text)
+    
+    if candidate:
+        candidates = generate_candidates(text)
+        # The patient number is never derived from the national number; report one only if it was read on its own
+        patient = candidate if candidate.national_number is None else next(
+            (c for c in candidates if c.source == 'ten_digits'), None)
+        response_data = {
+            'success': True,
+            'patient_number': patient.number if patient else None,
+            'confidence': round(candidate.confidence, 3),
+            'checksum_valid': candidate.checksum_valid,
+            'raw_text': text,
+            'method': method,
+            'candidates': [
+                {'national_number' if c.national_number else 'patient_number': c.number,
+                 'confidence': round(c.confidence, 3)}
+                for c in candidates[:3]
+            ],
+        }
+        
+        if candidate.national_number:
+            response_data['national_number'] = candidate.national_number
+        
+        if attempted:
+            response_data['attempts'] = attempted
+        
+        if geometry is not None:
+            response_data['geometry'] = geometry.to_dict()
+        
+        if best_result:
+            response_data['preprocessing'] = best_result[0]
+            response_data['ocr_config'] = best_result[1]
+            response_data['ocr_confidence'] = round(best_result[3], 3)
+        
+        metrics.inc('ocr_images_total', outcome='success')
+        metrics.inc('ocr_winner_total', arm=best_result[0] if best_result else 'fallback')
+        return response_data
+    
+    metrics.inc('ocr_images_total', outcome='no_number')
+    metrics.inc('ocr_failures_total', reason='no_number')
+    
+    # Provide helpful feedback about what was found
+    found_numbers = re.findall(r'\d+', text)
+    all_digits = re.sub(r'\D', '', text)
+    
+    return {
+        'success': False,
+        'message': 'No 10-digit patient number found',
+        'raw_text': text,
+        'method': method,
+        'found_numbers': found_numbers,
+        'total_digits': len(all_digits),
+        'suggestion': 'Try a clearer image or ensure the patient number is clearly visible',
+    }
+
+def recognize_upload(image_data, concurrent=None, preflight=None):
+    """
+    Cache lookup, decode, quality preflight and OCR for one uploaded image (bytes or
+    binary file). `preflight` overrides OCR_PREFLIGHT for this image. The result is
+    queued for the scan store when that is enabled.
+    Raises ImageTooLarge for images over the pixel limit.
+    """
+    with metrics.request() as timings:
+        # The request scope may have started earlier, e.g. before the upload was read
+        started = time.perf_counter()
+        if scan_store.keep_images and hasattr(image_data, 'read'):
+            # The stored copy needs the bytes; read the file once here
+            image_data = image_data.read()
+        
+        # Identical uploads (re-scans of the same photo) are answered from the shared cache
+        with metrics.timed('ocr_stage_seconds', stage='cache_lookup'):
+            cache_key = content_key(image_data)
+            cached = result_cache.get(cache_key)
+        if cached is not None:
+            metrics.inc('ocr_images_total', outcome='cached')
+            response_data = dict(cached, cached=True)
+        else:
+            # Decoding and OCR are CPU-bound: wait for one of this worker's OCR slots
+            with ocr_slots.hold():
+                response_data = _recognize_uncached(image_data, cache_key, concurrent,
+                                                    PREFLIGHT_ENABLED if preflight is None else preflight)
+        
+        pipeline_ms = round((time.perf_counter() - started) * 1000, 2)
+        scan_store.record(cache_key, response_data, dict(timings.to_dict(), pipeline_ms=pipeline_ms), image_data)
+        return response_data
+
+def _recognize_uncached(image_data, cache_key, concurrent, preflight):
+    # Decode straight to a size-capped grayscale image; no full-resolution RGB copy
+    rss_before = peak_rss_mb()
+    with metrics.timed('ocr_stage_seconds', stage='decode'):
+        gray_image, decode_info = decode_grayscale(image_data)
+    del image_data
+    
+    # Blurry, badly exposed or card-less photos fail in milliseconds instead of after every OCR pass
+    if preflight:
+        with metrics.timed('ocr_stage_seconds', stage='preflight'):
+            report = preflight_check(np.asarray(gray_image))
+        if not report['ok']:
+            metrics.inc('ocr_images_total', outcome='rejected')
+            metrics.inc('ocr_failures_total', reason=f"preflight_{report['failures'][0]}")
+            return {
+                'success': False,
+                'message': report['message'],
+                'suggestion': report['suggestion'],
+                'preflight': report,
+            }
+    
+    # Near-identical frames, when perceptual matching is enabled. The hash cannot tell two
+    # cards of the same design apart, so the cached number is only used once read again here.
+    phash = None
+    if result_cache.perceptual:
+        with metrics.timed('ocr_stage_seconds', stage='perceptual_lookup'):
+            phash = perceptual_hash(gray_image)
+            cached = result_cache.get_similar(phash)
+        if cached is not None and cached.get('success'):
+            with metrics.timed('ocr_stage_seconds', stage='perceptual_confirm'):
+                confirmed = confirm_number(gray_image, read_number(cached))
+            if confirmed:
+                metrics.inc('ocr_images_total', outcome='cached')
+                result_cache.put(cache_key, cached, phash)
+                return dict(cached, cached=True)
+            metrics.inc('ocr_failures_total', reason='perceptual_unconfirmed')
+    
+    response_data = recognize_gray(gray_image, concurrent)
+    with metrics.timed('ocr_stage_seconds', stage='cache_store'):
+        result_cache.put(cache_key, response_data, phash)
+    
+    peak_rss = peak_rss_mb()
+    response_data['memory'] = dict(decode_info, peak_rss_mb=peak_rss, peak_rss_growth_mb=round(peak_rss - rss_before, 1))
+    
+    return response_data
+
+def to_grayscale(image):
+    """
+    Grayscale PIL image from a PIL image or a NumPy array (OpenCV BGR/BGRA or single channel)
+    """
+    if isinstance(image, np.ndarray):
+        if image.ndim == 3 and image.shape[2] == 4:
+            image = cv2.cvtColor(image, cv2.COLOR_BGRA2GRAY)
+        elif image.ndim == 3:
+            image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+        return Image.fromarray(image.astype(np.uint8, copy=False))
+    return image if image.mode == 'L' else image.convert('L')
+
+def recognize(image, concurrent=None):
+    """
+    Patient number result for one image: a file path, encoded bytes, a binary
+    file object, a PIL image or a NumPy array. Encoded inputs go through the
+    size-capped decoder and the result cache; decoded images are OCR'd as given.
+    Raises ImageTooLarge for encoded images over the pixel limit.
+    """
+    if isinstance(image, (str, os.PathLike)):
+        with open(image, 'rb') as f:
+            return recognize_upload(f, concurrent)
+    if isinstance(image, (Image.Image, np.ndarray)):
+        with metrics.request(), ocr_slots.hold():
+            with metrics.timed('ocr_stage_seconds', stage='grayscale'):
+                gray_image = to_grayscale(image)
+            return recognize_gray(gray_image, concurrent)
+    return recognize_upload(image, concurrent)
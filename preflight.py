@@ -0,0 +1,97 @@
+"""
+Image-quality preflight: cheap checks that reject hopeless photos before OCR.
+
+All measurements run on a PREFLIGHT_WIDTH-wide grayscale copy and take a few
+milliseconds: focus (variance of the Laplacian), exposure (mean brightness),
+glare (fraction of clipped pixels), text-line density (the text-region filter
+from regions.py) and whether a card outline is visible. A photo failing any
+check is answered with the reason and a suggestion for the next shot, instead
+of several seconds of OCR passes that cannot succeed.
+"""
+import os
+
+import cv2
+import numpy as np
+
+from regions import find_card_outline, find_text_lines
+
+PREFLIGHT_ENABLED = os.environ.get('OCR_PREFLIGHT', 'true').lower() in ('1', 'true', 'yes')
+PREFLIGHT_WIDTH = int(os.environ.get('OCR_PREFLIGHT_WIDTH', 640))
+
+# Thresholds; the defaults only reject photos the OCR passes cannot read
+PREFLIGHT_MIN_SHARPNESS = float(os.environ.get('OCR_PREFLIGHT_MIN_SHARPNESS', 15))
+PREFLIGHT_MIN_BRIGHTNESS = float(os.environ.get('OCR_PREFLIGHT_MIN_BRIGHTNESS', 35))
+PREFLIGHT_MAX_BRIGHTNESS = float(os.environ.get('OCR_PREFLIGHT_MAX_BRIGHTNESS', 245))
+PREFLIGHT_MAX_GLARE = float(os.environ.get('OCR_PREFLIGHT_MAX_GLARE', 0.5))
+# Without a visible card outline, at least this many text lines must be found. A close-up of
+# the number line alone shows one line and no card, so by default only an empty photo fails.
+PREFLIGHT_MIN_TEXT_LINES = int(os.environ.get('OCR_PREFLIGHT_MIN_TEXT_LINES', 1))
+
+# Pixel value at and above which a pixel counts as clipped
+GLARE_LEVEL = 250
+
+# reason: (message, suggestion), in the order the checks are reported
+FAILURES = {
+    'blurry': ('Image is out of focus', 'Hold the phone steady and tap the card to focus'),
+    'too_dark': ('Image is too dark', 'Add light or move away from shadows'),
+    'overexposed': ('Image is overexposed', 'Reduce light or turn off the flash'),
+    'glare': ('Glare covers too much of the image', 'Tilt the card slightly to move the reflection'),
+    'no_text': ('No card or text found in the image', 'Fill the frame with the card, number side up'),
+}
+
+
+def laplacian_sharpness(gray_array, width=PREFLIGHT_WIDTH):
+    """
+    Variance of the Laplacian at a fixed width, so the score does not depend on image size
+    """
+    height, full_width = gray_array.shape[:2]
+    if full_width > width:
+        gray_array = cv2.resize(gray_array, (width, max(1, round(height * width / full_width))),
+                                interpolation=cv2.INTER_AREA)
+    return float(cv2.Laplacian(gray_array, cv2.CV_64F).var())
+
+
+def preflight_check(gray_array):
+    """
+    Quality report for a grayscale image: {'ok', 'failures', 'checks'}, plus
+    'message' and 'suggestion' for the first failure
+    """
+    height, width = gray_array.shape[:2]
+    if width > PREFLIGHT_WIDTH:
+        small = cv2.resize(gray_array, (PREFLIGHT_WIDTH, max(1, round(height * PREFLIGHT_WIDTH / width))),
+                           interpolation=cv2.INTER_AREA)
+    else:
+        small = gray_array
+
+    sharpness = laplacian_sharpness(small)
+    brightness = float(small.mean())
+    glare = float(np.count_nonzero(small >= GLARE_LEVEL)) / small.size
+    text_lines = len(find_text_lines(small)[0])
+    card = find_card_outline(small) is not None
+
+    failures = []
+    if sharpness < PREFLIGHT_MIN_SHARPNESS:
+        failures.append('blurry')
+    if brightness < PREFLIGHT_MIN_BRIGHTNESS:
+        failures.append('too_dark')
+    elif brightness > PREFLIGHT_MAX_BRIGHTNESS:
+        failures.append('overexposed')
+    elif glare > PREFLIGHT_MAX_GLARE:
+        failures.append('glare')
+    if text_lines == 0 or (not card and text_lines < PREFLIGHT_MIN_TEXT_LINES):
+        failures.append('no_text')
+
+    report = {
+        'ok': not failures,
+        'failures': failures,
+        'checks': {
+            'sharpness': round(sharpness, 1),
+            'brightness': round(brightness, 1),
+            'glare_fraction': round(glare, 3),
+            'text_lines': text_lines,
+            'card_detected': card,
+        },
+    }
+    if failures:
+        report['message'], report['suggestion'] = FAILURES[failures[0]]
+    return report
@@ -0,0 +1,168 @@
+"""
+Region-of-interest detection for the patient number line.
+
+Finds text-line boxes with the same contour filter the fallback OCR uses and
+ranks them by how much they look like a `XX.XX.XX-XXX.XX` card number, so
+Tesseract only has to read a few small strips instead of the whole photo.
+"""
+import cv2
+import numpy as np
+from PIL import Image
+
+# Detection runs on a copy no wider than this; boxes are mapped back to full size
+DETECTION_WIDTH = 1600
+
+# Glyphs in "39.12.17-193.06": 11 digits + 4 separators
+EXPECTED_GLYPHS = 15
+# Width / height of that line in common card fonts
+EXPECTED_ASPECT = 8.0
+
+# Crops are rescaled so the text is about this tall before OCR
+CROP_TEXT_HEIGHT = 48
+CROP_PADDING = 0.25
+
+
+def is_text_region(w, h):
+    """
+    Bounding-box filter for text-like regions
+    """
+    return w > 30 and h > 8 and 2 <= w / h <= 15
+
+
+def find_text_regions(binary, nested=False):
+    """
+    Bounding boxes of text-like contours in a binary image (text = white).
+    With `nested`, blobs inside other blobs (text inside a card border) count too.
+    """
+    mode = cv2.RETR_CCOMP if nested else cv2.RETR_EXTERNAL
+    contours, hierarchy = cv2.findContours(binary, mode, cv2.CHAIN_APPROX_SIMPLE)
+
+    text_regions = []
+    for i, contour in enumerate(contours):
+        # RETR_CCOMP: skip hole boundaries, keep outer boundaries at any depth
+        if nested and hierarchy[0][i][3] != -1:
+            continue
+        x, y, w, h = cv2.boundingRect(contour)
+        if is_text_region(w, h):
+            text_regions.append((x, y, w, h))
+
+    text_regions.sort(key=lambda r: (r[1], r[0]))
+    return text_regions
+
+
+def text_line_mask(small):
+    """
+    Binary glyph mask (text = white) of a detection-size image, and the same
+    mask with the glyphs of each line merged into one blob
+    """
+    # Black-hat keeps dark strokes narrower than the kernel, so a global otsu split
+    # separates text from card stock instead of the card from the table around it
+    stroke_kernel = max(9, small.shape[0] // 30) | 1
+    blackhat = cv2.morphologyEx(small, cv2.MORPH_BLACKHAT,
+                                cv2.getStructuringElement(cv2.MORPH_RECT, (stroke_kernel, stroke_kernel)))
+    _, binary = cv2.threshold(blackhat, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
+
+    # Merge the glyphs of a line into one blob, wide enough to bridge the "." and "-" gaps.
+    # The image height gives a floor; large text (a close-up or rectified card) needs
+    # a kernel sized from the glyphs themselves
+    char_height = max(3, small.shape[0] // 100)
+    heights = cv2.connectedComponentsWithStats(binary, connectivity=8)[2][1:, cv2.CC_STAT_HEIGHT]
+    heights = heights[(heights >= 2 * char_height) & (heights <= small.shape[0] // 8)]
+    gap = max(char_height * 3, int(np.median(heights)) if len(heights) else 0)
+    kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (gap, max(1, char_height // 3)))
+    return binary, cv2.morphologyEx(binary, cv2.MORPH_CLOSE, kernel)
+
+
+def find_text_lines(gray_array):
+    """
+    Text-line boxes on a downscaled detection copy, with the copy's binary
+    mask (text = white) and its scale relative to the full image
+    """
+    height, width = gray_array.shape[:2]
+    scale = min(1.0, DETECTION_WIDTH / float(width))
+    small = gray_array if scale == 1.0 else cv2.resize(
+        gray_array, (int(width * scale), int(height * scale)), interpolation=cv2.INTER_AREA)
+
+    binary, lines = text_line_mask(small)
+    return find_text_regions(lines, nested=True), binary, scale
+
+
+def find_card_outline(gray_array, min_area=0.1):
+    """
+    Corners (4x2 float array) of the largest convex quadrilateral outline covering
+    at least `min_area` of the image, or None when no card edge is visible
+    """
+    edges = cv2.Canny(cv2.GaussianBlur(gray_array, (5, 5), 0), 30, 90)
+    # Close small breaks in the card edge so it comes out as one contour
+    edges = cv2.dilate(edges, np.ones((3, 3), np.uint8))
+    contours, _ = cv2.findContours(edges, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+
+    image_area = float(gray_array.shape[0] * gray_array.shape[1])
+    for contour in sorted(contours, key=cv2.contourArea, reverse=True)[:5]:
+        if cv2.contourArea(contour) < min_area * image_area:
+            break
+        outline = cv2.approxPolyDP(cv2.convexHull(contour), 0.02 * cv2.arcLength(contour, True), True)
+        if len(outline) == 4:
+            return outline.reshape(4, 2).astype(np.float32)
+    return None
+
+
+def score_region(binary, box):
+    """
+    Likelihood that a text-line box holds the patient number, from glyph
+    count, line aspect ratio and glyph height consistency
+    """
+    x, y, w, h = box
+    glyphs = cv2.connectedComponentsWithStats(binary[y:y + h, x:x + w], connectivity=8)[2][1:]
+
+    # Digits are at least half the line height; dots and dashes are counted but not sized
+    heights = glyphs[:, cv2.CC_STAT_HEIGHT] if len(glyphs) else np.array([])
+    digits = heights[heights >= 0.5 * h]
+    if len(digits) < 4:
+        return 0.0
+
+    count_score = np.exp(-abs(len(glyphs) - EXPECTED_GLYPHS) / 5.0)
+    aspect_score = np.exp(-abs(np.log((w / h) / EXPECTED_ASPECT)))
+    height_score = 1.0 / (1.0 + np.std(digits) / max(1.0, np.mean(digits)) * 5.0)
+
+    return float(count_score * aspect_score * height_score)
+
+
+def rank_number_regions(gray_array, max_regions=3):
+    """
+    Top candidate boxes (x, y, w, h) in full-resolution coordinates, best first
+    """
+    boxes, binary, scale = find_text_lines(gray_array)
+
+    scored = [(score_region(binary, box), box) for box in boxes]
+    scored = [item for item in scored if item[0] > 0]
+    scored.sort(key=lambda item: item[0], reverse=True)
+
+    return [
+        (score, tuple(int(round(v / scale)) for v in box))
+        for score, box in scored[:max_regions]
+    ]
+
+
+def crop_region(gray_array, box):
+    """
+    Padded grayscale crop of a box, rescaled to CROP_TEXT_HEIGHT text height
+    """
+    x, y, w, h = box
+    pad = int(h * CROP_PADDING)
+    x0, y0 = max(0, x - pad), max(0, y - pad)
+    x1 = min(gray_array.shape[1], x + w + pad)
+    y1 = min(gray_array.shape[0], y + h + pad)
+    crop = gray_array[y0:y1, x0:x1]
+
+    factor = CROP_TEXT_HEIGHT / float(max(1, h))
+    interpolation = cv2.INTER_AREA if factor < 1 else cv2.INTER_CUBIC
+    crop = cv2.resize(crop, None, fx=factor, fy=factor, interpolation=interpolation)
+    return Image.fromarray(crop)
+
+
+def number_region_crops(gray_array, max_regions=3):
+    """
+    Crops of the most likely patient-number lines, best first
+    """
+    return [(box, crop_region(gray_array, box)) for _, box in rank_number_regions(gray_array, max_regions)]
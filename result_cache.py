@@ -0,0 +1,210 @@
+"""
+OCR result cache shared by all gunicorn workers on a host.
+
+Entries live in a small SQLite database on /dev/shm, so every preforked worker
+sees the same entries and counters. Lookups are keyed by a SHA-256 of the
+uploaded image bytes; optionally a 64-bit difference hash of the decoded
+grayscale image also finds near-identical frames. A 9x8 hash cannot see the
+printed digits, so two patients' cards of the same design can match: a
+perceptual match is only a hint, returned by the pipeline once a read of the
+new image confirms the cached number.
+Eviction is least-recently-used, bounded by entry count and total payload
+size, and entries expire after a TTL.
+"""
+import hashlib
+import json
+import os
+import sqlite3
+import time
+
+import numpy as np
+from PIL import Image
+
+from shm_db import connect, shared_dir
+
+CACHE_ENABLED = os.environ.get('OCR_CACHE', 'true').lower() in ('1', 'true', 'yes')
+CACHE_PATH = os.environ.get('OCR_CACHE_PATH', os.path.join(shared_dir(), 'ocr-result-cache.sqlite'))
+CACHE_TTL = float(os.environ.get('OCR_CACHE_TTL', 600))
+CACHE_MAX_ENTRIES = int(os.environ.get('OCR_CACHE_MAX_ENTRIES', 512))
+CACHE_MAX_BYTES = int(os.environ.get('OCR_CACHE_MAX_BYTES', 4 * 1024 * 1024))
+CACHE_PERCEPTUAL = os.environ.get('OCR_CACHE_PERCEPTUAL', 'false').lower() in ('1', 'true', 'yes')
+# Max differing bits between two difference hashes for frames to count as the same card shot
+CACHE_PHASH_DISTANCE = int(os.environ.get('OCR_CACHE_PHASH_DISTANCE', 4))
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+    key TEXT PRIMARY KEY,
+    phash INTEGER,
+    response TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    created REAL NOT NULL,
+    accessed REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS entries_accessed ON entries (accessed);
+CREATE TABLE IF NOT EXISTS counters (
+    name TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+"""
+
+
+def content_key(image_data):
+    """
+    SHA-256 of upload bytes or of a seekable binary file, which is rewound afterwards
+    """
+    if hasattr(image_data, 'read'):
+        digest = hashlib.file_digest(image_data, 'sha256').hexdigest()
+        image_data.seek(0)
+        return digest
+    return hashlib.sha256(image_data).hexdigest()
+
+
+def perceptual_hash(gray_image):
+    """
+    64-bit difference hash: sign of horizontal gradients on a 9x8 thumbnail
+    """
+    thumb = np.asarray(gray_image.resize((9, 8), Image.BILINEAR), dtype=np.int16)
+    bits = (thumb[:, 1:] > thumb[:, :-1]).flatten()
+    value = 0
+    for bit in bits:
+        value = (value << 1) | int(bit)
+    # SQLite integers are signed 64-bit
+    return value - (1 << 64) if value >= (1 << 63) else value
+
+
+def hamming(a, b):
+    return bin((a ^ b) & 0xFFFFFFFFFFFFFFFF).count('1')
+
+
+class ResultCache:
+    """
+    LRU/TTL cache of process_ocr responses in a file-backed SQLite store
+    """
+
+    def __init__(self, path=CACHE_PATH, ttl=CACHE_TTL, max_entries=CACHE_MAX_ENTRIES,
+                 max_bytes=CACHE_MAX_BYTES, perceptual=CACHE_PERCEPTUAL, enabled=CACHE_ENABLED):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.perceptual = enabled and perceptual
+        self.enabled = enabled
+
+    def _connect(self):
+        return connect(self.path, SCHEMA)
+
+    def _count(self, conn, name):
+        conn.execute(
+            'INSERT INTO counters (name, value) VALUES (?, 1) '
+            'ON CONFLICT(name) DO UPDATE SET value = value + 1', (name,))
+
+    def get(self, key):
+        """
+        Cached response for an exact content key, or None
+        """
+        if not self.enabled:
+            return None
+        try:
+            conn = self._connect()
+            now = time.time()
+            row = conn.execute(
+                'SELECT response FROM entries WHERE key = ? AND created >= ?',
+                (key, now - self.ttl)).fetchone()
+            if row is None:
+                if not self.perceptual:
+                    self._count(conn, 'misses')
+                return None
+            conn.execute('UPDATE entries SET accessed = ? WHERE key = ?', (now, key))
+            self._count(conn, 'hits')
+            return json.loads(row[0])
+        except sqlite3.Error as e:
+            print(f"Result cache error: {e}")
+            return None
+
+    def get_similar(self, phash):
+        """
+        Cached response for the closest perceptual hash within CACHE_PHASH_DISTANCE, or None.
+        Only a hint: the number must be confirmed on the new image before it is used.
+        """
+        if not self.perceptual:
+            return None
+        try:
+            conn = self._connect()
+            now = time.time()
+            rows = conn.execute(
+                'SELECT key, phash FROM entries WHERE phash IS NOT NULL AND created >= ?',
+                (now - self.ttl,)).fetchall()
+            best = min(rows, key=lambda row: hamming(row[1], phash), default=None)
+            if best is None or hamming(best[1], phash) > CACHE_PHASH_DISTANCE:
+                self._count(conn, 'misses')
+                return None
+            row = conn.execute('SELECT response FROM entries WHERE key = ?', (best[0],)).fetchone()
+            if row is None:
+                self._count(conn, 'misses')
+                return None
+            conn.execute('UPDATE entries SET accessed = ? WHERE key = ?', (now, best[0]))
+            self._count(conn, 'perceptual_hits')
+            return json.loads(row[0])
+        except sqlite3.Error as e:
+            print(f"Result cache error: {e}")
+            return None
+
+    def put(self, key, response, phash=None):
+        """
+        Store a response and evict expired and least-recently-used entries past the bounds
+        """
+        if not self.enabled:
+            return
+        payload = json.dumps(response)
+        if len(payload) > self.max_bytes:
+            return
+        try:
+            conn = self._connect()
+            now = time.time()
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                conn.execute(
+                    'INSERT OR REPLACE INTO entries (key, phash, response, size, created, accessed) '
+                    'VALUES (?, ?, ?, ?, ?, ?)', (key, phash, payload, len(payload), now, now))
+                conn.execute('DELETE FROM entries WHERE created < ?', (now - self.ttl,))
+                conn.execute(
+                    'DELETE FROM entries WHERE key IN ('
+                    '  SELECT key FROM entries ORDER BY accessed DESC LIMIT -1 OFFSET ?)',
+                    (self.max_entries,))
+                total = conn.execute('SELECT COALESCE(SUM(size), 0) FROM entries').fetchone()[0]
+                while total > self.max_bytes:
+                    oldest = conn.execute(
+                        'SELECT key, size FROM entries ORDER BY accessed LIMIT 1').fetchone()
+                    conn.execute('DELETE FROM entries WHERE key = ?', (oldest[0],))
+                    total -= oldest[1]
+                conn.execute('COMMIT')
+            except Exception:
+                conn.execute('ROLLBACK')
+                raise
+        except sqlite3.Error as e:
+            print(f"Result cache error: {e}")
+
+    def stats(self):
+        if not self.enabled:
+            return {'enabled': False}
+        try:
+            conn = self._connect()
+            counters = dict(conn.execute('SELECT name, value FROM counters').fetchall())
+            entries, size = conn.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries').fetchone()
+        except sqlite3.Error as e:
+            return {'enabled': True, 'error': str(e)}
+        return {
+            'enabled': True,
+            'perceptual': self.perceptual,
+            'hits': counters.get('hits', 0),
+            'perceptual_hits': counters.get('perceptual_hits', 0),
+            'misses': counters.get('misses', 0),
+            'entries': entries,
+            'bytes': size,
+            'max_entries': self.max_entries,
+            'max_bytes': self.max_bytes,
+            'ttl_seconds': self.ttl,
+        }
+
+
+result_cache = ResultCache()
@@ -0,0 +1,269 @@
+"""
+Write-behind store of scan results, for auditing and for replaying real traffic.
+
+When enabled, every image through recognize_upload is recorded with the
+SHA-256 of its bytes, the winning preprocessing and OCR config, the number,
+its candidates, the per-stage timings and the full response. With
+OCR_SCAN_STORE_IMAGES the image bytes are kept too, once per hash, so
+benchmarks/replay.py can run them through the current pipeline again.
+
+Requests only put the record on an in-memory queue. A background thread per
+process writes the queue to SQLite in batches of up to OCR_SCAN_STORE_BATCH
+rows per transaction, at least every OCR_SCAN_STORE_FLUSH_SECONDS, and
+deletes scans and images past their retention. When the queue is full,
+records are dropped and counted rather than slowing down the request.
+"""
+import atexit
+import json
+import os
+import queue
+import sqlite3
+import threading
+import time
+
+from metrics import metrics
+from shm_db import connect
+
+STORE_ENABLED = os.environ.get('OCR_SCAN_STORE', 'false').lower() in ('1', 'true', 'yes')
+# Audit data should outlive the container's /dev/shm: point this at a persistent disk
+STORE_PATH = os.environ.get('OCR_SCAN_STORE_PATH', 'ocr-scans.sqlite')
+STORE_IMAGES = os.environ.get('OCR_SCAN_STORE_IMAGES', 'false').lower() in ('1', 'true', 'yes')
+# Days to keep scans and images; 0 keeps them forever
+STORE_RETENTION_DAYS = float(os.environ.get('OCR_SCAN_STORE_RETENTION_DAYS', 90))
+STORE_IMAGE_RETENTION_DAYS = float(os.environ.get('OCR_SCAN_STORE_IMAGE_RETENTION_DAYS', 7))
+STORE_BATCH = int(os.environ.get('OCR_SCAN_STORE_BATCH', 200))
+STORE_FLUSH_SECONDS = float(os.environ.get('OCR_SCAN_STORE_FLUSH_SECONDS', 1))
+STORE_QUEUE_SIZE = int(os.environ.get('OCR_SCAN_STORE_QUEUE', 2000))
+
+# Retention is applied by the writer thread this often
+PRUNE_SECONDS = 3600
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS scans (
+    id INTEGER PRIMARY KEY,
+    created REAL NOT NULL,
+    image_hash TEXT NOT NULL,
+    success INTEGER NOT NULL,
+    cached INTEGER NOT NULL,
+    patient_number TEXT,
+    national_number TEXT,
+    checksum_valid INTEGER,
+    confidence REAL,
+    method TEXT,
+    preprocessing TEXT,
+    ocr_config TEXT,
+    total_ms REAL,
+    pipeline_ms REAL,
+    queue_ms REAL,
+    engine_calls INTEGER,
+    candidates TEXT NOT NULL,
+    timings TEXT NOT NULL,
+    response TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS scans_created ON scans (created);
+CREATE INDEX IF NOT EXISTS scans_image_hash ON scans (image_hash);
+CREATE TABLE IF NOT EXISTS images (
+    hash TEXT PRIMARY KEY,
+    created REAL NOT NULL,
+    data BLOB NOT NULL
+);
+CREATE INDEX IF NOT EXISTS images_created ON images (created);
+"""
+
+
+def scan_row(created, image_hash, response, timings):
+    """
+    Values of one scans row, in column order after id
+    """
+    candidates = response.get('candidates') or [
+        {'patient_number': number} for number in response.get('found_numbers', [])]
+    return (
+        created, image_hash, int(bool(response.get('success'))), int(bool(response.get('cached'))),
+        response.get('patient_number'), response.get('national_number'),
+        None if response.get('checksum_valid') is None else int(response['checksum_valid']),
+        response.get('confidence'), response.get('method'), response.get('preprocessing'),
+        response.get('ocr_config'), timings.get('total_ms'), timings.get('pipeline_ms'), timings.get('queue_ms'),
+        timings.get('engine_calls'), json.dumps(candidates), json.dumps(timings.get('stages', [])),
+        json.dumps(response),
+    )
+
+
+class ScanStore:
+    """
+    Scan records in a SQLite file, written behind the request path by one thread per process
+    """
+
+    def __init__(self, path=STORE_PATH, enabled=STORE_ENABLED, keep_images=STORE_IMAGES,
+                 retention_days=STORE_RETENTION_DAYS, image_retention_days=STORE_IMAGE_RETENTION_DAYS):
+        self.path = path
+        self.enabled = enabled
+        self.keep_images = enabled and keep_images
+        self.retention = retention_days * 86400
+        self.image_retention = image_retention_days * 86400
+        self._lock = threading.Lock()
+        # Serialises the writer thread with flush() calls from other threads
+        self._write_lock = threading.Lock()
+        self._pid = None
+        self._queue = None
+        self._last_prune = 0.0
+        self.dropped = 0
+
+    def _connect(self):
+        # Audit data on disk: fsync at WAL checkpoints, and a longer lock wait than the /dev/shm files
+        return connect(self.path, SCHEMA, synchronous='NORMAL', timeout=30,
+                       migrations=('ALTER TABLE scans ADD COLUMN national_number TEXT',
+                                   'ALTER TABLE scans ADD COLUMN pipeline_ms REAL'))
+
+    def _ensure_process(self):
+        # Records queued in the master at fork time belong to the master
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._queue = queue.Queue(maxsize=STORE_QUEUE_SIZE)
+            self.dropped = 0
+            self._pid = os.getpid()
+            threading.Thread(target=self._write_loop, name='ocr-scan-store', daemon=True).start()
+
+    def record(self, image_hash, response, timings, image_data=None):
+        """
+        Queue one scan: its content hash, response dict, timing breakdown
+        (RequestTimings.to_dict(), plus pipeline_ms: the time spent in the pipeline
+        itself) and, when images are kept, the image bytes
+        """
+        if not self.enabled:
+            return
+        self._ensure_process()
+        item = (time.time(), image_hash, response, timings, image_data if self.keep_images else None)
+        try:
+            self._queue.put_nowait(item)
+        except queue.Full:
+            self.dropped += 1
+            metrics.inc('ocr_scan_store_rows_total', outcome='dropped')
+
+    def _write_loop(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + STORE_FLUSH_SECONDS
+            while len(batch) < STORE_BATCH:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            self._write(batch)
+            if time.time() - self._last_prune >= PRUNE_SECONDS:
+                self.prune()
+
+    def _write(self, batch):
+        rows = [scan_row(created, image_hash, response, timings)
+                for created, image_hash, response, timings, _ in batch]
+        images = [(image_hash, created, image_data)
+                  for created, image_hash, _, _, image_data in batch if image_data is not None]
+        with self._write_lock:
+            try:
+                conn = self._connect()
+                conn.execute('BEGIN IMMEDIATE')
+                try:
+                    conn.executemany(
+                        'INSERT INTO scans (created, image_hash, success, cached, patient_number, national_number, '
+                        'checksum_valid, confidence, method, preprocessing, ocr_config, total_ms, pipeline_ms, '
+                        'queue_ms, engine_calls, candidates, timings, response) '
+                        'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                        rows)
+                    conn.executemany('INSERT OR IGNORE INTO images (hash, created, data) VALUES (?, ?, ?)', images)
+                    conn.execute('COMMIT')
+                except BaseException:
+                    conn.execute('ROLLBACK')
+                    raise
+            except sqlite3.Error as e:
+                print(f"Scan store error: {e}")
+                metrics.inc('ocr_scan_store_rows_total', amount=len(rows), outcome='error')
+                return
+        metrics.inc('ocr_scan_store_rows_total', amount=len(rows), outcome='written')
+
+    def flush(self):
+        """
+        Write everything still queued by this process; called at exit
+        """
+        if not self.enabled or self._pid != os.getpid():
+            return
+        batch = []
+        while True:
+            try:
+                batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+            if len(batch) >= STORE_BATCH:
+                self._write(batch)
+                batch = []
+        if batch:
+            self._write(batch)
+
+    def prune(self):
+        """
+        Delete scans and images past their retention, and images no scan refers to any more
+        """
+        self._last_prune = time.time()
+        with self._write_lock:
+            try:
+                conn = self._connect()
+                if self.retention > 0:
+                    conn.execute('DELETE FROM scans WHERE created < ?', (time.time() - self.retention,))
+                if self.image_retention > 0:
+                    conn.execute('DELETE FROM images WHERE created < ?', (time.time() - self.image_retention,))
+                conn.execute('DELETE FROM images WHERE hash NOT IN (SELECT image_hash FROM scans)')
+            except sqlite3.Error as e:
+                print(f"Scan store prune error: {e}")
+
+    def scans(self, since=None, limit=None):
+        """
+        Recorded scans whose image is stored, oldest first, one per image hash and
+        skipping cache hits; each a dict with the recorded columns plus `image`
+        """
+        query = ('SELECT s.id, s.created, s.image_hash, s.success, s.patient_number, s.national_number, '
+                 's.checksum_valid, s.confidence, s.preprocessing, s.ocr_config, s.total_ms, s.pipeline_ms, '
+                 's.queue_ms, s.engine_calls, s.candidates, s.timings, i.data FROM scans s JOIN images i ON i.hash = s.image_hash '
+                 'WHERE s.cached = 0 AND s.created >= ? AND s.id IN '
+                 '(SELECT MIN(id) FROM scans WHERE cached = 0 GROUP BY image_hash) ORDER BY s.id')
+        params = [since or 0]
+        if limit:
+            query += ' LIMIT ?'
+            params.append(limit)
+        columns = ('id', 'created', 'image_hash', 'success', 'patient_number', 'national_number', 'checksum_valid',
+                   'confidence', 'preprocessing', 'ocr_config', 'total_ms', 'pipeline_ms', 'queue_ms', 'engine_calls',
+                   'candidates', 'timings', 'image')
+        for row in self._connect().execute(query, params):
+            scan = dict(zip(columns, row))
+            scan['success'] = bool(scan['success'])
+            scan['candidates'] = json.loads(scan['candidates'])
+            scan['timings'] = json.loads(scan['timings'])
+            yield scan
+
+    def stats(self):
+        if not self.enabled:
+            return {'enabled': False}
+        try:
+            conn = self._connect()
+            scans = conn.execute('SELECT COUNT(*) FROM scans').fetchone()[0]
+            images = conn.execute('SELECT COUNT(*), COALESCE(SUM(LENGTH(data)), 0) FROM images').fetchone()
+        except sqlite3.Error as e:
+            return {'enabled': True, 'error': str(e)}
+        current = self._pid == os.getpid()
+        return {
+            'enabled': True,
+            'path': self.path,
+            'scans': scans,
+            'images': images[0],
+            'image_bytes': images[1],
+            'keep_images': self.keep_images,
+            'queued': self._queue.qsize() if current else 0,
+            'dropped': self.dropped if current else 0,
+        }
+
+
+scan_store = ScanStore()
+atexit.register(scan_store.flush)
@@ -0,0 +1,207 @@
+"""
+Adaptive ordering of OCR attempts.
+
+Keeps per-arm trial and win counts, where an arm is a preprocessing variant
+with its OCR config, bucketed by cheap image features (brightness, contrast,
+glare). Attempts are ordered by Thompson sampling over those counts, so the
+arm that usually wins on this card stock and lighting runs first, while
+rarely-winning arms still get explored now and then. Arms that almost never
+win after enough trials are pruned from the list.
+
+Counts are kept in memory by each worker and merged into a shared JSON file
+under an exclusive lock every OCR_SCHEDULER_FLUSH_SECONDS. All workers learn from each other,
+and what was learned survives worker recycling and restarts.
+"""
+import atexit
+import fcntl
+import json
+import os
+import random
+import tempfile
+import threading
+import time
+
+import cv2
+import numpy as np
+
+SCHEDULER_ENABLED = os.environ.get('OCR_SCHEDULER', 'true').lower() in ('1', 'true', 'yes')
+SCHEDULER_PATH = os.environ.get('OCR_SCHEDULER_PATH', os.path.join(tempfile.gettempdir(), 'ocr-scheduler.json'))
+SCHEDULER_FLUSH_SECONDS = float(os.environ.get('OCR_SCHEDULER_FLUSH_SECONDS', 30))
+# Chance of trying the full attempt list in a random order, pruned arms included
+SCHEDULER_EXPLORE = float(os.environ.get('OCR_SCHEDULER_EXPLORE', 0.05))
+# Arms winning less often than this after SCHEDULER_MIN_TRIALS attempts are skipped
+SCHEDULER_PRUNE_BELOW = float(os.environ.get('OCR_SCHEDULER_PRUNE_BELOW', 0.02))
+SCHEDULER_MIN_TRIALS = int(os.environ.get('OCR_SCHEDULER_MIN_TRIALS', 50))
+
+# Feature thresholds on a 0-255 grayscale thumbnail
+DARK_BELOW = 90
+BRIGHT_ABOVE = 170
+LOW_CONTRAST_BELOW = 40
+GLARE_LEVEL = 245
+GLARE_FRACTION = 0.02
+
+
+def image_features(gray_array):
+    """
+    Mean brightness, contrast (standard deviation) and glare fraction from a
+    256-pixel-wide thumbnail, plus the context bucket they fall in
+    """
+    height, width = gray_array.shape[:2]
+    scale = min(1.0, 256.0 / width)
+    thumb = cv2.resize(gray_array, (max(1, int(width * scale)), max(1, int(height * scale))),
+                       interpolation=cv2.INTER_AREA) if scale < 1.0 else gray_array
+
+    brightness = float(thumb.mean())
+    contrast = float(thumb.std())
+    glare = float(np.count_nonzero(thumb >= GLARE_LEVEL)) / thumb.size
+
+    context = '/'.join((
+        'dark' if brightness < DARK_BELOW else 'bright' if brightness > BRIGHT_ABOVE else 'normal',
+        'flat' if contrast < LOW_CONTRAST_BELOW else 'contrast',
+        'glare' if glare > GLARE_FRACTION else 'matte',
+    ))
+    return {
+        'brightness': round(brightness, 1),
+        'contrast': round(contrast, 1),
+        'glare': round(glare, 4),
+        'context': context,
+    }
+
+
+class AttemptScheduler:
+    """
+    Thompson-sampling scheduler over OCR arms, with counts shared through a locked JSON file
+    """
+
+    def __init__(self, path=SCHEDULER_PATH, enabled=SCHEDULER_ENABLED):
+        self.path = path
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        # {context: {arm: [trials, wins]}} merged across workers, and this worker's unflushed share
+        self._totals = {}
+        self._pending = {}
+        self._loaded = False
+        self._last_flush = 0.0
+
+    def _counts(self, context, arm):
+        merged = self._totals.get(context, {}).get(arm, [0, 0])
+        local = self._pending.get(context, {}).get(arm, [0, 0])
+        return merged[0] + local[0], merged[1] + local[1]
+
+    def order(self, context, arms):
+        """
+        `arms` reordered (and possibly pruned) for an image in `context`
+        """
+        if not self.enabled:
+            return list(arms)
+        self._ensure_loaded()
+
+        if random.random() < SCHEDULER_EXPLORE:
+            explored = list(arms)
+            random.shuffle(explored)
+            return explored
+
+        scored = []
+        with self._lock:
+            for position, arm in enumerate(arms):
+                trials, wins = self._counts(context, arm)
+                if trials >= SCHEDULER_MIN_TRIALS and wins < SCHEDULER_PRUNE_BELOW * trials:
+                    continue
+                # Beta(wins + 1, losses + 1) sample; the configured order breaks ties
+                scored.append((random.betavariate(wins + 1, trials - wins + 1), -position, arm))
+
+        if not scored:
+            return list(arms)
+        scored.sort(reverse=True)
+        return [arm for _, _, arm in scored]
+
+    def record(self, context, attempted, winner):
+        """
+        Count one trial for each attempted arm and a win for `winner` (None if nothing validated)
+        """
+        if not self.enabled:
+            return
+        with self._lock:
+            arms = self._pending.setdefault(context, {})
+            for arm in attempted:
+                counts = arms.setdefault(arm, [0, 0])
+                counts[0] += 1
+                if arm == winner:
+                    counts[1] += 1
+        if time.time() - self._last_flush >= SCHEDULER_FLUSH_SECONDS:
+            self.flush()
+
+    def _ensure_loaded(self):
+        if not self._loaded:
+            self.flush()
+
+    def flush(self):
+        """
+        Add this worker's pending counts to the shared file and reload the merged totals
+        """
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            self._last_flush = time.time()
+        try:
+            with open(self.path, 'a+') as f:
+                fcntl.flock(f, fcntl.LOCK_EX)
+                try:
+                    f.seek(0)
+                    content = f.read()
+                    totals = json.loads(content) if content.strip() else {}
+                    for context, arms in pending.items():
+                        for arm, (trials, wins) in arms.items():
+                            counts = totals.setdefault(context, {}).setdefault(arm, [0, 0])
+                            counts[0] += trials
+                            counts[1] += wins
+                    if pending:
+                        f.seek(0)
+                        f.truncate()
+                        json.dump(totals, f)
+                        f.flush()
+                finally:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+        except (OSError, ValueError) as e:
+            print(f"Scheduler stats error: {e}")
+            # Keep the counts for the next flush
+            with self._lock:
+                for context, arms in pending.items():
+                    for arm, (trials, wins) in arms.items():
+                        counts = self._pending.setdefault(context, {}).setdefault(arm, [0, 0])
+                        counts[0] += trials
+                        counts[1] += wins
+            return
+
+        with self._lock:
+            self._totals = totals
+            self._loaded = True
+
+    def stats(self):
+        if not self.enabled:
+            return {'enabled': False}
+        self._ensure_loaded()
+        contexts = {}
+        with self._lock:
+            names = set(self._totals) | set(self._pending)
+            for context in sorted(names):
+                arms = set(self._totals.get(context, {})) | set(self._pending.get(context, {}))
+                contexts[context] = {}
+                for arm in sorted(arms):
+                    trials, wins = self._counts(context, arm)
+                    contexts[context][arm] = {
+                        'trials': trials,
+                        'wins': wins,
+                        'win_rate': round(wins / trials, 3) if trials else None,
+                    }
+        return {
+            'enabled': True,
+            'explore': SCHEDULER_EXPLORE,
+            'prune_below': SCHEDULER_PRUNE_BELOW,
+            'min_trials': SCHEDULER_MIN_TRIALS,
+            'contexts': contexts,
+        }
+
+
+attempt_scheduler = AttemptScheduler()
+# Workers recycled by max_requests keep what they learned since the last flush
+atexit.register(attempt_scheduler.flush)
@@ -0,0 +1,47 @@
+"""
+Files shared by all gunicorn workers on a host.
+
+The result cache, job queue, live sessions and metrics keep their state on
+/dev/shm, a RAM-backed filesystem every preforked worker can open, or in the
+temp directory where there is none. Their SQLite databases are opened here:
+one connection per thread and per process, in WAL mode, since a connection
+must not be shared between threads or cross a fork.
+"""
+import os
+import sqlite3
+import tempfile
+import threading
+
+_local = threading.local()
+
+
+def shared_dir():
+    """
+    /dev/shm where it exists, the temp directory otherwise
+    """
+    return '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+
+
+def connect(path, schema, synchronous='OFF', timeout=5, migrations=()):
+    """
+    This thread's autocommit connection to the SQLite file at `path`. On first use
+    in a thread and process, `schema` is applied, then each of the `migrations`
+    statements that has not been applied yet.
+    """
+    if getattr(_local, 'pid', None) != os.getpid():
+        _local.connections = {}
+        _local.pid = os.getpid()
+    conn = _local.connections.get(path)
+    if conn is None:
+        conn = sqlite3.connect(path, timeout=timeout, isolation_level=None)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute(f'PRAGMA synchronous={synchronous}')
+        conn.executescript(schema)
+        for statement in migrations:
+            try:
+                conn.execute(statement)
+            except sqlite3.OperationalError:
+                # Already applied, e.g. a column added by an earlier deploy
+                pass
+        _local.connections[path] = conn
+    return conn
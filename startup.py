@@ -0,0 +1,200 @@
+"""
+Cold start: import and initialisation timings, OCR warmup and readiness.
+
+The web layer imports only what / and /health need; the OCR modules (OpenCV,
+NumPy, the pipeline) are imported by warmup(), which also runs a synthetic
+card through the whole pipeline and through Tesseract so language data,
+templates and code paths are loaded. Under gunicorn with preload_app this
+happens once in the master before the workers are forked, so every worker
+starts warm, engines included (see EnginePool.prewarm). Elsewhere each
+process warms itself in a background thread on first use of ensure_warm().
+
+A process is ready once warmup has finished. Stage timings are kept per
+process and inherited by forked workers.
+"""
+import importlib
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+OCR_WARMUP = os.environ.get('OCR_WARMUP', 'true').lower() in ('1', 'true', 'yes')
+# Tesseract engines created in the preload master and inherited by every worker
+OCR_WARMUP_ENGINES = int(os.environ.get('OCR_WARMUP_ENGINES', 1))
+
+# Everything the OCR routes import; none of it is needed for / or /health
+OCR_MODULES = ('image_decode', 'result_cache', 'scheduler', 'preflight', 'card_geometry', 'pipeline', 'live_scan')
+
+WARMUP_NUMBER = '85.07.30-033.28'
+
+
+def process_started():
+    """
+    Wall-clock time this process was started, from /proc; now where that is unavailable
+    """
+    try:
+        with open('/proc/self/stat') as f:
+            # The command name may contain spaces; the fields after it are fixed
+            fields = f.read().rsplit(')', 1)[1].split()
+        with open('/proc/uptime') as f:
+            uptime = float(f.read().split()[0])
+        age = uptime - int(fields[19]) / os.sysconf('SC_CLK_TCK')
+        return time.time() - max(0.0, age)
+    except (OSError, ValueError, IndexError):
+        return time.time()
+
+
+PROCESS_STARTED = process_started()
+_imported = time.time()
+
+_lock = threading.Lock()
+_stages = {'interpreter': _imported - PROCESS_STARTED}
+_state = {'ready': not OCR_WARMUP, 'ready_at': None, 'warmed_by': None, 'warming_pid': None, 'error': None}
+
+
+@contextmanager
+def timed(stage):
+    """
+    Record the duration of the block as startup stage `stage`
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        with _lock:
+            _stages[stage] = time.perf_counter() - start
+
+
+def mark(stage):
+    """
+    Record the time since this module was imported as stage `stage`
+    """
+    with _lock:
+        _stages[stage] = time.time() - _imported
+
+
+def is_ready():
+    return _state['ready']
+
+
+def synthetic_card():
+    """
+    Grayscale card with a patient number line and some text, as a PIL image
+    """
+    from PIL import Image, ImageDraw, ImageFont
+
+    try:
+        font = ImageFont.truetype('DejaVuSans.ttf', 40)
+    except OSError:
+        font = ImageFont.load_default()
+    card = Image.new('L', (1024, 646), 235)
+    draw = ImageDraw.Draw(card)
+    draw.rectangle((0, 0, 1023, 645), outline=40, width=6)
+    draw.text((60, 80), 'BELGIE  BELGIQUE', fill=30, font=font)
+    draw.text((60, 200), 'PATIENT', fill=30, font=font)
+    draw.text((60, 480), WARMUP_NUMBER, fill=20, font=font)
+    return card
+
+
+def warmup():
+    """
+    Import the OCR modules and run a synthetic card through preflight, rectification,
+    the OCR passes and Tesseract. Safe to call more than once; later calls return at once.
+    """
+    with _lock:
+        if _state['ready'] and _state['warmed_by'] is not None:
+            return
+    start = time.perf_counter()
+    try:
+        with timed('import_ocr'):
+            for module in OCR_MODULES:
+                importlib.import_module(module)
+            import cv2
+            import numpy as np
+            from concurrency import apply_thread_limits
+            from metrics import metrics
+            from ocr_engine import AVAILABLE, engine_pool
+            from pipeline import recognize
+            from preflight import preflight_check
+            from scheduler import attempt_scheduler
+
+        card = synthetic_card()
+        # Warmup calls must not show up in the metrics or teach the scheduler
+        metrics_enabled, scheduler_enabled = metrics.enabled, attempt_scheduler.enabled
+        metrics.enabled = attempt_scheduler.enabled = False
+        # No OpenCV pool threads in the master: a forked worker would inherit a pool without threads
+        cv2.setNumThreads(1)
+        try:
+            with timed('warmup_pipeline'):
+                preflight_check(np.asarray(card))
+                recognize(card, concurrent=False)
+            if AVAILABLE:
+                with timed('warmup_tesseract'):
+                    line = card.crop((40, 450, 700, 540))
+                    try:
+                        engine_pool.prewarm(line, OCR_WARMUP_ENGINES)
+                    except Exception as e:
+                        # The pipeline falls back to the digit reader; readiness does not depend on Tesseract
+                        print(f"Tesseract warmup error: {e}")
+        finally:
+            metrics.enabled, attempt_scheduler.enabled = metrics_enabled, scheduler_enabled
+            apply_thread_limits()
+    except Exception as e:
+        print(f"Warmup error: {e}")
+        with _lock:
+            _state['error'] = str(e)
+    with _lock:
+        _stages['warmup'] = time.perf_counter() - start
+        _state.update(ready=True, ready_at=time.time(), warmed_by=os.getpid())
+
+
+def ensure_warm():
+    """
+    Start warmup in a background thread, once per process, unless it already ran
+    (in this process or in the master it was forked from)
+    """
+    with _lock:
+        if _state['ready'] or _state['warming_pid'] == os.getpid():
+            return
+        _state['warming_pid'] = os.getpid()
+    threading.Thread(target=warmup, name='ocr-warmup', daemon=True).start()
+
+
+def status():
+    """
+    Readiness and startup stage timings of this process, in seconds
+    """
+    with _lock:
+        stages = {stage: round(seconds, 3) for stage, seconds in _stages.items()}
+        state = dict(_state)
+    info = {
+        'ready': state['ready'],
+        'pid': os.getpid(),
+        'uptime_seconds': round(time.time() - PROCESS_STARTED, 1),
+        'stages': stages,
+        # Forked workers inherit the master's warmup
+        'warmed_in': None if state['warmed_by'] is None else (
+            'this_process' if state['warmed_by'] == os.getpid() else 'master'),
+    }
+    if state['ready_at'] is not None:
+        info['seconds_to_ready'] = round(state['ready_at'] - PROCESS_STARTED, 3)
+    if state['error']:
+        info['error'] = state['error']
+    return info
+
+
+def render():
+    """
+    Startup stage timings of this process as a Prometheus gauge
+    """
+    lines = [
+        '# HELP ocr_startup_seconds Import and initialisation time by startup stage, of the serving process',
+        '# TYPE ocr_startup_seconds gauge',
+    ]
+    with _lock:
+        for stage, seconds in sorted(_stages.items()):
+            lines.append(f'ocr_startup_seconds{{stage="{stage}"}} {seconds}')
+    lines.append('# HELP ocr_ready Whether the serving process has finished warmup')
+    lines.append('# TYPE ocr_ready gauge')
+    lines.append(f'ocr_ready {int(is_ready())}')
+    return '\n'.join(lines) + '\n'
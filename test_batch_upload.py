@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+import io
+import tarfile
+import zipfile
+
+import pytest
+
+import batch_upload
+from batch_upload import BatchFormatError, ImageTooBig, iter_batch_images
+
+IMAGES = [('a.jpg', b'\xff\xd8first'), ('cards/b.png', b'\x89PNGsecond' * 50)]
+
+
+class Chunked(io.RawIOBase):
+    """A request body that hands out at most `size` bytes per read, like a socket"""
+
+    def __init__(self, data, size=7):
+        self.data = io.BytesIO(data)
+        self.size = size
+
+    def readable(self):
+        return True
+
+    def read(self, n=-1):
+        return self.data.read(self.size if n is None or n < 0 else min(n, self.size))
+
+    def readinto(self, buffer):
+        chunk = self.read(len(buffer))
+        buffer[:len(chunk)] = chunk
+        return len(chunk)
+
+
+def tar_body(files, mode='w'):
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode=mode) as archive:
+        for name, data in files:
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            archive.addfile(info, io.BytesIO(data))
+    return buffer.getvalue()
+
+
+def zip_body(files):
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as archive:
+        for name, data in files:
+            archive.writestr(name, data)
+    return buffer.getvalue()
+
+
+def multipart_body(files, boundary='batchboundary'):
+    body = b''
+    for name, data in files:
+        body += (f'--{boundary}\r\nContent-Disposition: form-data; name="images"; filename="{name}"\r\n'
+                 f'Content-Type: application/octet-stream\r\n\r\n').encode() + data + b'\r\n'
+    return body + f'--{boundary}--\r\n'.encode()
+
+
+def read(mimetype, body, params=None):
+    return list(iter_batch_images(mimetype, params or {}, Chunked(body)))
+
+
+def test_tar():
+    files = IMAGES + [('notes.txt', b'skipped')]
+    assert read('application/x-tar', tar_body(files)) == IMAGES
+
+
+def test_compressed_tar():
+    assert read('application/gzip', tar_body(IMAGES, 'w:gz')) == IMAGES
+
+
+def test_zip():
+    files = IMAGES + [('notes.txt', b'skipped'), ('__MACOSX/._a.jpg', b'resource fork')]
+    assert read('application/zip', zip_body(files)) == IMAGES
+
+
+def test_multipart():
+    body = multipart_body(IMAGES)
+    assert read('multipart/form-data', body, {'boundary': 'batchboundary'}) == IMAGES
+
+
+def test_oversized_image_is_reported_not_buffered(monkeypatch):
+    monkeypatch.setattr(batch_upload, 'MAX_IMAGE_BYTES', 100)
+    for mimetype, body, params in (
+            ('application/x-tar', tar_body(IMAGES), None),
+            ('application/zip', zip_body(IMAGES), None),
+            ('multipart/form-data', multipart_body(IMAGES), {'boundary': 'batchboundary'})):
+        (first, first_data), (second, second_data) = read(mimetype, body, params)
+        assert (first, first_data) == IMAGES[0]
+        assert second == 'cards/b.png'
+        assert isinstance(second_data, ImageTooBig)
+
+
+def test_unsupported_content_type():
+    with pytest.raises(BatchFormatError):
+        read('image/jpeg', b'\xff\xd8')
+
+
+def test_multipart_without_boundary():
+    with pytest.raises(BatchFormatError):
+        read('multipart/form-data', multipart_body(IMAGES))
+
+
+def test_not_an_archive():
+    with pytest.raises(BatchFormatError):
+        read('application/x-tar', b'this is not a tar archive' * 40)
+    with pytest.raises(BatchFormatError):
+        read('application/zip', b'this is not a zip archive')
+
+
+def test_truncated_tar():
+    body = tar_body(IMAGES)
+    with pytest.raises(BatchFormatError):
+        read('application/x-tar', body[:600])
+
+
+def test_truncated_compressed_tar():
+    body = tar_body(IMAGES, 'w:gz')
+    with pytest.raises(BatchFormatError):
+        read('application/gzip', body[:len(body) // 2])
+
+
+def test_corrupt_tar_after_first_member():
+    body = bytearray(tar_body(IMAGES))
+    # Second member's header
+    body[1024:1124] = b'\x01' * 100
+    with pytest.raises(BatchFormatError):
+        read('application/x-tar', bytes(body))
+
+
+def test_truncated_zip():
+    body = zip_body(IMAGES)
+    with pytest.raises(BatchFormatError):
+        read('application/zip', body[:len(body) - 30])
+
+
+def test_truncated_multipart():
+    body = multipart_body(IMAGES)
+    with pytest.raises(BatchFormatError):
+        read('multipart/form-data', body[:len(body) // 2], {'boundary': 'batchboundary'})
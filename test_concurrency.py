@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+import os
+
+import pytest
+
+import concurrency
+from concurrency import available_cpus, cgroup_cpu_limit, plan
+
+
+@pytest.fixture
+def cgroup(tmp_path, monkeypatch):
+    """A fake /sys/fs/cgroup: write(name, value) creates one of its files"""
+    monkeypatch.setattr(concurrency, 'CGROUP_V2_CPU_MAX', str(tmp_path / 'cpu.max'))
+    monkeypatch.setattr(concurrency, 'CGROUP_V1_DIRS', (str(tmp_path / 'cpu'), str(tmp_path / 'cpu,cpuacct')))
+
+    def write(name, value):
+        path = tmp_path / name
+        path.parent.mkdir(exist_ok=True)
+        path.write_text(f'{value}\n')
+    return write
+
+
+def test_no_cgroup_files(cgroup):
+    assert cgroup_cpu_limit() is None
+
+
+def test_cgroup_v2_quota(cgroup):
+    cgroup('cpu.max', '200000 100000')
+    assert cgroup_cpu_limit() == 2.0
+
+
+def test_cgroup_v2_fractional_quota(cgroup):
+    cgroup('cpu.max', '150000 100000')
+    assert cgroup_cpu_limit() == 1.5
+
+
+def test_cgroup_v2_unlimited(cgroup):
+    cgroup('cpu.max', 'max 100000')
+    # v1 files are not consulted once cpu.max exists
+    cgroup('cpu/cpu.cfs_quota_us', '100000')
+    cgroup('cpu/cpu.cfs_period_us', '100000')
+    assert cgroup_cpu_limit() is None
+
+
+def test_cgroup_v1_quota(cgroup):
+    cgroup('cpu/cpu.cfs_quota_us', '300000')
+    cgroup('cpu/cpu.cfs_period_us', '100000')
+    assert cgroup_cpu_limit() == 3.0
+
+
+def test_cgroup_v1_combined_controller(cgroup):
+    cgroup('cpu,cpuacct/cpu.cfs_quota_us', '50000')
+    cgroup('cpu,cpuacct/cpu.cfs_period_us', '100000')
+    assert cgroup_cpu_limit() == 0.5
+
+
+def test_cgroup_v1_unlimited(cgroup):
+    cgroup('cpu/cpu.cfs_quota_us', '-1')
+    cgroup('cpu/cpu.cfs_period_us', '100000')
+    assert cgroup_cpu_limit() is None
+
+
+def test_available_cpus_rounds_the_quota_up(cgroup, monkeypatch):
+    monkeypatch.delenv('OCR_CPUS', raising=False)
+    monkeypatch.setattr(os, 'sched_getaffinity', lambda pid: set(range(8)), raising=False)
+    cgroup('cpu.max', '150000 100000')
+    assert available_cpus() == 2
+
+
+def test_available_cpus_is_capped_by_affinity(cgroup, monkeypatch):
+    monkeypatch.delenv('OCR_CPUS', raising=False)
+    monkeypatch.setattr(os, 'sched_getaffinity', lambda pid: {0, 1}, raising=False)
+    cgroup('cpu.max', '400000 100000')
+    assert available_cpus() == 2
+
+
+def test_ocr_cpus_overrides(cgroup, monkeypatch):
+    monkeypatch.setenv('OCR_CPUS', '6')
+    cgroup('cpu.max', '100000 100000')
+    assert available_cpus() == 6
+
+
+def test_plan():
+    assert plan(1, 'latency')['workers'] == 1
+    latency = plan(4, 'latency')
+    assert (latency['workers'], latency['ocr_slots'], latency['concurrent']) == (2, 2, True)
+    throughput = plan(4, 'throughput')
+    assert (throughput['workers'], throughput['ocr_slots'], throughput['concurrent']) == (4, 1, False)
+    assert plan(4, 'throughput', workers=3)['workers'] == 3
@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+import sqlite3
+import subprocess
+import sys
+import threading
+import time
+
+import pytest
+
+from jobs import ORPHANED_ERROR, JobQueue, QueueFull
+
+
+def make_queue(tmp_path, handler, **kwargs):
+    return JobQueue(handler, workers=1, path=str(tmp_path / 'jobs.sqlite'), **kwargs)
+
+
+def dead_pid():
+    process = subprocess.Popen([sys.executable, '-c', 'pass'])
+    process.wait()
+    return process.pid
+
+
+def wait_for(jobs, job_id, status):
+    deadline = time.time() + 5
+    while jobs.get(job_id)['status'] != status:
+        assert time.time() < deadline, jobs.get(job_id)
+        time.sleep(0.01)
+
+
+def test_job_result(tmp_path):
+    jobs = make_queue(tmp_path, lambda image_data: {'national_number': image_data.decode()})
+    job_id = jobs.submit(b'39121719306')
+    job = jobs.get(job_id, wait=5)
+    assert job['status'] == 'done'
+    assert job['result'] == {'national_number': '39121719306'}
+    assert jobs.get('unknown') is None
+
+
+def test_handler_error_fails_the_job(tmp_path):
+    def handler(image_data):
+        raise ValueError('cannot decode image')
+
+    jobs = make_queue(tmp_path, handler)
+    job = jobs.get(jobs.submit(b'x'), wait=5)
+    assert job['status'] == 'failed'
+    assert job['error'] == 'cannot decode image'
+
+
+def test_queue_full(tmp_path):
+    release = threading.Event()
+    jobs = make_queue(tmp_path, lambda image_data: release.wait(5), maxsize=1)
+    running = jobs.submit(b'1')
+    wait_for(jobs, running, 'running')
+    queued = jobs.submit(b'2')
+
+    with pytest.raises(QueueFull) as error:
+        jobs.submit(b'3')
+    assert error.value.retry_after >= 1
+    # The rejected job leaves no record behind
+    assert jobs.stats()['queued'] == 1
+
+    release.set()
+    assert jobs.get(queued, wait=5)['status'] == 'done'
+
+
+def test_jobs_of_a_dead_worker_are_orphaned(tmp_path):
+    jobs = make_queue(tmp_path, lambda image_data: {})
+    conn = jobs._connect()
+    pid = dead_pid()
+    for job_id, status in (('queued-job', 'queued'), ('running-job', 'running')):
+        conn.execute('INSERT INTO jobs (id, status, created, pid) VALUES (?, ?, ?, ?)',
+                     (job_id, status, time.time(), pid))
+
+    job = jobs.get('queued-job')
+    assert job['status'] == 'failed'
+    assert job['error'] == ORPHANED_ERROR
+    assert jobs.get('running-job')['error'] == ORPHANED_ERROR
+
+
+def test_submit_fails_orphaned_jobs(tmp_path):
+    jobs = make_queue(tmp_path, lambda image_data: {})
+    jobs._connect().execute('INSERT INTO jobs (id, status, created, pid) VALUES (?, ?, ?, ?)',
+                            ('orphan', 'queued', time.time(), dead_pid()))
+    jobs.get(jobs.submit(b'x'), wait=5)
+    status, error = jobs._connect().execute("SELECT status, error FROM jobs WHERE id = 'orphan'").fetchone()
+    assert (status, error) == ('failed', ORPHANED_ERROR)
+
+
+def test_worker_thread_survives_bookkeeping_errors(tmp_path, monkeypatch):
+    jobs = make_queue(tmp_path, lambda image_data: {'ok': True})
+    process = jobs._process
+    calls = []
+
+    def flaky_process(job_id, image_data):
+        calls.append(job_id)
+        if len(calls) == 1:
+            raise sqlite3.OperationalError('database is locked')
+        process(job_id, image_data)
+
+    monkeypatch.setattr(jobs, '_process', flaky_process)
+    first = jobs.submit(b'1')
+    second = jobs.submit(b'2')
+    jobs._queue.join()
+
+    assert jobs.get(first)['status'] == 'failed'
+    assert 'database is locked' in jobs.get(first)['error']
+    assert jobs.get(second)['result'] == {'ok': True}
+    assert jobs._busy == 0
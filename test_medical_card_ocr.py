@@ -12,8 +12,8 @@ def test_medical_card_ocr():
     test_cases = [
         (
             "/home/ubuntu/attachments/a8e442a5-3e0b-41b0-b2bc-d29c253dbda0/IMG_4547.jpeg",
-            "3912171035",
-            "Real medical card with patient number 3912171035"
+            "39121719306",
+            "Real medical card with national number 39.12.17-193.06 (patient number 3912171035)"
         ),
         (
             "/home/ubuntu/attachments/b993fb49-dc23-45af-93ce-a9b3707e941c/IMG_4564.jpeg",
@@ -27,6 +27,9 @@ def test_medical_card_ocr():
     
     all_passed = True
     
+    # National number -> the card's own patient number, the only one that may be reported besides it
+    patient_numbers = {"39121719306": "3912171035"}
+    
     for image_path, expected_number, description in test_cases:
         print(f"\nTesting: {description}")
         print(f"Image: {image_path}")
@@ -48,10 +51,13 @@ def test_medical_card_ocr():
                 print(f"Response: {json.dumps(result, indent=2)}")
                 
                 if expected_number:
-                    if result.get('success') and result.get('patient_number') == expected_number:
-                        print(f"✓ SUCCESS: Correctly extracted patient number {expected_number}")
+                    patient_number = result.get('patient_number')
+                    if (result.get('success') and result.get('national_number') == expected_number
+                            and patient_number in (None, patient_numbers[expected_number])):
+                        print(f"✓ SUCCESS: Correctly extracted national number {expected_number}")
                     else:
-                        print(f"✗ FAILED: Expected {expected_number}, got {result.get('patient_number', 'None')}")
+                        print(f"✗ FAILED: Expected national number {expected_number}, got "
+                              f"{result.get('national_number', 'None')} (patient number {patient_number})")
                         all_passed = False
                 else:
                     if not result.get('success'):
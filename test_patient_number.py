@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+from patient_number import best_candidate, checksum_valid, generate_candidates, unique_correction
+
+# National register number printed on the reference card IMG_4547
+REFERENCE = '39.12.17-193.06'
+
+
+def test_checksum_valid():
+    assert checksum_valid('39121719306')
+    assert not checksum_valid('39121719307')
+
+
+def test_checksum_valid_after_2000():
+    # Births from 2000 on are checked with a leading "2"
+    base = '010203123'
+    check = 97 - int('2' + base) % 97
+    assert checksum_valid(f'{base}{check:02d}')
+
+
+def test_unique_correction():
+    # A single 7 read as 1 has one valid fix
+    assert unique_correction('39127719306') == ('39121719306', 1)
+
+
+def test_ambiguous_correction_is_rejected():
+    # Two single substitutions give valid numbers; picking one would be a guess
+    assert unique_correction('72480231611') is None
+
+
+def test_reference_card_is_a_national_number():
+    candidate = best_candidate(REFERENCE)
+    assert candidate.national_number == '39121719306'
+    assert candidate.checksum_valid
+    assert candidate.confidence >= 0.95
+
+
+def test_no_patient_number_is_derived_from_the_national_number():
+    candidates = generate_candidates(REFERENCE)
+    assert all(c.national_number for c in candidates)
+    assert '3912171930' not in [c.number for c in candidates]
+
+
+def test_standalone_ten_digit_number():
+    candidates = generate_candidates('Nr 3912171035')
+    assert candidates[0].number == '3912171035'
+    assert candidates[0].national_number is None
+    assert not candidates[0].checksum_valid
+
+
+def test_ten_digit_number_next_to_national_number():
+    numbers = {c.number: c for c in generate_candidates(f'3912171035\n{REFERENCE}')}
+    assert numbers['3912171035'].source == 'ten_digits'
+    assert numbers['39121719306'].national_number == '39121719306'
+    assert '3912171930' not in numbers
@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+from PIL import Image, ImageDraw
+
+import result_cache
+from result_cache import ResultCache, hamming, perceptual_hash
+
+
+class Clock:
+    """Stands in for the time module so entries get distinct, controllable timestamps"""
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def time(self):
+        self.now += 1
+        return self.now
+
+
+def make_cache(tmp_path, monkeypatch, **kwargs):
+    clock = Clock()
+    monkeypatch.setattr(result_cache, 'time', clock)
+    return ResultCache(path=str(tmp_path / 'cache.sqlite'), enabled=True, **kwargs), clock
+
+
+def card(offset):
+    image = Image.new('L', (320, 200), 255)
+    draw = ImageDraw.Draw(image)
+    draw.rectangle((20 + offset, 40, 180 + offset, 90), fill=0)
+    draw.ellipse((200, 100 + offset, 300, 180 + offset), fill=80)
+    return image
+
+
+def test_exact_hit_and_miss(tmp_path, monkeypatch):
+    cache, _ = make_cache(tmp_path, monkeypatch)
+    cache.put('a', {'national_number': '39121719306'})
+    assert cache.get('a') == {'national_number': '39121719306'}
+    assert cache.get('b') is None
+    stats = cache.stats()
+    assert (stats['hits'], stats['misses'], stats['entries']) == (1, 1, 1)
+
+
+def test_evicts_least_recently_used_past_max_entries(tmp_path, monkeypatch):
+    cache, _ = make_cache(tmp_path, monkeypatch, max_entries=2)
+    cache.put('a', {'n': 1})
+    cache.put('b', {'n': 2})
+    # Reading "a" makes "b" the least recently used
+    assert cache.get('a') == {'n': 1}
+    cache.put('c', {'n': 3})
+    assert cache.get('b') is None
+    assert cache.get('a') == {'n': 1}
+    assert cache.get('c') == {'n': 3}
+
+
+def test_evicts_least_recently_used_past_max_bytes(tmp_path, monkeypatch):
+    payload = {'text': 'x' * 100}
+    cache, _ = make_cache(tmp_path, monkeypatch, max_bytes=250)
+    cache.put('a', payload)
+    cache.put('b', payload)
+    cache.put('c', payload)
+    assert cache.get('a') is None
+    assert cache.get('b') == payload
+    assert cache.get('c') == payload
+    assert cache.stats()['bytes'] <= 250
+
+
+def test_oversized_response_is_not_stored(tmp_path, monkeypatch):
+    cache, _ = make_cache(tmp_path, monkeypatch, max_bytes=50)
+    cache.put('a', {'text': 'x' * 100})
+    assert cache.stats()['entries'] == 0
+
+
+def test_entries_expire_after_ttl(tmp_path, monkeypatch):
+    cache, clock = make_cache(tmp_path, monkeypatch, ttl=60)
+    cache.put('a', {'n': 1})
+    clock.now += 30
+    assert cache.get('a') == {'n': 1}
+    # Reads do not extend the lifetime of an entry
+    clock.now += 60
+    assert cache.get('a') is None
+    cache.put('b', {'n': 2})
+    assert cache.stats()['entries'] == 1
+
+
+def test_disabled_cache_stores_nothing(tmp_path):
+    cache = ResultCache(path=str(tmp_path / 'cache.sqlite'), enabled=False, perceptual=True)
+    cache.put('a', {'n': 1})
+    assert cache.get('a') is None
+    assert cache.get_similar(0) is None
+    assert cache.stats() == {'enabled': False}
+
+
+def test_hamming():
+    assert hamming(0, 0) == 0
+    assert hamming(0b1011, 0b0001) == 2
+    # Hashes are stored as signed 64-bit integers
+    assert hamming(-1, 0) == 64
+
+
+def test_perceptual_hash_is_stable_under_small_changes():
+    first = perceptual_hash(card(0))
+    # Recompressed or slightly shifted frames of the same shot
+    assert hamming(first, perceptual_hash(card(0).point(lambda v: min(255, v + 3)))) == 0
+    assert hamming(first, perceptual_hash(card(2))) <= result_cache.CACHE_PHASH_DISTANCE
+    assert -(1 << 63) <= first < (1 << 63)
+
+
+def test_get_similar_finds_the_closest_hash(tmp_path, monkeypatch):
+    cache, _ = make_cache(tmp_path, monkeypatch, perceptual=True)
+    near = perceptual_hash(card(0))
+    cache.put('card', {'national_number': '39121719306'}, near)
+    cache.put('other', {'national_number': '85073003328'}, near ^ 0xFFFF)
+    assert cache.get_similar(near ^ 0b1) == {'national_number': '39121719306'}
+    assert cache.get_similar(near ^ 0xFF00FF) is None
+    assert cache.stats()['perceptual_hits'] == 1
+
+
+def test_get_similar_needs_perceptual_lookups(tmp_path, monkeypatch):
+    cache, _ = make_cache(tmp_path, monkeypatch, perceptual=False)
+    phash = perceptual_hash(card(0))
+    cache.put('card', {'n': 1}, phash)
+    assert cache.get_similar(phash) is None